@@ -2,53 +2,43 @@ import os
 import sys
 # Add the root directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+# Add the shared background processing modules to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'Branch', 'Background')))
 from APIs.ChangeBackground.model_setup import setup_environment
-setup_environment()
 
-import shutil
-import cv2
-import numpy as np
-from rembg import remove
-from tqdm import tqdm
+# Shard worker processes re-import this module as __mp_main__ when it is the entry script,
+# and only need its definitions
+SERVING_PROCESS = __name__ != '__mp_main__'
+if SERVING_PROCESS:
+    setup_environment()
+
 import gdown
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
+from pipeline import replace_background, start_worker_pool
+from matting import warm_up_matting
+from options import ProcessingOptions, is_truthy
+from jobs import JobManager, COMPLETED, FAILED
+from result_cache import ResultCache
+from mask_cache import MaskCache
 
 
 app = Flask(__name__)
 CORS(app=app)  # Enable Cross-Origin Resource Sharing (CORS) for the Flask app
 
-# Define paths for output frames, video, and processing status
-OUTPUT_FRAMES_DIR = '/tmp/change_bg/output_frames'
-OUTPUT_VIDEO_PATH = '/tmp/change_bg/output_video.mp4'
-PROCESSING_COMPLETE_FLAG = '/tmp/change_bg/processing_complete.txt'
+# Load the matting model and start the shard workers once so the first request does not pay the load cost
+if SERVING_PROCESS:
+    warm_up_matting()
+    start_worker_pool()
 
-# Helper function to clear directories
-def clear_directories(paths):
-    """
-    Clears all files and subdirectories in the given list of directory paths.
+# Every job gets its own workspace (inputs, debug frames, output) under this directory
+JOBS_DIR = '/tmp/change_bg/jobs'
 
-    Args:
-        paths (list): List of directory paths to clear.
+# Outputs of previous jobs, reused when the same inputs and parameters are submitted again
+result_cache = ResultCache('/tmp/change_bg/cache')
 
-    Returns:
-        None
-    """
-    for path in paths:
-        if os.path.exists(path):
-            for file_name in os.listdir(path):
-                file_path = os.path.join(path, file_name)
-                try:
-                    # Delete files or directories
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        os.unlink(file_path)
-                    elif os.path.isdir(file_path):
-                        shutil.rmtree(file_path)
-                except Exception as e:
-                    print(f'Failed to delete {file_path}. Reason: {e}')
-            print(f"Directory {path} cleared successfully.")
-        else:
-            print(f"Directory {path} does not exist.")
+# Per-frame alpha masks of processed videos, so a new background on the same video skips matting
+mask_cache = MaskCache('/tmp/change_bg/mask_cache')
 
 # Helper function to download a file from Google Drive
 def download_from_google_drive(url, output_path):
@@ -70,27 +60,72 @@ def download_from_google_drive(url, output_path):
     except Exception as e:
         print(f"Failed to download file from {url}. Error: {str(e)}")
 
+def process_job(job):
+    """
+    Runs one queued background change job on a job worker thread.
+
+    Args:
+        job (Job): The job; its params hold the request URLs, the debug flag and the processing options.
+
+    Returns:
+        dict: Processing stats of the job.
+    """
+    params = job.params
+    workspace = job.workspace
+    options = ProcessingOptions(**params['options'])
+
+    # Download files from Google Drive into the job's own workspace
+    download_from_google_drive(params['video_url'], workspace.input_video_path)
+    download_from_google_drive(params['background_url'], workspace.background_path)
+
+    # Frames are only written to disk when explicitly debugging
+    debug_frames_dir = workspace.frames_dir if params['debug_frames'] else None
+
+    # The same video, background and parameters were rendered before: reuse that output
+    cache_key = result_cache.key(workspace.input_video_path, workspace.background_path, options)
+    if not debug_frames_dir and result_cache.fetch(cache_key, job.output_path):
+        return {'cache_hit': True}
+
+    # Stream frames through background removal straight into the job's output video
+    stats = replace_background(workspace.input_video_path, workspace.background_path, job.output_path,
+                               debug_frames_dir=debug_frames_dir, options=options,
+                               progress_callback=job.update_progress, mask_cache=mask_cache,
+                               checkpoint_dir=workspace.checkpoint_dir)
+    result_cache.store(cache_key, job.output_path)
+    return {**stats, 'cache_hit': False}
+
+# Background workers processing the queued jobs
+job_manager = JobManager(process_job, JOBS_DIR) if SERVING_PROCESS else None
+
 # Endpoint to process video
 @app.route('/change_background', methods=['POST'])
 def change_background():
     """
-    Endpoint to start the background change process for a video.
+    Endpoint to enqueue a background change job for a video.
 
     Expects form data with the following fields:
         - video_url (str): Google Drive link to the input video.
-        - background_url (str): Google Drive link to the new background image.
+        - background_url (str): Google Drive link to the new background, a still image or a video.
+        - debug_frames (str, optional): "true" to also dump every processed frame as a PNG.
+        - batch_size (int, optional): Number of frames matted per inference call.
+        - workers (int, optional): Number of processes the video is split across by frame range.
+        - temporal (str, optional): "true" to matte only keyframes and reuse their masks in between.
+        - keyframe_interval (int, optional): Maximum number of frames between two keyframes.
+        - diff_threshold (float, optional): Mean frame difference (0-255) that forces a new keyframe.
+        - inference_size (int, optional): Long side of the downscaled copy matting runs on, e.g. 512.
+        - refine_edges (str, optional): "true" to upsample downscaled masks with an edge-aware filter.
+        - encoder (str, optional): "ffmpeg" (libx264/libx265, keeps the audio) or "opencv" ('mp4v').
+        - codec (str, optional): "libx264" or "libx265".
+        - preset (str, optional): ffmpeg encoder preset, e.g. "veryfast".
+        - crf (int, optional): ffmpeg constant rate factor; lower is higher quality.
 
     Returns:
-        JSON response indicating the status of the processing and instructions for checking completion.
+        JSON response with the id of the enqueued job, to be polled at /job_status/<job_id>.
 
     Raises:
-        Exception: If an error occurs during processing.
+        Exception: If the job cannot be enqueued.
     """
     try:
-        # Clear and create the output frames directory
-        clear_directories([OUTPUT_FRAMES_DIR])
-        os.makedirs(OUTPUT_FRAMES_DIR, exist_ok=True)
-
         # Retrieve URLs from the request
         video_url = request.form.get('video_url')
         background_url = request.form.get('background_url')
@@ -99,84 +134,43 @@ def change_background():
         if not video_url or not background_url:
             return jsonify({'error': 'Both video URL and background URL are required.'}), 400
 
-        # Define paths for the downloaded files
-        input_video_path = os.path.join('/content', 'input_video.mp4')
-        new_background_path = os.path.join('/content', 'new_background.jpg')
-
-        # Download files from Google Drive
-        download_from_google_drive(video_url, input_video_path)
-        download_from_google_drive(background_url, new_background_path)
-
-        # Open the input video
-        cap = cv2.VideoCapture(input_video_path)
-        if not cap.isOpened():
-            return jsonify({'error': f'Could not open video {input_video_path}'}), 400
-
-        # Retrieve video properties
-        fps = int(cap.get(cv2.CAP_PROP_FPS))
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        try:
+            options = ProcessingOptions.from_form(request.form)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid processing option: {e}'}), 400
 
-        # Load and resize the new background
-        new_background = cv2.imread(new_background_path)
-        if new_background is None:
-            return jsonify({'error': f'Could not load background image {new_background_path}'}), 400
-        new_background_resized = cv2.resize(new_background, (frame_width, frame_height))
-
-        # Process each frame
-        for i in tqdm(range(frame_count), desc="Processing frames"):
-            ret, frame = cap.read()
-            if not ret:
-                break
-
-            try:
-                result = remove(frame)
-            except Exception as e:
-                print(f"Error removing background from frame {i}: {e}")
-                continue
-
-            # Ensure result has an alpha channel
-            if result.shape[-1] != 4:
-                result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
-
-            # Composite the result with the new background
-            alpha_channel = result[:, :, 3] / 255.0
-            for c in range(0, 3):
-                result[:, :, c] = result[:, :, c] * alpha_channel + new_background_resized[:, :, c] * (1 - alpha_channel)
-
-            # Save processed frame
-            frame_output_path = os.path.join(OUTPUT_FRAMES_DIR, f'{i:04d}.png')
-            cv2.imwrite(frame_output_path, result[:, :, :3])
-
-        cap.release()
-
-        # Reassemble the frames into a video
-        frame_files = sorted([f for f in os.listdir(OUTPUT_FRAMES_DIR) if f.endswith('.png')])
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        video_writer = cv2.VideoWriter(OUTPUT_VIDEO_PATH, fourcc, fps, (frame_width, frame_height))
-
-        for frame_file in tqdm(frame_files, desc="Reassembling Video"):
-            frame_path = os.path.join(OUTPUT_FRAMES_DIR, frame_file)
-            frame = cv2.imread(frame_path)
-            video_writer.write(frame)
-
-        video_writer.release()
-
-        # Create a flag file to indicate processing completion
-        with open(PROCESSING_COMPLETE_FLAG, 'w') as f:
-            f.write('Processing complete')
+        job = job_manager.submit({
+            'video_url': video_url,
+            'background_url': background_url,
+            'debug_frames': is_truthy(request.form.get('debug_frames')),
+            'options': options.to_dict(),
+        })
 
-        return jsonify({'message': 'Video processing started. Check the status for completion.'}), 202
+        return jsonify({'message': 'Video processing started. Check the status for completion.', 'job_id': job.id}), 202
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Endpoint to report the progress of a background change job.
+
+    Returns:
+        JSON response with the job status, frames done / total, fps, ETA and output path.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict()), 200
+
 @app.route('/get_path_change_bg', methods=['GET'])
 def get_path_change_bg():
     """
     Endpoint to retrieve the path of the output video from the background change operation.
 
+    Accepts an optional `job_id` query parameter; defaults to the most recent job.
+
     Returns:
         JSON response with the status and path to the output video, if it exists.
 
@@ -184,15 +178,14 @@ def get_path_change_bg():
         Exception: If there is an error retrieving the file path.
     """
     try:
-        # Path to the output video from the background change
-        OUTPUT_VIDEO_PATH = '/tmp/change_bg/output_video.mp4'
+        job = job_manager.get(request.args.get('job_id'))
 
         # Check if the output file exists
-        if os.path.exists(OUTPUT_VIDEO_PATH):
+        if job is not None and job.status == COMPLETED and os.path.exists(job.output_path):
             return jsonify({
                 'status': 'success',
                 'message': 'Output file path retrieved successfully',
-                'output_path': OUTPUT_VIDEO_PATH
+                'output_path': job.output_path
             })
         else:
             return jsonify({
@@ -210,13 +203,29 @@ def get_video_output_bg():
     """
     Endpoint to check processing status and get the video output if processing is complete.
 
+    Accepts an optional `job_id` query parameter; defaults to the most recent job.
+
+    Returns:
+        A video file if processing is complete, otherwise the job progress.
+    """
+    job = job_manager.get(request.args.get('job_id'))
+    if job is None:
+        return jsonify({'error': 'No background change job found.'}), 404
+    if job.status == COMPLETED:
+        return send_file(job.output_path, as_attachment=True, mimetype='video/mp4', download_name='output_video.mp4')
+    if job.status == FAILED:
+        return jsonify(job.to_dict()), 500
+    return jsonify({'message': 'Processing is still in progress. Please wait.', **job.to_dict()}), 202
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Endpoint to report the usage of the result and mask caches.
+
     Returns:
-        A video file if processing is complete, otherwise a message indicating that processing is still in progress.
+        JSON response with the hits, misses, hit rate, entry count and size in bytes of each cache.
     """
-    if os.path.exists(PROCESSING_COMPLETE_FLAG):
-        return send_file(OUTPUT_VIDEO_PATH, as_attachment=True, mimetype='video/mp4', download_name='output_video.mp4')
-    else:
-        return jsonify({'message': 'Processing is still in progress. Please wait.'}), 202
+    return jsonify({'results': result_cache.stats(), 'masks': mask_cache.stats()}), 200
 
 if __name__ == "__main__":
     app.run()  # Start the Flask application
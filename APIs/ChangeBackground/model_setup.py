@@ -10,6 +10,7 @@ def setup_environment():
         'ffmpeg-python',
         'tqdm',
         'rembg',
+        'onnx',
         'flask-ngrok',
         'pyngrok',
         'flask_cors',
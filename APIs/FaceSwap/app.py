@@ -1,9 +1,13 @@
-from flask import Flask, request, jsonify
 import os
-import subprocess
+import sys
+import json
+# Add the root directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+# Add the shared face swap modules to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'Branch', 'FaceSwap')))
+from flask import Flask, request, jsonify, send_file
 import gdown
 from flask_cors import CORS
-from tqdm import tqdm  # Import tqdm for progress tracking
 from APIs.FaceSwap.model_setup import setup_environment
 
 app = Flask(__name__)
@@ -15,6 +19,16 @@ ROOP_DIR = os.chdir("roop")  # Change the directory to where your Roop files are
 # Setup the Roop environment and dependencies
 setup_environment()
 
+# Load the face analyser and the inswapper session once; every request reuses them
+from face_swapper import FaceSwapper
+from face_tracker import DETECT_INTERVAL
+from jobs import JobManager, COMPLETED, FAILED
+MODEL_PATH = os.path.abspath(os.path.join('models', 'inswapper_128.onnx'))
+face_swapper = FaceSwapper(MODEL_PATH)
+
+# Every job gets its own workspace (inputs, output, job state) under this directory
+JOBS_DIR = '/tmp/uploaded_data/jobs'
+
 # Helper function to download a file from Google Drive
 def download_from_google_drive(url, output_path):
     """
@@ -36,82 +50,147 @@ def download_from_google_drive(url, output_path):
     except Exception as e:
         print(f"Failed to download file from {url}. Error: {str(e)}")
 
+# Runs one queued job on a job worker thread, a face swap or listing the identities of a
+# target video; all workers share the loaded models
+def process_job(job):
+    params = job.params
+    workspace = job.workspace
+
+    # Download the files from Google Drive into the job's own workspace
+    print("Downloading target video...")
+    download_from_google_drive(params['target_url'], workspace.target_video_path)
+    if params.get('kind') == 'identities':
+        # The identities are returned as the job stats
+        return {'identities': face_swapper.get_identities(workspace.target_video_path).to_list()}
+
+    face_mapping = None
+    if params.get('face_mapping'):
+        print("Downloading the source image of every mapped identity...")
+        face_mapping = {}
+        for identity, source_url in params['face_mapping'].items():
+            face_mapping[int(identity)] = workspace.identity_source_image_path(identity)
+            download_from_google_drive(source_url, face_mapping[int(identity)])
+    else:
+        print("Downloading source image...")
+        download_from_google_drive(params['source_url'], workspace.source_image_path)
+
+    # Swap in-process with the preloaded models
+    print("Performing face swapping...")
+    return face_swapper.swap_faces(workspace.target_video_path, workspace.source_image_path, job.output_path,
+                                   params['detect_interval'], progress_callback=job.update_progress,
+                                   face_mapping=face_mapping)
+
+job_manager = JobManager(process_job, JOBS_DIR)
+
 @app.route('/face_swap', methods=['POST'])
 def face_swap():
     """
-    Endpoint for performing face swapping using provided Google Drive links for the target video and source image.
+    Endpoint to enqueue a face swap job using provided Google Drive links for the target video and source image.
 
     Expects form data with the following fields:
         - target_url (str): Google Drive link to the target video.
         - source_url (str): Google Drive link to the source image.
+        - face_mapping (str, optional): JSON object mapping target identity ids, as listed by
+          /identities, to Google Drive links of their source images; replaces source_url.
+        - detect_interval (int, optional): Run the face detector every N frames and track faces in between.
 
     Returns:
-        JSON response with the status of the face swapping operation and the path to the output file.
+        JSON response with the id of the enqueued job, to be polled at /job_status/<job_id>.
 
     Raises:
-        Exception: If the face swapping process fails.
+        Exception: If the job cannot be enqueued.
     """
     try:
-        # Change to the Roop directory
-        os.chdir(ROOP_DIR)
-
         # Retrieve URLs from the request
         target_url = request.form.get('target_url')  # Google Drive link for the target video
         source_url = request.form.get('source_url')  # Google Drive link for the source image
-        output_path = '/tmp/uploaded_data/outputs/output_face_swap.mp4'  # Default output path
 
-        # Define paths to save the downloaded files
-        target_path = "/tmp/uploaded_data/videos/target_video.mp4"
-        source_path = "/tmp/uploaded_data/images/source_image.jpg"
+        # Optional source image link per target identity
+        face_mapping = None
+        if request.form.get('face_mapping'):
+            try:
+                face_mapping = json.loads(request.form.get('face_mapping'))
+                face_mapping = {str(int(identity)): url for identity, url in face_mapping.items()}
+            except (AttributeError, TypeError, ValueError):
+                return jsonify({'status': 'error', 'message': 'face_mapping must be a JSON object of identity ids to source URLs.'}), 400
 
-        # Ensure directories exist
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
-        os.makedirs(os.path.dirname(source_path), exist_ok=True)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-        # Download the files from Google Drive with progress reporting
-        print("Downloading target video...")
-        download_from_google_drive(target_url, target_path)
-        print("Downloading source image...")
-        download_from_google_drive(source_url, source_path)
+        if not target_url or not (source_url or face_mapping):
+            return jsonify({'status': 'error', 'message': 'Both target URL and source URL are required.'}), 400
 
-        # Prepare and run the face swapping command
-        print("Performing face swapping...")
-        command = f"python run.py --target {target_path} --source {source_path} -o {output_path} --execution-provider cuda --frame-processor face_swapper"
-        
-        # Mock progress bar since subprocess is blocking
-        with tqdm(total=100, desc="Face swapping") as pbar:
-            process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            pbar.update(100)
+        try:
+            detect_interval = int(request.form.get('detect_interval', DETECT_INTERVAL))  # Frames between face detector runs
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'detect_interval must be an integer.'}), 400
 
-        # Check if subprocess ran successfully
-        if process.returncode != 0:
-            raise Exception(f"Face swapping failed: {process.stderr.decode('utf-8')}")
+        job = job_manager.submit({
+            'target_url': target_url,
+            'source_url': source_url,
+            'detect_interval': detect_interval,
+            'face_mapping': face_mapping,
+        })
 
         return jsonify({
             'status': 'success',
-            'message': 'Face swapping completed',
-            'output_path': output_path
-        })
+            'message': 'Face swapping started. Check the status for completion.',
+            'job_id': job.id
+        }), 202
 
     except Exception as e:
         return jsonify({
             'status': 'error',
             'message': str(e)
-        })
+        }), 500
 
-    finally:
-        # Optionally clean up the temporary files after the process
-        if os.path.exists(target_path):
-            os.remove(target_path)
-        if os.path.exists(source_path):
-            os.remove(source_path)
+@app.route('/identities', methods=['POST'])
+def identities():
+    """
+    Endpoint to enqueue listing the identities (distinct faces) of a target video, to build
+    the face_mapping of /face_swap. Clustering runs once per video; later calls are cached.
+
+    Expects form data with the following fields:
+        - target_url (str): Google Drive link to the target video.
+
+    Returns:
+        JSON response with the id of the enqueued job. Once /job_status/<job_id> reports it
+        completed, its stats hold every identity id, its number of sampled faces, and the
+        frame and bounding box where it is first seen.
+    """
+    target_url = request.form.get('target_url')
+    if not target_url:
+        return jsonify({'status': 'error', 'message': 'Target URL is required.'}), 400
+
+    try:
+        # Downloading and clustering a whole video can outlast the request, so it runs as a job
+        job = job_manager.submit({'kind': 'identities', 'target_url': target_url})
+        return jsonify({
+            'status': 'success',
+            'message': 'Listing identities started. Check the status for completion.',
+            'job_id': job.id
+        }), 202
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/job_status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Endpoint to report the progress of a face swap job.
+
+    Returns:
+        JSON response with the job status, frames done / total, fps, ETA, output path and
+        frame statistics, including how often the face detector ran.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict()), 200
 
 @app.route('/get_path_face_swap', methods=['GET'])
 def get_path_face_swap():
     """
     Endpoint to retrieve the path of the output file from the face swap operation.
 
+    Accepts an optional `job_id` query parameter; defaults to the most recent job.
+
     Returns:
         JSON response with the status and the path to the output file, if it exists.
 
@@ -119,15 +198,14 @@ def get_path_face_swap():
         Exception: If there is an error retrieving the file path.
     """
     try:
-        # Path to the output video from the face swap
-        output_path = '/tmp/uploaded_data/outputs/output_face_swap.mp4'
+        job = job_manager.get(request.args.get('job_id'))
 
         # Check if the output file exists
-        if os.path.exists(output_path):
+        if job is not None and job.status == COMPLETED and os.path.exists(job.output_path):
             return jsonify({
                 'status': 'success',
                 'message': 'Output file path retrieved successfully',
-                'output_path': output_path
+                'output_path': job.output_path
             })
         else:
             return jsonify({
@@ -140,6 +218,36 @@ def get_path_face_swap():
             'message': str(e)
         })
 
+@app.route('/get_video_output_face_swap', methods=['GET'])
+def get_video_output_face_swap():
+    """
+    Endpoint to check processing status and get the video output if processing is complete.
+
+    Accepts an optional `job_id` query parameter; defaults to the most recent job.
+
+    Returns:
+        A video file if processing is complete, otherwise the job progress.
+    """
+    job = job_manager.get(request.args.get('job_id'))
+    if job is None:
+        return jsonify({'error': 'No face swap job found.'}), 404
+    if job.status == COMPLETED:
+        return send_file(job.output_path, as_attachment=True, mimetype='video/mp4', download_name='output_face_swap.mp4')
+    if job.status == FAILED:
+        return jsonify(job.to_dict()), 500
+    return jsonify({'message': 'Processing is still in progress. Please wait.', **job.to_dict()}), 202
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Endpoint to report the usage of the source-face cache and of the identity cluster cache.
+
+    Returns:
+        JSON response with the memory and disk hits, misses, hit rate and entry counts.
+    """
+    return jsonify({**face_swapper.engine.face_cache.stats(),
+                    'clusters': face_swapper.engine.cluster_cache.stats()})
+
 # Test route to verify the API is working
 @app.route('/')
 def index():
@@ -1,22 +1,39 @@
-import cv2
-import os
-from rembg import remove
-from tqdm import tqdm
-import numpy as np
 import gdown
 from flask import Flask, request, jsonify, send_file
 from clear_dir import clear_directory
+from pipeline import replace_background, start_worker_pool
+from matting import warm_up_matting
+from options import ProcessingOptions, is_truthy
+from jobs import JobManager, COMPLETED, FAILED
+from result_cache import ResultCache
+from mask_cache import MaskCache
 from model_setup import install_dependencies
 
 app = Flask(__name__)
 
-# Setup environment
-install_dependencies()
+# Shard worker processes re-import this module as __mp_main__ and only need its definitions
+SERVING_PROCESS = __name__ != '__mp_main__'
 
-# Define paths
+if SERVING_PROCESS:
+    # Setup environment
+    install_dependencies()
+
+    # Load the matting model and start the shard workers once so the first request does not pay the load cost
+    warm_up_matting()
+    start_worker_pool()
+
+# Define paths for local runs (frames are only written in debug mode)
 OUTPUT_FRAMES_DIR = '/content/output_frames'
 OUTPUT_VIDEO_PATH = '/content/output_video.mp4'
-PROCESSING_COMPLETE_FLAG = '/content/processing_complete.txt'
+
+# Every API job gets its own workspace under this directory
+JOBS_DIR = '/content/jobs'
+
+# Outputs of previous jobs, reused when the same inputs and parameters are submitted again
+result_cache = ResultCache('/content/cache')
+
+# Per-frame alpha masks of processed videos, so a new background on the same video skips matting
+mask_cache = MaskCache('/content/mask_cache')
 
 
 """
@@ -25,81 +42,24 @@ For Runing model local without API
 
 """
 
-def run_change_background_local(face_swap_output_video, background_image):
-    # Ensure output directory is clean
-    clear_directory([OUTPUT_FRAMES_DIR])
-    os.makedirs(OUTPUT_FRAMES_DIR, exist_ok=True)
+def run_change_background_local(face_swap_output_video, background_image, debug_frames=False, options=None):
     if not face_swap_output_video or not background_image:
         error = 'Both video URL and background URL are required.'
         return error
-    
-    # Step 1: Extract frames from the video
-    cap = cv2.VideoCapture(face_swap_output_video)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # Check if the video was opened successfully
-    if not cap.isOpened():
-        error = {'error': f'Could not open video {face_swap_output_video}'}
-        return error
-    
-    # Step 2: Read new background and resize it to match the video frame dimensions
-    new_background = cv2.imread(background_image)
 
-    if new_background is None:
-        error = {'error': f'Could not load background image {background_image}'}
+    # Only dump frames to disk when explicitly debugging
+    debug_frames_dir = None
+    if debug_frames:
+        clear_directory(OUTPUT_FRAMES_DIR)
+        debug_frames_dir = OUTPUT_FRAMES_DIR
+
+    # Stream frames through background removal straight into the output video
+    try:
+        replace_background(face_swap_output_video, background_image, OUTPUT_VIDEO_PATH, debug_frames_dir=debug_frames_dir,
+                           options=options)
+    except ValueError as e:
+        error = {'error': str(e)}
         return error
-    
-    new_background_resized = cv2.resize(new_background, (frame_width, frame_height))
-
-    # Step 3: Process frames
-    for i in tqdm(range(frame_count), desc="Processing frames"):
-        ret, frame = cap.read()
-        if not ret:
-            break
-        # Remove background using rembg
-        try:
-            result = remove(frame)
-        except Exception as e:
-            print(f"Error removing background from frame {i}: {e}")
-            continue
-
-        # Convert result to RGBA if not already
-        if result.shape[-1] != 4:
-            result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
-
-        # Create a copy of the result to avoid modifying read-only data
-        result_copy = np.copy(result)
-
-        # Overlay the new background using alpha channel
-        alpha_channel = result_copy[:, :, 3] / 255.0
-        for c in range(0, 3):
-            result_copy[:, :, c] = result_copy[:, :, c] * alpha_channel + new_background_resized[:, :, c] * (1 - alpha_channel)
-
-        # Remove alpha channel and save the processed frame
-        frame_output_path = os.path.join(OUTPUT_FRAMES_DIR, f'{i:04d}.png')
-        cv2.imwrite(frame_output_path, result_copy[:, :, :3])
-
-    # Release video capture object
-    cap.release()
-
-    # Step 4: Reassemble frames into a new video
-    frame_files = sorted([f for f in os.listdir(OUTPUT_FRAMES_DIR) if f.endswith('.png')])
-
-    # Initialize VideoWriter
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 'mp4v' for MP4 format
-    video_writer = cv2.VideoWriter(OUTPUT_VIDEO_PATH, fourcc, fps, (frame_width, frame_height))
-
-    # Write frames to video with tqdm progress bar
-    for frame_file in tqdm(frame_files, desc="Reassembling Video"):
-        frame_path = os.path.join(OUTPUT_FRAMES_DIR, frame_file)
-        frame = cv2.imread(frame_path)
-        video_writer.write(frame)
-
-    # Release the video writer object
-    video_writer.release()
 
     return  OUTPUT_VIDEO_PATH
 
@@ -118,13 +78,37 @@ def download_from_google_drive(url, output_path):
     download_url = f"https://drive.google.com/uc?id={file_id}"
     gdown.download(download_url, output_path, quiet=False)
 
-# Endpoint to process video
+# Runs one queued background change job on a job worker thread
+def process_job(job):
+    params = job.params
+    workspace = job.workspace
+    options = ProcessingOptions(**params['options'])
+
+    # Download video and background from Google Drive into the job's own workspace
+    download_from_google_drive(params['video_url'], workspace.input_video_path)
+    download_from_google_drive(params['background_url'], workspace.background_path)
+
+    # Only dump frames to disk when explicitly debugging
+    debug_frames_dir = workspace.frames_dir if params['debug_frames'] else None
+
+    # The same video, background and parameters were rendered before: reuse that output
+    cache_key = result_cache.key(workspace.input_video_path, workspace.background_path, options)
+    if not debug_frames_dir and result_cache.fetch(cache_key, job.output_path):
+        return {'cache_hit': True}
+
+    # Stream frames through background removal straight into the job's output video
+    stats = replace_background(workspace.input_video_path, workspace.background_path, job.output_path,
+                               debug_frames_dir=debug_frames_dir, options=options,
+                               progress_callback=job.update_progress, mask_cache=mask_cache,
+                               checkpoint_dir=workspace.checkpoint_dir)
+    result_cache.store(cache_key, job.output_path)
+    return {**stats, 'cache_hit': False}
+
+job_manager = JobManager(process_job, JOBS_DIR) if SERVING_PROCESS else None
+
+# Endpoint to enqueue a background change job
 @app.route('/change_background', methods=['POST'])
 def process_video():
-    # Ensure output directory is clean
-    clear_directory([OUTPUT_FRAMES_DIR])
-    os.makedirs(OUTPUT_FRAMES_DIR, exist_ok=True)
-
     # Fetch Google Drive URLs from request
     video_url = request.form.get('video_url')
     background_url = request.form.get('background_url')
@@ -132,94 +116,47 @@ def process_video():
     if not video_url or not background_url:
         return jsonify({'error': 'Both video URL and background URL are required.'}), 400
 
-    input_video_path = os.path.join('/content', 'input_video.mp4')
-    new_background_path = os.path.join('/content', 'new_background.jpg')
-
-    # Download video and background from Google Drive
-    download_from_google_drive(video_url, input_video_path)
-    download_from_google_drive(background_url, new_background_path)
-
-    # Step 1: Extract frames from the video
-    cap = cv2.VideoCapture(input_video_path)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-    # Check if the video was opened successfully
-    if not cap.isOpened():
-        return jsonify({'error': f'Could not open video {input_video_path}'}), 400
-
-    # Step 2: Read new background and resize it to match the video frame dimensions
-    new_background = cv2.imread(new_background_path)
-
-    if new_background is None:
-        return jsonify({'error': f'Could not load background image {new_background_path}'}), 400
-
-    new_background_resized = cv2.resize(new_background, (frame_width, frame_height))
-
-    # Step 3: Process frames
-    for i in tqdm(range(frame_count), desc="Processing frames"):
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Remove background using rembg
-        try:
-            result = remove(frame)
-        except Exception as e:
-            print(f"Error removing background from frame {i}: {e}")
-            continue
-
-        # Convert result to RGBA if not already
-        if result.shape[-1] != 4:
-            result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
-
-        # Create a copy of the result to avoid modifying read-only data
-        result_copy = np.copy(result)
-
-        # Overlay the new background using alpha channel
-        alpha_channel = result_copy[:, :, 3] / 255.0
-        for c in range(0, 3):
-            result_copy[:, :, c] = result_copy[:, :, c] * alpha_channel + new_background_resized[:, :, c] * (1 - alpha_channel)
-
-        # Remove alpha channel and save the processed frame
-        frame_output_path = os.path.join(OUTPUT_FRAMES_DIR, f'{i:04d}.png')
-        cv2.imwrite(frame_output_path, result_copy[:, :, :3])
-
-    # Release video capture object
-    cap.release()
-
-    # Step 4: Reassemble frames into a new video
-    frame_files = sorted([f for f in os.listdir(OUTPUT_FRAMES_DIR) if f.endswith('.png')])
-
-    # Initialize VideoWriter
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 'mp4v' for MP4 format
-    video_writer = cv2.VideoWriter(OUTPUT_VIDEO_PATH, fourcc, fps, (frame_width, frame_height))
+    try:
+        options = ProcessingOptions.from_form(request.form)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid processing option: {e}'}), 400
 
-    # Write frames to video with tqdm progress bar
-    for frame_file in tqdm(frame_files, desc="Reassembling Video"):
-        frame_path = os.path.join(OUTPUT_FRAMES_DIR, frame_file)
-        frame = cv2.imread(frame_path)
-        video_writer.write(frame)
+    job = job_manager.submit({
+        'video_url': video_url,
+        'background_url': background_url,
+        'debug_frames': is_truthy(request.form.get('debug_frames')),
+        'options': options.to_dict(),
+    })
 
-    # Release the video writer object
-    video_writer.release()
+    return jsonify({'message': 'Video processing started. Check the status for completion.', 'job_id': job.id}), 202
 
-    # Create a flag file to indicate processing is complete
-    with open(PROCESSING_COMPLETE_FLAG, 'w') as f:
-        f.write('Processing complete')
 
-    return jsonify({'message': 'Video processing started. Check the status for completion.'}), 202
+# Endpoint to report the progress of a job
+@app.route('/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict()), 200
 
 
-# Endpoint to check processing status and get the video
+# Endpoint to check processing status and get the video (latest job unless job_id is given)
 @app.route('/status', methods=['GET'])
 def status():
-    if os.path.exists(PROCESSING_COMPLETE_FLAG):
-        return send_file(OUTPUT_VIDEO_PATH, as_attachment=True, mimetype='video/mp4', download_name='output_video.mp4')
-    else:
-        return jsonify({'message': 'Processing is still in progress. Please wait.'}), 202
+    job = job_manager.get(request.args.get('job_id'))
+    if job is None:
+        return jsonify({'error': 'No background change job found.'}), 404
+    if job.status == COMPLETED:
+        return send_file(job.output_path, as_attachment=True, mimetype='video/mp4', download_name='output_video.mp4')
+    if job.status == FAILED:
+        return jsonify(job.to_dict()), 500
+    return jsonify({'message': 'Processing is still in progress. Please wait.', **job.to_dict()}), 202
+
+
+# Endpoint to report the hit/miss counters and size of the result and mask caches
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'results': result_cache.stats(), 'masks': mask_cache.stats()}), 200
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+import itertools
+import cv2
+import numpy as np
+
+
+def is_video_background(background_path):
+    """
+    Tells whether a background file is a video rather than a still image.
+
+    The file content decides, not its extension, so a downloaded background can be
+    stored under any name.
+    """
+    if cv2.imread(background_path) is not None:
+        return False
+    cap = cv2.VideoCapture(background_path)
+    try:
+        return cap.isOpened() and cap.grab()
+    finally:
+        cap.release()
+
+
+class VideoBackground:
+    """
+    Decodes a background video in lockstep with the foreground video: the n-th call
+    to next_frame() returns background frame n, looping a shorter background and
+    leaving the tail of a longer one unused.
+
+    Frames are resized into a fixed ring of reused buffers, so memory stays flat
+    however long either video is. The ring must be at least as large as the number
+    of background frames in flight at once.
+
+    Args:
+        background_path (str): Path to the background video.
+        frame_width (int): Width of the foreground frames.
+        frame_height (int): Height of the foreground frames.
+        start_frame (int): Index of the foreground frame the first call corresponds to.
+        buffers (int): Number of buffers in the ring.
+
+    Raises:
+        ValueError: If the background video cannot be read.
+    """
+
+    def __init__(self, background_path, frame_width, frame_height, start_frame=0, buffers=1):
+        self.background_path = background_path
+        self.frame_size = (frame_width, frame_height)
+        self._buffers = itertools.cycle([np.empty((frame_height, frame_width, 3), dtype=np.uint8)
+                                         for _ in range(max(1, buffers))])
+        self._cap = cv2.VideoCapture(background_path)
+        if not self._cap.isOpened():
+            raise ValueError(f'Could not open background video {background_path}')
+
+        # Skip to the background frame matching start_frame, modulo the background length
+        frame_count = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        for _ in range(start_frame % frame_count if frame_count > 0 else 0):
+            if not self._cap.grab():
+                self._restart()
+
+    def _restart(self):
+        # Reopen rather than seek to frame 0, which is not frame-exact for every codec
+        self._cap.release()
+        self._cap = cv2.VideoCapture(self.background_path)
+
+    def next_frame(self):
+        """
+        Returns the next background frame, resized to the foreground frame size.
+        """
+        ret, frame = self._cap.read()
+        if not ret:
+            self._restart()
+            ret, frame = self._cap.read()
+            if not ret:
+                raise ValueError(f'Could not read background video {self.background_path}')
+        return cv2.resize(frame, self.frame_size, dst=next(self._buffers))
+
+    def close(self):
+        self._cap.release()
@@ -0,0 +1,60 @@
+import argparse
+import time
+import numpy as np
+from compositing import Compositor
+
+
+"""
+
+Microbenchmark of the float32 Compositor against the previous per-channel
+float64 compositing loop.
+
+    python benchmark_compositing.py --repeats 50
+
+"""
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080)}
+
+
+def composite_loop(frame, alpha, background):
+    """
+    The per-channel float64 loop the background apps used before Compositor.
+    """
+    result = np.copy(frame)
+    alpha_channel = alpha / 255.0
+    for c in range(0, 3):
+        result[:, :, c] = result[:, :, c] * alpha_channel + background[:, :, c] * (1 - alpha_channel)
+    return result
+
+
+def time_call(function, repeats):
+    function()  # Warm-up call
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(repeats):
+    for name, (width, height) in RESOLUTIONS.items():
+        frame = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        alpha = np.random.randint(0, 256, (height, width), dtype=np.uint8)
+        background = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        compositor = Compositor(background, width, height)
+
+        # Both kernels must agree to within one intensity level
+        difference = np.abs(compositor.composite(frame, alpha).astype(np.int16)
+                            - composite_loop(frame, alpha, background).astype(np.int16)).max()
+
+        loop_time = time_call(lambda: composite_loop(frame, alpha, background), repeats)
+        kernel_time = time_call(lambda: compositor.composite(frame, alpha), repeats)
+        print(f"{name:>5s}: loop {loop_time * 1000:7.2f} ms, compositor {kernel_time * 1000:7.2f} ms, "
+              f"speedup {loop_time / kernel_time:5.2f}x, max difference {difference}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark alpha compositing kernels.")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    benchmark(args.repeats)
@@ -0,0 +1,99 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from downscale import DownscaledMattingEngine, mask_iou
+from matting import BatchedMattingEngine, get_session_pool
+
+
+"""
+
+Benchmark of downscaled-inference matting: ms per frame of full-resolution matting
+against downscaled inference at several inference sizes, for 1080p and 4K frames,
+with the time spent shrinking the frames to the model input and the mean mask IoU
+against full-resolution matting (only meaningful on the frames of a real video; random
+frames are pure noise).
+
+    python benchmark_downscale.py --video /srv/videos/example_video.mp4 --inference-sizes 320 512 1024
+
+"""
+
+RESOLUTIONS = {'1080p': (1920, 1080), '4K': (3840, 2160)}
+
+
+def load_frames(video_path, frame_count, width, height):
+    """
+    Reads the first frames of a video scaled to width x height, or generates random
+    frames when no video is given.
+    """
+    if not video_path:
+        return [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(frame_count)]
+
+    frames = []
+    cap = cv2.VideoCapture(video_path)
+    while len(frames) < frame_count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_CUBIC))
+    cap.release()
+    return frames
+
+
+def time_per_frame(engine, frames, repeats):
+    engine.predict_alphas(frames[:engine.batch_size])
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        alphas = engine.predict_alphas(frames)
+        best = min(best, time.perf_counter() - start)
+    return best / len(frames) * 1000, alphas
+
+
+def shrink_time_per_frame(shrink, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        shrink(frame)
+    return (time.perf_counter() - start) / len(frames) * 1000
+
+
+def benchmark(video_path, frame_count, inference_sizes, batch_size, repeats):
+    session_pool = get_session_pool()
+    session_pool.warm_up()
+    full_engine = BatchedMattingEngine(session_pool, batch_size=batch_size)
+    if full_engine.input_spec is None:
+        print(f"Model '{session_pool.model_name}' runs through rembg; shrink times are not reported.")
+    model_size = full_engine.input_spec[0] if full_engine.input_spec else None
+
+    for name, (width, height) in RESOLUTIONS.items():
+        frames = load_frames(video_path, frame_count, width, height)
+        full_ms, full_alphas = time_per_frame(full_engine, frames, repeats)
+        shrink = ""
+        if model_size:
+            shrink_ms = shrink_time_per_frame(lambda f: cv2.resize(f, model_size, interpolation=cv2.INTER_AREA), frames)
+            shrink = f" (shrink {shrink_ms:.2f} ms)"
+        print(f"{name}: full resolution     {full_ms:7.2f} ms/frame{shrink}")
+
+        for inference_size in inference_sizes:
+            engine = DownscaledMattingEngine(BatchedMattingEngine(session_pool, batch_size=batch_size), inference_size)
+            downscaled_ms, alphas = time_per_frame(engine, frames, repeats)
+            shrink = ""
+            if model_size:
+                shrink_ms = shrink_time_per_frame(
+                    lambda f: cv2.resize(engine._downscale(f), model_size, interpolation=cv2.INTER_AREA), frames)
+                shrink = f" (shrink {shrink_ms:.2f} ms)"
+            iou = np.mean([mask_iou(full, alpha) for full, alpha in zip(full_alphas, alphas)])
+            print(f"  inference_size={engine.inference_size:<5d} {downscaled_ms:7.2f} ms/frame{shrink}  "
+                  f"speedup {full_ms / downscaled_ms:5.2f}x  mean IoU {iou:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark downscaled-inference matting.")
+    parser.add_argument('--video', help="Video to read frames from (random frames if omitted).")
+    parser.add_argument('--frames', type=int, default=16, help="Number of frames per run.")
+    parser.add_argument('--inference-sizes', type=int, nargs='+', default=[320, 512, 1024])
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark(args.video, args.frames, args.inference_sizes, args.batch_size, args.repeats)
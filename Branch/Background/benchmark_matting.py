@@ -0,0 +1,63 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from matting import BatchedMattingEngine, get_session_pool
+
+
+"""
+
+Benchmark of batched matting throughput (frames/s) at several batch sizes.
+
+    python benchmark_matting.py --video /srv/videos/example_video.mp4 --frames 64
+
+"""
+
+def load_frames(video_path, frame_count, width, height):
+    """
+    Reads the first frames of a video, or generates random frames when no video is given.
+    """
+    if not video_path:
+        return [np.random.randint(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(frame_count)]
+
+    frames = []
+    cap = cv2.VideoCapture(video_path)
+    while len(frames) < frame_count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def benchmark(frames, batch_sizes, repeats):
+    session_pool = get_session_pool()
+    session_pool.warm_up()
+
+    for batch_size in batch_sizes:
+        engine = BatchedMattingEngine(session_pool, batch_size=batch_size)
+        engine.predict_alphas(frames[:batch_size])  # Warm-up call at this batch size
+
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            engine.predict_alphas(frames)
+            best = min(best, time.perf_counter() - start)
+
+        # A model that does not accept batches runs every batch size one frame at a time
+        print(f"batch_size={batch_size:<3d} {len(frames) / best:8.2f} frames/s"
+              + ('' if engine.batch_size == batch_size else f" (ran with batch_size={engine.batch_size})"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched matting inference.")
+    parser.add_argument('--video', help="Video to read frames from (random frames if omitted).")
+    parser.add_argument('--frames', type=int, default=64, help="Number of frames per run.")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark(load_frames(args.video, args.frames, args.width, args.height), args.batch_sizes, args.repeats)
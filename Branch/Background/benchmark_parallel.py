@@ -0,0 +1,49 @@
+import argparse
+import os
+import tempfile
+import time
+from options import ProcessingOptions
+from pipeline import ShardWorkerPool, probe_video, replace_background, set_worker_pool
+
+
+"""
+
+Benchmark of frame-sharded background replacement: wall time and speedup for
+several worker counts on the same video.
+
+    python benchmark_parallel.py --video /srv/videos/example_video.mp4 --background /srv/backgrounds/example_background.jpg
+
+"""
+
+def benchmark(video_path, background_path, worker_counts, batch_size):
+    _, frame_count, _, _ = probe_video(video_path)
+    output_dir = tempfile.mkdtemp(prefix='benchmark_parallel_')
+
+    baseline = None
+    for workers in worker_counts:
+        # A long-lived pool of this size, started (sessions loaded) outside the timed run
+        worker_pool = ShardWorkerPool(workers) if workers > 1 else None
+        set_worker_pool(worker_pool)
+
+        output_video_path = os.path.join(output_dir, f'output_{workers}.mp4')
+        start = time.perf_counter()
+        replace_background(video_path, background_path, output_video_path,
+                           options=ProcessingOptions(batch_size=batch_size, workers=workers))
+        elapsed = time.perf_counter() - start
+        if worker_pool:
+            worker_pool.shutdown()
+
+        baseline = baseline or elapsed
+        print(f"workers={workers:<3d} {elapsed:8.2f} s  {frame_count / elapsed:7.2f} frames/s  "
+              f"speedup {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark frame-sharded background replacement.")
+    parser.add_argument('--video', required=True)
+    parser.add_argument('--background', required=True)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument('--batch-size', type=int, default=4)
+    args = parser.parse_args()
+
+    benchmark(args.video, args.background, sorted(set(args.workers)), args.batch_size)
@@ -0,0 +1,87 @@
+import os
+import json
+import shutil
+
+# Number of frames per checkpointed segment
+CHECKPOINT_SEGMENT_FRAMES = int(os.getenv('BACKGROUND_CHECKPOINT_FRAMES', '250'))
+
+# Videos shorter than this are rendered in one go: re-rendering them after a restart is
+# cheaper than the segment encoding and concatenation a checkpointed render costs
+CHECKPOINT_MIN_FRAMES = int(os.getenv('BACKGROUND_CHECKPOINT_MIN_FRAMES', str(4 * CHECKPOINT_SEGMENT_FRAMES)))
+
+# Encoder threads used for checkpointed renders when the options leave the count to ffmpeg;
+# x264/x265 output only depends on the thread count, so pinning it makes segments encoded
+# by different processes or machines byte-identical
+CHECKPOINT_ENCODER_THREADS = int(os.getenv('BACKGROUND_CHECKPOINT_ENCODER_THREADS', '4'))
+
+_MANIFEST_NAME = 'manifest.json'
+
+
+class CheckpointManifest:
+    """
+    Progress of a checkpointed render: the video is rendered as fixed-size segments,
+    and every finished segment is recorded in a manifest next to the segment files.
+
+    The manifest is rewritten atomically after every segment, so it always describes
+    segments that are complete on disk. A manifest whose fingerprint (input hashes
+    and processing parameters) differs from the current render is discarded together
+    with its segments.
+
+    Args:
+        checkpoint_dir (str): Directory holding the manifest and the segment files.
+        fingerprint (dict): JSON-serializable description of the inputs and parameters.
+    """
+
+    def __init__(self, checkpoint_dir, fingerprint):
+        self.checkpoint_dir = checkpoint_dir
+        self.fingerprint = json.loads(json.dumps(fingerprint))
+        self.segments = {}
+
+        manifest_path = os.path.join(checkpoint_dir, _MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('fingerprint') == self.fingerprint:
+                self.segments = {int(index): entry for index, entry in manifest['segments'].items()}
+            else:
+                print(f"Discarding checkpoint in {checkpoint_dir}: inputs or parameters changed.")
+
+        if not self.segments:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def segment_path(self, index):
+        return os.path.join(self.checkpoint_dir, f'segment_{index:05d}.mp4')
+
+    @property
+    def last_finished_frame(self):
+        """
+        Index of the last frame of the unbroken run of finished segments from the
+        start of the video, or -1 if the first segment is not finished.
+        """
+        frame, index = -1, 0
+        while index in self.segments:
+            entry = self.segments[index]
+            frame = entry['start_frame'] + entry['stats']['frames_written'] - 1
+            index += 1
+        return frame
+
+    def mark_done(self, index, start_frame, stats):
+        """
+        Records a finished segment and persists the manifest.
+        """
+        self.segments[index] = {'start_frame': start_frame, 'stats': stats}
+        manifest = {
+            'fingerprint': self.fingerprint,
+            'last_finished_frame': self.last_finished_frame,
+            'segments': {str(index): entry for index, entry in sorted(self.segments.items())},
+        }
+        temp_path = os.path.join(self.checkpoint_dir, _MANIFEST_NAME + '.tmp')
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_path, os.path.join(self.checkpoint_dir, _MANIFEST_NAME))
+
+    def remove(self):
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
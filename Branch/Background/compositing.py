@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+
+
+class Compositor:
+    """
+    Blends foreground frames over a background with float32 per-pixel weights.
+
+    A still background is resized once and every intermediate buffer is allocated up
+    front, so compositing a frame does not allocate any new arrays. For video
+    backgrounds, the matching background frame is passed with every call instead.
+
+    Args:
+        background (numpy.ndarray): BGR background image of any size, or None when every
+            call provides its own background frame.
+        frame_width (int): Width of the frames to composite.
+        frame_height (int): Height of the frames to composite.
+    """
+
+    def __init__(self, background, frame_width, frame_height):
+        self.background = cv2.resize(background, (frame_width, frame_height)) if background is not None else None
+        self._foreground_weight = np.empty((frame_height, frame_width), dtype=np.float32)
+        self._background_weight = np.empty((frame_height, frame_width), dtype=np.float32)
+        self._output = np.empty((frame_height, frame_width, 3), dtype=np.uint8)
+
+    def composite(self, frame, alpha, out=None, background=None):
+        """
+        Composites a frame over the background: out = frame * a + background * (1 - a).
+
+        Args:
+            frame (numpy.ndarray): BGR uint8 frame.
+            alpha (numpy.ndarray): uint8 foreground mask of shape (H, W).
+            out (numpy.ndarray, optional): uint8 buffer of shape (H, W, 3) to write into.
+                Defaults to a buffer owned by the compositor, overwritten on every call.
+            background (numpy.ndarray, optional): BGR background frame of the frame's size,
+                used instead of the still background.
+
+        Returns:
+            numpy.ndarray: The composited BGR frame (`out`).
+        """
+        if out is None:
+            out = self._output
+        if background is None:
+            background = self.background
+
+        # float32 weights from the alpha mask, computed in place
+        np.multiply(alpha, np.float32(1 / 255), out=self._foreground_weight)
+        np.subtract(np.float32(1), self._foreground_weight, out=self._background_weight)
+
+        # One fused, rounded blend of all three channels straight into the output buffer
+        cv2.blendLinear(frame, background, self._foreground_weight, self._background_weight, dst=out)
+        return out
@@ -0,0 +1,127 @@
+import cv2
+import numpy as np
+
+# Guided filter parameters used for edge-aware refinement (radius in low-resolution pixels)
+GUIDED_FILTER_RADIUS = 4
+GUIDED_FILTER_EPS = 1e-3
+
+
+def mask_iou(mask_a, mask_b, threshold=128):
+    """
+    Intersection over union of two alpha masks binarised at `threshold`.
+
+    Args:
+        mask_a (numpy.ndarray): uint8 alpha mask.
+        mask_b (numpy.ndarray): uint8 alpha mask of the same shape.
+        threshold (int): Alpha value from which a pixel counts as foreground.
+
+    Returns:
+        float: IoU in [0, 1]; 1.0 when both masks are empty.
+    """
+    foreground_a = mask_a >= threshold
+    foreground_b = mask_b >= threshold
+    union = np.count_nonzero(foreground_a | foreground_b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(foreground_a & foreground_b) / union
+
+
+def refine_alpha(frame, small_frame, small_alpha, radius=GUIDED_FILTER_RADIUS, eps=GUIDED_FILTER_EPS):
+    """
+    Upsamples a low-resolution alpha mask with a fast guided filter, so mask edges snap
+    to the edges of the full-resolution frame.
+
+    The filter coefficients are solved at low resolution and only the final linear
+    model is evaluated at full resolution.
+
+    Args:
+        frame (numpy.ndarray): Full-resolution BGR frame used as the guide.
+        small_frame (numpy.ndarray): The downscaled frame the mask was predicted on.
+        small_alpha (numpy.ndarray): uint8 alpha mask of `small_frame`.
+
+    Returns:
+        numpy.ndarray: uint8 alpha mask at the full frame resolution.
+    """
+    kernel = (2 * radius + 1, 2 * radius + 1)
+    guide = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255
+    alpha = small_alpha.astype(np.float32) / 255
+
+    mean_guide = cv2.boxFilter(guide, -1, kernel)
+    mean_alpha = cv2.boxFilter(alpha, -1, kernel)
+    covariance = cv2.boxFilter(guide * alpha, -1, kernel) - mean_guide * mean_alpha
+    variance = cv2.boxFilter(guide * guide, -1, kernel) - mean_guide * mean_guide
+
+    a = covariance / (variance + eps)
+    b = mean_alpha - a * mean_guide
+
+    size = (frame.shape[1], frame.shape[0])
+    full_guide = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255
+    refined = cv2.resize(cv2.boxFilter(a, -1, kernel), size) * full_guide + cv2.resize(cv2.boxFilter(b, -1, kernel), size)
+    return (refined.clip(0, 1) * 255).astype(np.uint8)
+
+
+class DownscaledMattingEngine:
+    """
+    Wraps a matting engine so inference runs on downscaled copies of the frames; the
+    predicted masks are upsampled, optionally with edge-aware refinement, and the
+    compositing still happens at full resolution.
+
+    The matting models run at a fixed input size (320x320 for u2net, 1024x1024 for
+    isnet) whatever the frame resolution, so downscaling does not make inference itself
+    cheaper. What grows with the pixel count is shrinking every full-resolution frame to
+    the model input with an area filter (about 10 ms at 1080p and 35 ms at 4K per frame).
+    The downscaled copy is made with a bilinear resize instead (under 1 ms), and the
+    engine's area filter then only shrinks the small copy. The copy is never smaller
+    than the model input, which would lose detail for no gain.
+
+    Args:
+        engine (BatchedMattingEngine): Engine used on the downscaled frames.
+        inference_size (int): Length of the long side of the downscaled frames.
+        refine_edges (bool): Upsample masks with a guided filter instead of bilinear interpolation.
+    """
+
+    def __init__(self, engine, inference_size, refine_edges=False):
+        self.engine = engine
+        self.batch_size = engine.batch_size
+        input_spec = getattr(engine, 'input_spec', None)
+        self.inference_size = max(inference_size, max(input_spec[0])) if input_spec else inference_size
+        self.refine_edges = refine_edges
+
+    @property
+    def inferences(self):
+        return self.engine.inferences
+
+    @property
+    def skipped_inferences(self):
+        return self.engine.skipped_inferences
+
+    def _downscale(self, frame):
+        height, width = frame.shape[:2]
+        scale = self.inference_size / max(height, width)
+        if scale >= 1:
+            return frame
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+
+    def predict_alphas(self, frames):
+        """
+        Predicts the full-resolution alpha mask of every frame from downscaled inference.
+
+        Args:
+            frames (list): BGR frames (numpy.ndarray).
+
+        Returns:
+            list: One uint8 alpha mask per frame, at the frame's resolution.
+        """
+        small_frames = [self._downscale(frame) for frame in frames]
+        small_alphas = self.engine.predict_alphas(small_frames)
+
+        alphas = []
+        for frame, small_frame, small_alpha in zip(frames, small_frames, small_alphas):
+            if small_frame is frame:
+                alphas.append(small_alpha)
+            elif self.refine_edges:
+                alphas.append(refine_alpha(frame, small_frame, small_alpha))
+            else:
+                alphas.append(cv2.resize(small_alpha, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR))
+        return alphas
@@ -0,0 +1,148 @@
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from fractions import Fraction
+import cv2
+
+# Default output encoding: 'ffmpeg' pipes frames into an ffmpeg subprocess, 'opencv' uses cv2.VideoWriter
+DEFAULT_ENCODER = os.getenv('BACKGROUND_ENCODER', 'ffmpeg')
+DEFAULT_VIDEO_CODEC = os.getenv('BACKGROUND_VIDEO_CODEC', 'libx264')
+DEFAULT_PRESET = os.getenv('BACKGROUND_ENCODER_PRESET', 'veryfast')
+DEFAULT_CRF = int(os.getenv('BACKGROUND_ENCODER_CRF', '23'))
+DEFAULT_ENCODER_THREADS = int(os.getenv('BACKGROUND_ENCODER_THREADS', '0'))
+
+ENCODERS = ('ffmpeg', 'opencv')
+VIDEO_CODECS = ('libx264', 'libx265')
+
+# Number of frames buffered between the caller and the encoder thread
+ENCODER_QUEUE_SIZE = 8
+
+
+class FFmpegVideoWriter:
+    """
+    Encodes frames with libx264/libx265 by piping raw BGR frames into an ffmpeg subprocess.
+
+    Frames are handed to a background thread, so encoding overlaps with the work of the
+    caller; when `audio_source` is given its audio track is muxed into the output.
+    Has the same write()/release() interface as cv2.VideoWriter.
+
+    Args:
+        output_video_path (str): Path of the encoded video.
+        fps (float): Frame rate of the output.
+        frame_size (tuple): (width, height) of the frames.
+        codec (str): 'libx264' or 'libx265'.
+        preset (str): Encoder preset, e.g. 'veryfast' or 'medium'.
+        crf (int): Constant rate factor; lower is higher quality.
+        audio_source (str, optional): Video whose audio track is copied into the output.
+        threads (int): Encoder threads; 0 lets ffmpeg decide. The output is byte-identical
+            across runs for a given thread count.
+    """
+
+    def __init__(self, output_video_path, fps, frame_size, codec=DEFAULT_VIDEO_CODEC, preset=DEFAULT_PRESET,
+                 crf=DEFAULT_CRF, audio_source=None, threads=DEFAULT_ENCODER_THREADS):
+        width, height = frame_size
+        frame_rate = Fraction(fps).limit_denominator(1001) if fps else Fraction(25)
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+            "-framerate", f"{frame_rate.numerator}/{frame_rate.denominator}", "-i", "-",
+        ]
+        if audio_source:
+            command += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0?", "-c:a", "aac"]
+        command += [
+            # yuv420p needs even dimensions
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v", codec, "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p",
+            # Keep version strings and timestamps out of the file so identical input gives identical bytes
+            "-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact", "-map_metadata", "-1",
+        ]
+        if threads:
+            command += ["-threads", str(threads)]
+        if codec == 'libx265':
+            command += ["-tag:v", "hvc1"]
+        command += ["-movflags", "+faststart", output_video_path]
+
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self._stderr)
+        self._queue = queue.Queue(maxsize=ENCODER_QUEUE_SIZE)
+        self._error = None
+        self._thread = threading.Thread(target=self._encode, name='ffmpeg-encoder', daemon=True)
+        self._thread.start()
+
+    def _encode(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error:
+                continue
+            try:
+                self._process.stdin.write(data)
+            except (BrokenPipeError, OSError) as e:
+                self._error = e
+
+    def write(self, frame):
+        """
+        Queues a frame for encoding. The frame is copied, so the caller may reuse its buffer.
+
+        Raises:
+            RuntimeError: If ffmpeg has already failed.
+        """
+        if self._error:
+            raise RuntimeError(f'ffmpeg encoder failed: {self._error}')
+        self._queue.put(frame.tobytes())
+
+    def release(self):
+        """
+        Flushes the queued frames and waits for ffmpeg to finish the file.
+
+        Raises:
+            RuntimeError: If ffmpeg exits with an error.
+        """
+        if self._process is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        returncode = self._process.wait()
+        self._process = None
+
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode(errors='replace').strip()
+        self._stderr.close()
+        if returncode != 0:
+            raise RuntimeError(f'ffmpeg exited with code {returncode}: {stderr}')
+
+
+def open_video_writer(output_video_path, fps, frame_size, options, audio_source=None):
+    """
+    Opens the output encoder selected by the processing options.
+
+    Falls back to OpenCV's 'mp4v' writer, which drops the audio, when the OpenCV
+    encoder is requested or ffmpeg is not installed.
+
+    Args:
+        output_video_path (str): Path of the encoded video.
+        fps (float): Frame rate of the output.
+        frame_size (tuple): (width, height) of the frames.
+        options (ProcessingOptions): Provides encoder, codec, preset, crf and encoder_threads.
+        audio_source (str, optional): Video whose audio track is muxed into the output.
+
+    Returns:
+        FFmpegVideoWriter or cv2.VideoWriter: A writer with write(frame) and release().
+    """
+    if options.encoder == 'ffmpeg':
+        if shutil.which('ffmpeg'):
+            return FFmpegVideoWriter(output_video_path, fps, frame_size, codec=options.codec,
+                                     preset=options.preset, crf=options.crf, audio_source=audio_source,
+                                     threads=options.encoder_threads)
+        print("ffmpeg not found, falling back to the OpenCV encoder.")
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 'mp4v' for MP4 format
+    return cv2.VideoWriter(output_video_path, fourcc, fps, frame_size)
@@ -0,0 +1,23 @@
+import os
+import sys
+# The job queue is shared with the other apps
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Common')))
+import job_queue
+from job_queue import Job, QUEUED, RUNNING, COMPLETED, FAILED
+from workspace import JobWorkspace
+
+# Number of background threads processing queued jobs
+JOB_WORKERS = int(os.getenv('BACKGROUND_JOB_WORKERS', '1'))
+
+# How long a finished job's workspace (and output) is kept before it is deleted
+JOB_RETENTION_SECONDS = int(os.getenv('BACKGROUND_JOB_RETENTION_SECONDS', str(24 * 3600)))
+
+
+class JobManager(job_queue.JobManager):
+    """
+    Job queue of background-replacement requests, see job_queue.JobManager.
+    """
+
+    def __init__(self, handler, workspace_root, workers=JOB_WORKERS, retention_seconds=JOB_RETENTION_SECONDS):
+        super().__init__(handler, workspace_root, JobWorkspace, workers=workers,
+                         retention_seconds=retention_seconds, name='background')
@@ -0,0 +1,312 @@
+import os
+import glob
+import json
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+import zlib
+import numpy as np
+from matting import MATTING_MODEL
+from result_cache import file_digest
+
+# Upper bound of the disk space used by cached alpha masks
+MASK_CACHE_MAX_BYTES = int(os.getenv('BACKGROUND_MASK_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+
+# zlib level used for the masks; mostly flat masks compress well even at the fastest level
+MASK_COMPRESSION_LEVEL = 1
+
+# Footer of a mask file: magic, index offset, first frame, frame count, width, height
+_FOOTER = struct.Struct('<8sQIIII')
+_MAGIC = b'VLMASK01'
+
+# Name of the marker written once every part of a cache entry is complete
+_COMPLETE_MARKER = 'complete.json'
+
+
+class MaskWriter:
+    """
+    Writes the alpha masks of consecutive frames to a compact mask file.
+
+    Every mask is stored as a zlib-compressed uint8 record; an offset index and a
+    footer are appended on close, so a reader can seek to any frame of the file.
+
+    Args:
+        path (str): Path of the mask file.
+        width (int): Width of the masks.
+        height (int): Height of the masks.
+        start_frame (int): Index, in the video, of the first mask written.
+    """
+
+    def __init__(self, path, width, height, start_frame=0):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.start_frame = start_frame
+        self._offsets = [0]
+        self._file = open(path, 'wb')
+
+    def write(self, alpha):
+        record = zlib.compress(np.ascontiguousarray(alpha, dtype=np.uint8).tobytes(), MASK_COMPRESSION_LEVEL)
+        self._file.write(record)
+        self._offsets.append(self._offsets[-1] + len(record))
+
+    def close(self):
+        if self._file.closed:
+            return
+        index_offset = self._offsets[-1]
+        self._file.write(np.asarray(self._offsets, dtype=np.uint64).tobytes())
+        self._file.write(_FOOTER.pack(_MAGIC, index_offset, self.start_frame, len(self._offsets) - 1,
+                                      self.width, self.height))
+        self._file.close()
+
+
+class MaskReader:
+    """
+    Reads the masks of consecutive frames, starting at `start_frame`, from the mask
+    files of a cache entry.
+
+    Args:
+        entry_dir (str): Directory holding the mask files of one video.
+        start_frame (int): Index of the first frame to read.
+
+    Raises:
+        ValueError: If a mask file is corrupt.
+    """
+
+    def __init__(self, entry_dir, start_frame=0):
+        self._parts = []
+        for path in sorted(glob.glob(os.path.join(entry_dir, 'part_*.masks'))):
+            with open(path, 'rb') as file:
+                file.seek(-_FOOTER.size, os.SEEK_END)
+                magic, index_offset, first_frame, frame_count, width, height = _FOOTER.unpack(file.read(_FOOTER.size))
+                if magic != _MAGIC:
+                    raise ValueError(f'Corrupt mask file {path}')
+                file.seek(index_offset)
+                offsets = np.frombuffer(file.read(8 * (frame_count + 1)), dtype=np.uint64)
+            self._parts.append((first_frame, frame_count, width, height, offsets, path))
+        self._next_frame = start_frame
+        self._file = None
+        self._part = None
+
+    def _open_part(self, frame_index):
+        for part in self._parts:
+            first_frame, frame_count = part[0], part[1]
+            if first_frame <= frame_index < first_frame + frame_count:
+                if self._part is not part:
+                    self.close()
+                    self._file = open(part[5], 'rb')
+                    self._part = part
+                return part
+        raise ValueError(f'No cached mask for frame {frame_index}')
+
+    def read(self):
+        """
+        Returns the mask of the next frame.
+        """
+        first_frame, _, width, height, offsets, _ = self._open_part(self._next_frame)
+        position = self._next_frame - first_frame
+        self._file.seek(int(offsets[position]))
+        record = self._file.read(int(offsets[position + 1] - offsets[position]))
+        self._next_frame += 1
+        return np.frombuffer(zlib.decompress(record), dtype=np.uint8).reshape(height, width)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._part = None
+
+
+class CachedMaskEngine:
+    """
+    Stands in for a matting engine and returns the cached masks of the frames, in
+    order, so rendering a new background is pure compositing.
+
+    Args:
+        entry_dir (str): Cache entry of the video.
+        start_frame (int): Index of the first frame that will be requested.
+        batch_size (int): Number of frames per batch.
+    """
+
+    def __init__(self, entry_dir, start_frame, batch_size):
+        self.batch_size = batch_size
+        self.inferences = 0
+        self.skipped_inferences = 0
+        self._reader = MaskReader(entry_dir, start_frame)
+
+    def predict_alphas(self, frames):
+        return [self._reader.read() for _ in frames]
+
+    def close(self):
+        self._reader.close()
+
+
+class RecordingMattingEngine:
+    """
+    Wraps a matting engine and writes every predicted mask to a mask file.
+
+    If a batch fails, recording stops and `complete` turns False, so a partial
+    set of masks is never committed to the cache.
+
+    Args:
+        engine: Matting engine whose masks are recorded.
+        writer (MaskWriter): Destination of the masks.
+    """
+
+    def __init__(self, engine, writer):
+        self.engine = engine
+        self.batch_size = engine.batch_size
+        self.writer = writer
+        self.complete = True
+
+    @property
+    def inferences(self):
+        return self.engine.inferences
+
+    @property
+    def skipped_inferences(self):
+        return self.engine.skipped_inferences
+
+    def predict_alphas(self, frames):
+        try:
+            alphas = self.engine.predict_alphas(frames)
+        except Exception:
+            self.complete = False
+            raise
+        if self.complete:
+            for alpha in alphas:
+                self.writer.write(alpha)
+        return alphas
+
+    def close(self):
+        self.writer.close()
+
+
+class MaskCache:
+    """
+    Disk-backed cache of the per-frame alpha masks of processed videos, keyed by the
+    content hash of the video and the matting parameters. A later request for the
+    same video with another background reuses the masks instead of re-matting.
+
+    Each entry is a directory of mask files, one per processed frame range; entries
+    are evicted least-recently-used first once the cache grows past `max_bytes`. An
+    entry returned by lookup() is pinned, and never evicted, until it is released.
+
+    Args:
+        cache_dir (str): Directory holding the cache entries.
+        max_bytes (int): Maximum total size of the cached masks.
+    """
+
+    def __init__(self, cache_dir, max_bytes=MASK_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pins = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_video_path, options):
+        """
+        Builds the cache key of the masks of a video from its content and the
+        parameters that affect the masks.
+        """
+        # Batched inference is not bit-identical to inference on one frame, so the batch size is part of the key
+        params = {'model': MATTING_MODEL, 'batch_size': options.batch_size, 'inference_size': options.inference_size,
+                  'refine_edges': options.refine_edges, 'temporal': options.temporal}
+        if options.temporal:
+            params.update(keyframe_interval=options.keyframe_interval, diff_threshold=options.diff_threshold)
+        digest = hashlib.sha256()
+        digest.update(file_digest(input_video_path).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """
+        Returns the entry directory of `key` if its masks are complete, else None. The
+        entry stays pinned until release() is called with it.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if not os.path.exists(os.path.join(entry_dir, _COMPLETE_MARKER)):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pins[entry_dir] = self._pins.get(entry_dir, 0) + 1
+            os.utime(entry_dir)
+            return entry_dir
+
+    def release(self, entry_dir):
+        """
+        Unpins an entry returned by lookup(), once its masks are no longer read.
+        """
+        with self._lock:
+            self._pins[entry_dir] -= 1
+            if not self._pins[entry_dir]:
+                del self._pins[entry_dir]
+
+    def begin(self):
+        """
+        Returns a fresh directory the masks of a new entry are recorded into.
+        """
+        return tempfile.mkdtemp(prefix='recording_', dir=self.cache_dir)
+
+    def commit(self, key, recording_dir, frame_count):
+        """
+        Publishes the masks recorded in `recording_dir` under `key`, then evicts the
+        least recently used entries until the cache fits in `max_bytes`.
+        """
+        with open(os.path.join(recording_dir, _COMPLETE_MARKER), 'w') as marker:
+            json.dump({'frame_count': frame_count}, marker)
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if os.path.exists(entry_dir):
+                # Another job recorded the same masks first
+                shutil.rmtree(recording_dir, ignore_errors=True)
+            else:
+                os.replace(recording_dir, entry_dir)
+            self._evict()
+
+    def discard(self, recording_dir):
+        shutil.rmtree(recording_dir, ignore_errors=True)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('recording_') or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(entry_dir, '*')))
+            entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            # Masks still read by a running job are kept
+            if entry_dir in self._pins:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            entries = self._entries()
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'entries': len(entries),
+                'size_bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,219 @@
+import os
+import sys
+import queue
+import threading
+from contextlib import contextmanager
+import cv2
+import numpy as np
+import onnx
+import onnxruntime as ort
+from rembg import new_session, remove
+# The ONNX batching helpers are shared with the other apps
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Common')))
+from onnx_batching import make_batch_dynamic, accepts_batches
+
+# Matting model and ONNX Runtime settings, configurable through the environment
+MATTING_MODEL = os.getenv('MATTING_MODEL', 'u2net')
+MATTING_POOL_SIZE = int(os.getenv('MATTING_POOL_SIZE', '1'))
+ORT_INTRA_OP_THREADS = int(os.getenv('ORT_INTRA_OP_THREADS', '0'))  # 0 lets ONNX Runtime decide
+ORT_INTER_OP_THREADS = int(os.getenv('ORT_INTER_OP_THREADS', '0'))
+MATTING_BATCH_SIZE = int(os.getenv('MATTING_BATCH_SIZE', '4'))
+
+# Input size and normalisation of the rembg models the batched engine can drive directly
+MODEL_INPUT_SPECS = {
+    'u2net': ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'u2netp': ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'u2net_human_seg': ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'silueta': ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'isnet-general-use': ((1024, 1024), (0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+}
+
+
+class MattingSessionPool:
+    """
+    A fixed-size pool of preloaded rembg sessions shared by every frame of every request.
+
+    rembg ships some models with a fixed batch dimension of 1; for the models listed in
+    MODEL_INPUT_SPECS the batch dimension is made dynamic when the session is created.
+    If the graph still does not accept a batch larger than one, `accepts_batches` is
+    False and frames are matted one at a time.
+
+    Args:
+        model_name (str): Name of the rembg model to load.
+        size (int): Number of sessions to keep loaded (one per concurrent caller).
+        intra_op_threads (int): ONNX Runtime intra-op thread count, 0 for the default.
+        inter_op_threads (int): ONNX Runtime inter-op thread count, 0 for the default.
+    """
+
+    def __init__(self, model_name=MATTING_MODEL, size=MATTING_POOL_SIZE,
+                 intra_op_threads=ORT_INTRA_OP_THREADS, inter_op_threads=ORT_INTER_OP_THREADS):
+        self.model_name = model_name
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self._sessions = [self._create_session() for _ in range(max(1, size))]
+        self._available = queue.Queue()
+        for session in self._sessions:
+            self._available.put(session)
+        self.accepts_batches = self.model_name in MODEL_INPUT_SPECS and self._accepts_batches()
+        if self.model_name in MODEL_INPUT_SPECS and not self.accepts_batches:
+            print(f"Warning: matting model '{self.model_name}' does not accept batched inputs, "
+                  f"matting frames one at a time.")
+
+    def _create_session(self):
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = self.inter_op_threads
+        session = new_session(self.model_name, sess_opts=sess_opts)
+
+        inner_session = session.inner_session
+        if self.model_name in MODEL_INPUT_SPECS and isinstance(inner_session.get_inputs()[0].shape[0], int):
+            model = make_batch_dynamic(onnx.load(str(type(session).download_models())))
+            session.inner_session = ort.InferenceSession(model.SerializeToString(), sess_options=sess_opts,
+                                                         providers=inner_session.get_providers())
+        return session
+
+    def _accepts_batches(self):
+        (input_width, input_height), _, _ = MODEL_INPUT_SPECS[self.model_name]
+        inner_session = self._sessions[0].inner_session
+        return accepts_batches(inner_session, {inner_session.get_inputs()[0].name: (3, input_height, input_width)})
+
+    @contextmanager
+    def session(self):
+        """
+        Borrows a session from the pool for the duration of the `with` block.
+        """
+        session = self._available.get()
+        try:
+            yield session
+        finally:
+            self._available.put(session)
+
+    def remove(self, frame):
+        """
+        Removes the background of a single frame with a pooled session.
+
+        Args:
+            frame (numpy.ndarray): BGR frame.
+
+        Returns:
+            numpy.ndarray: BGRA frame whose alpha channel is the foreground mask.
+        """
+        with self.session() as session:
+            return remove(frame, session=session)
+
+    def warm_up(self):
+        """
+        Runs one dummy inference on every session so the first request does not pay
+        the model initialisation cost.
+        """
+        dummy_frame = np.zeros((64, 64, 3), dtype=np.uint8)
+        for session in self._sessions:
+            remove(dummy_frame, session=session)
+        print(f"Matting model '{self.model_name}' loaded with {len(self._sessions)} session(s).")
+
+
+class BatchedMattingEngine:
+    """
+    Runs the matting model over several frames with one inference call per batch
+    and returns one alpha mask per frame.
+
+    Models listed in MODEL_INPUT_SPECS are driven directly through the session's
+    ONNX Runtime graph with a stacked (N, 3, H, W) tensor; any other model falls
+    back to one rembg call per frame. If the pool's graph does not accept batches,
+    the batch size is 1.
+
+    Args:
+        session_pool (MattingSessionPool): Pool providing the loaded sessions.
+        batch_size (int): Maximum number of frames per inference call.
+    """
+
+    def __init__(self, session_pool, batch_size=MATTING_BATCH_SIZE):
+        self.session_pool = session_pool
+        self.batch_size = max(1, int(batch_size)) if session_pool.accepts_batches else 1
+        self.input_spec = MODEL_INPUT_SPECS.get(session_pool.model_name)
+        self.inferences = 0
+        self.skipped_inferences = 0
+
+    def _preprocess(self, frames):
+        (input_width, input_height), mean, std = self.input_spec
+        batch = np.empty((len(frames), input_height, input_width, 3), dtype=np.float32)
+        for i, frame in enumerate(frames):
+            # Resize first, then flip BGR to the RGB order the models were trained on
+            resized = cv2.resize(frame, (input_width, input_height), interpolation=cv2.INTER_AREA)
+            batch[i] = resized[:, :, ::-1]
+
+        # Same normalisation as rembg: scale by the per-image maximum, then mean/std
+        batch /= np.maximum(batch.max(axis=(1, 2, 3), keepdims=True), 1e-6)
+        batch -= np.array(mean, dtype=np.float32)
+        batch /= np.array(std, dtype=np.float32)
+        return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+    def _run(self, session, tensor):
+        inner_session = session.inner_session
+        return inner_session.run(None, {inner_session.get_inputs()[0].name: tensor})[0]
+
+    def _infer_batch(self, frames):
+        if self.input_spec is None:
+            with self.session_pool.session() as session:
+                return [remove(frame, session=session, only_mask=True) for frame in frames]
+
+        tensor = self._preprocess(frames)
+        with self.session_pool.session() as session:
+            predictions = self._run(session, tensor)[:, 0, :, :]
+
+        # Min-max normalise every prediction and scale it back to its frame size
+        alphas = []
+        for frame, prediction in zip(frames, predictions):
+            low, high = prediction.min(), prediction.max()
+            prediction = (prediction - low) / max(high - low, 1e-6)
+            alpha = (prediction.clip(0, 1) * 255).astype(np.uint8)
+            alphas.append(cv2.resize(alpha, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR))
+        return alphas
+
+    def predict_alphas(self, frames):
+        """
+        Predicts the foreground alpha mask of every frame.
+
+        Args:
+            frames (list): BGR frames (numpy.ndarray), all of the same size.
+
+        Returns:
+            list: One uint8 alpha mask (numpy.ndarray of shape (H, W)) per frame.
+        """
+        alphas = []
+        for start in range(0, len(frames), self.batch_size):
+            alphas.extend(self._infer_batch(frames[start:start + self.batch_size]))
+        self.inferences += len(frames)
+        return alphas
+
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """
+    Returns the process-wide matting session pool, creating it on first use.
+    """
+    global _session_pool
+    if _session_pool is None:
+        with _session_pool_lock:
+            if _session_pool is None:
+                _session_pool = MattingSessionPool()
+    return _session_pool
+
+
+def set_session_pool(session_pool):
+    """
+    Replaces the process-wide matting session pool, e.g. with a per-worker pool.
+    """
+    global _session_pool
+    with _session_pool_lock:
+        _session_pool = session_pool
+
+
+def warm_up_matting():
+    """
+    Loads and warms up the process-wide matting session pool. Call at process start.
+    """
+    get_session_pool().warm_up()
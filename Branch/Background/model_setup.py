@@ -11,6 +11,7 @@ def install_dependencies():
     subprocess.run(["pip", "install", "ffmpeg-python"], check=True)
     subprocess.run(["pip", "install", "tqdm"], check=True)
     subprocess.run(["pip", "install", "rembg"], check=True)
+    subprocess.run(["pip", "install", "onnx"], check=True)
     subprocess.run(["pip", "install", "flask"], check=True)  
     subprocess.run(["pip", "install", "flask-ngrok"], check=True)
     subprocess.run(["pip", "install", "pyngrok"], check=True)
@@ -0,0 +1,90 @@
+import os
+from encoders import (DEFAULT_CRF, DEFAULT_ENCODER, DEFAULT_ENCODER_THREADS, DEFAULT_PRESET, DEFAULT_VIDEO_CODEC,
+                      ENCODERS, VIDEO_CODECS)
+from matting import MATTING_BATCH_SIZE
+
+# Defaults of the tunable background-replacement parameters
+DEFAULT_WORKERS = int(os.getenv('BACKGROUND_WORKERS', str(min(4, os.cpu_count() or 1))))
+DEFAULT_KEYFRAME_INTERVAL = 12
+DEFAULT_DIFF_THRESHOLD = 3.0
+
+
+def is_truthy(value):
+    """
+    Parses a boolean form field ("1", "true", "yes" or "on").
+    """
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+class ProcessingOptions:
+    """
+    Tunable parameters of a background-replacement run.
+
+    Args:
+        batch_size (int): Number of frames matted per inference call.
+        workers (int): Number of processes the video is split across by frame range. The
+            processes come from the server's shard worker pool (BACKGROUND_WORKERS), so a
+            larger count is capped to the pool size rather than starting more processes.
+        temporal (bool): Only run matting on keyframes and reuse the last mask in between.
+        keyframe_interval (int): In temporal mode, maximum number of frames between two keyframes.
+        diff_threshold (float): In temporal mode, mean absolute difference (0-255) from the last
+            keyframe above which a frame is matted again.
+        inference_size (int): Long side, in pixels, of the bilinear-downscaled copy matting runs
+            on, at least the model input size; 0 shrinks full-resolution frames with an area filter.
+        refine_edges (bool): Upsample downscaled masks with an edge-aware guided filter.
+        encoder (str): 'ffmpeg' to encode with libx264/libx265 and keep the audio, or 'opencv'
+            for the 'mp4v' writer.
+        codec (str): Video codec of the ffmpeg encoder, 'libx264' or 'libx265'.
+        preset (str): Preset of the ffmpeg encoder.
+        crf (int): Constant rate factor of the ffmpeg encoder.
+        encoder_threads (int): Threads of the ffmpeg encoder; 0 lets ffmpeg decide.
+
+    Raises:
+        ValueError: If the encoder or codec is not supported.
+    """
+
+    def __init__(self, batch_size=MATTING_BATCH_SIZE, workers=DEFAULT_WORKERS, temporal=False,
+                 keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, diff_threshold=DEFAULT_DIFF_THRESHOLD,
+                 inference_size=0, refine_edges=False, encoder=DEFAULT_ENCODER, codec=DEFAULT_VIDEO_CODEC,
+                 preset=DEFAULT_PRESET, crf=DEFAULT_CRF, encoder_threads=DEFAULT_ENCODER_THREADS):
+        self.batch_size = max(1, int(batch_size))
+        self.workers = max(1, int(workers))
+        self.temporal = bool(temporal)
+        self.keyframe_interval = max(1, int(keyframe_interval))
+        self.diff_threshold = float(diff_threshold)
+        self.inference_size = max(0, int(inference_size))
+        self.refine_edges = bool(refine_edges)
+        if encoder not in ENCODERS:
+            raise ValueError(f'Unsupported encoder {encoder!r}, expected one of {ENCODERS}')
+        if codec not in VIDEO_CODECS:
+            raise ValueError(f'Unsupported codec {codec!r}, expected one of {VIDEO_CODECS}')
+        self.encoder = encoder
+        self.codec = codec
+        self.preset = str(preset)
+        self.crf = int(crf)
+        self.encoder_threads = max(0, int(encoder_threads))
+
+    @classmethod
+    def from_form(cls, form):
+        """
+        Builds the options from request form fields, using the defaults for missing fields.
+
+        Raises:
+            ValueError: If a numeric field cannot be parsed or the encoder or codec is not supported.
+        """
+        return cls(
+            batch_size=int(form.get('batch_size', MATTING_BATCH_SIZE)),
+            workers=int(form.get('workers', DEFAULT_WORKERS)),
+            temporal=is_truthy(form.get('temporal')),
+            keyframe_interval=int(form.get('keyframe_interval', DEFAULT_KEYFRAME_INTERVAL)),
+            diff_threshold=float(form.get('diff_threshold', DEFAULT_DIFF_THRESHOLD)),
+            inference_size=int(form.get('inference_size', 0)),
+            refine_edges=is_truthy(form.get('refine_edges')),
+            encoder=form.get('encoder', DEFAULT_ENCODER),
+            codec=form.get('codec', DEFAULT_VIDEO_CODEC),
+            preset=form.get('preset', DEFAULT_PRESET),
+            crf=int(form.get('crf', DEFAULT_CRF)),
+        )
+
+    def to_dict(self):
+        return dict(vars(self))
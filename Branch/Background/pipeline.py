@@ -0,0 +1,636 @@
+import os
+import math
+import itertools
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+import numpy as np
+from tqdm import tqdm
+from backgrounds import VideoBackground, is_video_background
+from checkpoint import CHECKPOINT_ENCODER_THREADS, CHECKPOINT_MIN_FRAMES, CHECKPOINT_SEGMENT_FRAMES, CheckpointManifest
+from compositing import Compositor
+from downscale import DownscaledMattingEngine
+from encoders import open_video_writer
+from mask_cache import CachedMaskEngine, MaskWriter, RecordingMattingEngine
+from matting import BatchedMattingEngine, MattingSessionPool, get_session_pool, set_session_pool
+from options import DEFAULT_WORKERS, ProcessingOptions
+from result_cache import file_digest
+from segments import concat_segments
+from stages import StagedPipeline, format_utilization
+from temporal import TemporalMattingEngine
+
+
+def probe_video(video_path):
+    """
+    Reads the frame rate, frame count and frame size of a video.
+
+    Args:
+        video_path (str): Path to the video.
+
+    Returns:
+        tuple: (fps, frame_count, frame_width, frame_height). fps is kept as a float
+            so fractional rates such as 29.97 survive re-encoding.
+
+    Raises:
+        ValueError: If the video cannot be opened.
+    """
+    cap = cv2.VideoCapture(video_path)
+
+    # Check if the video was opened successfully
+    if not cap.isOpened():
+        raise ValueError(f'Could not open video {video_path}')
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    return fps, frame_count, frame_width, frame_height
+
+
+def load_background(background_image_path):
+    """
+    Reads the new background image.
+
+    Raises:
+        ValueError: If the image cannot be loaded.
+    """
+    new_background = cv2.imread(background_image_path)
+    if new_background is None:
+        raise ValueError(f'Could not load background image {background_image_path}')
+    return new_background
+
+
+def _merge_stats(stats_list):
+    merged = {'frames_written': 0, 'inferences': 0, 'skipped_inferences': 0}
+    for stats in stats_list:
+        for key in merged:
+            merged[key] += stats[key]
+    merged['masks_recorded'] = all(stats['masks_recorded'] for stats in stats_list)
+
+    # Shards run side by side, so report the mean utilization of each stage
+    stages = stats_list[0]['stage_utilization'] if stats_list else {}
+    merged['stage_utilization'] = {
+        stage: round(sum(stats['stage_utilization'][stage] for stats in stats_list) / len(stats_list), 3)
+        for stage in stages
+    }
+    return merged
+
+
+def render_frame_range(input_video_path, background_image_path, output_video_path, start_frame=0, end_frame=None,
+                       debug_frames_dir=None, options=None, progress_callback=None, audio_source=None,
+                       cached_masks_dir=None, record_masks_dir=None):
+    """
+    Replaces the background of frames [start_frame, end_frame) of a video and streams
+    the composited frames straight into the video encoder.
+
+    Decoding, matting, compositing and encoding run as separate stages on their own
+    threads, connected by bounded queues, so they overlap while memory stays flat.
+
+    Args:
+        input_video_path (str): Path to the input video.
+        background_image_path (str): Path to the new background, a still image or a video.
+            A video background is played in lockstep with the input video, looped when
+            shorter and cut when longer.
+        output_video_path (str): Path where the output video is written.
+        start_frame (int, optional): Index of the first frame to process.
+        end_frame (int, optional): Index one past the last frame to process, or None
+            to read until the end of the video.
+        debug_frames_dir (str, optional): If given, every composited frame is also
+            dumped there as a PNG for debugging.
+        options (ProcessingOptions, optional): Processing parameters; defaults are used if omitted.
+        progress_callback (callable, optional): Called as progress_callback(frames_done, total_frames)
+            after every batch, counting frames of this range only.
+        audio_source (str, optional): Video whose audio track is muxed into the output
+            (ffmpeg encoder only).
+        cached_masks_dir (str, optional): Mask cache entry of the video; its masks are used
+            instead of running matting.
+        record_masks_dir (str, optional): Directory the predicted masks of the range are
+            recorded into, for the mask cache.
+
+    Returns:
+        dict: Number of frames written, matting inferences run, inferences skipped, the
+            utilization of every pipeline stage and whether all masks were recorded.
+
+    Raises:
+        ValueError: If the video or the background cannot be opened.
+    """
+    options = options or ProcessingOptions()
+    fps, frame_count, frame_width, frame_height = probe_video(input_video_path)
+
+    # A still background is resized once by the compositor; a video background is decoded
+    # frame by frame in lockstep with the input video
+    video_mode = is_video_background(background_image_path)
+    still_background = None if video_mode else load_background(background_image_path)
+    compositor = Compositor(still_background, frame_width, frame_height)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_video_path)), exist_ok=True)
+    if debug_frames_dir:
+        os.makedirs(debug_frames_dir, exist_ok=True)
+
+    cap = cv2.VideoCapture(input_video_path)
+
+    # Skip to the first frame by grabbing; seeking by frame index is not frame-exact for every codec
+    for _ in range(start_frame):
+        if not cap.grab():
+            break
+
+    # The ffmpeg encoder runs on its own thread, so encoding overlaps with matting
+    video_writer = open_video_writer(output_video_path, fps, (frame_width, frame_height), options,
+                                     audio_source=audio_source)
+
+    if cached_masks_dir:
+        # The masks of this video are cached, so only compositing is left to do
+        engine = CachedMaskEngine(cached_masks_dir, start_frame, options.batch_size)
+    else:
+        # Every batch reuses the preloaded, process-wide matting sessions
+        engine = BatchedMattingEngine(get_session_pool(), batch_size=options.batch_size)
+        if options.inference_size:
+            engine = DownscaledMattingEngine(engine, options.inference_size, refine_edges=options.refine_edges)
+        if options.temporal:
+            engine = TemporalMattingEngine(engine, options.keyframe_interval, options.diff_threshold)
+        if record_masks_dir:
+            mask_writer = MaskWriter(os.path.join(record_masks_dir, f'part_{start_frame:08d}.masks'),
+                                     frame_width, frame_height, start_frame)
+            engine = RecordingMattingEngine(engine, mask_writer)
+
+    last_frame = frame_count if end_frame is None else min(end_frame, frame_count)
+    total_frames = max(0, last_frame - start_frame)
+    pipeline = StagedPipeline()
+
+    # Composited frames are written into a ring of buffers large enough for every frame
+    # that can be in flight between the compositing stage and the encoder
+    ring_size = (pipeline.queue_size + 2) * engine.batch_size
+    output_buffers = itertools.cycle([np.empty((frame_height, frame_width, 3), dtype=np.uint8)
+                                      for _ in range(ring_size)])
+    counts = {'frames_done': 0, 'frames_written': 0}
+
+    # Background frames are decoded with the input frames and stay in flight until they are
+    # composited, so their ring covers the decode, matting and compositing stages and their queues
+    video_background = None
+    if video_mode:
+        video_background = VideoBackground(background_image_path, frame_width, frame_height, start_frame=start_frame,
+                                           buffers=(2 * pipeline.queue_size + 3) * engine.batch_size)
+
+    def decode():
+        i = start_frame
+        batch, backgrounds, batch_start = [], [], start_frame
+        while end_frame is None or i < end_frame:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if not batch:
+                batch_start = i
+            batch.append(frame)
+            backgrounds.append(video_background.next_frame() if video_background else None)
+            i += 1
+            if len(batch) == engine.batch_size:
+                yield batch_start, batch, backgrounds
+                batch, backgrounds = [], []
+
+        # Flush the last, possibly incomplete batch
+        if batch:
+            yield batch_start, batch, backgrounds
+
+    def matte(item):
+        batch_start, frames, backgrounds = item
+        try:
+            return batch_start, frames, backgrounds, engine.predict_alphas(frames)
+        except Exception as e:
+            print(f"Error removing background from frames {batch_start}-{batch_start + len(frames) - 1}: {e}")
+            return batch_start, frames, backgrounds, None
+
+    def composite(item):
+        batch_start, frames, backgrounds, alphas = item
+        if alphas is None:
+            return batch_start, len(frames), []
+        return batch_start, len(frames), [compositor.composite(frame, alpha, out=next(output_buffers),
+                                                               background=background)
+                                          for frame, alpha, background in zip(frames, alphas, backgrounds)]
+
+    def encode(item):
+        batch_start, frame_total, composited_frames = item
+        for offset, composited in enumerate(composited_frames):
+            video_writer.write(composited)
+
+            # Optionally keep the processed frame on disk for debugging
+            if debug_frames_dir:
+                cv2.imwrite(os.path.join(debug_frames_dir, f'{batch_start + offset:04d}.png'), composited)
+
+        counts['frames_done'] += frame_total
+        counts['frames_written'] += len(composited_frames)
+        progress.update(frame_total)
+        if progress_callback:
+            progress_callback(counts['frames_done'], max(total_frames, counts['frames_done']))
+
+    # Decode, matte, composite and encode on their own threads, connected by bounded queues
+    pipeline.set_source('decode', decode).add_stage('matte', matte).add_stage('composite', composite) \
+        .add_stage('encode', encode)
+    try:
+        with tqdm(total=total_frames, desc="Processing frames") as progress:
+            stage_utilization = pipeline.run()
+        if progress_callback:
+            progress_callback(counts['frames_done'], counts['frames_done'])
+    finally:
+        cap.release()
+        video_writer.release()
+        if video_background:
+            video_background.close()
+        if cached_masks_dir or record_masks_dir:
+            engine.close()
+
+    print(f"Stage utilization: {format_utilization(stage_utilization)}")
+    if options.temporal and not cached_masks_dir:
+        print(f"Temporal mode skipped {engine.skipped_inferences} of {engine.inferences + engine.skipped_inferences} "
+              f"matting inferences.")
+    return {'frames_written': counts['frames_written'], 'inferences': engine.inferences,
+            'skipped_inferences': engine.skipped_inferences, 'stage_utilization': stage_utilization,
+            'masks_recorded': bool(record_masks_dir) and engine.complete}
+
+
+"""
+
+Frame-sharded processing across a pool of worker processes
+
+"""
+
+# Queue of (run id, frames finished) reports shared by all workers, set by _init_worker
+_progress_queue = None
+
+
+def _init_worker(model_name, intra_op_threads, progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+    # Each worker loads and warms up its own matting session once, when the pool starts;
+    # ONNX Runtime sessions are not shared across processes
+    session_pool = MattingSessionPool(model_name=model_name, size=1, intra_op_threads=intra_op_threads)
+    session_pool.warm_up()
+    set_session_pool(session_pool)
+
+
+def _render_shard(run_id, shard):
+    (input_video_path, background_image_path, segment_path, start_frame, end_frame, debug_frames_dir, options,
+     cached_masks_dir, record_masks_dir) = shard
+    reported = [0]
+
+    # Report the frames finished since the last report to the parent process
+    def report_progress(frames_done, total_frames):
+        _progress_queue.put((run_id, frames_done - reported[0]))
+        reported[0] = frames_done
+
+    return render_frame_range(input_video_path, background_image_path, segment_path, start_frame=start_frame,
+                              end_frame=end_frame, debug_frames_dir=debug_frames_dir, options=options,
+                              progress_callback=report_progress, cached_masks_dir=cached_masks_dir,
+                              record_masks_dir=record_masks_dir)
+
+
+class ShardWorkerPool:
+    """
+    A long-lived pool of worker processes rendering frame-range shards, shared by every
+    sharded run of the process. Every worker loads its matting session once, when the
+    pool starts.
+
+    Workers are started with 'forkserver' rather than forked from the serving process,
+    whose Flask, job and ONNX Runtime threads may hold locks at fork time. Modules that
+    start services at import time must therefore skip them when re-imported as
+    __mp_main__ in a worker.
+
+    Args:
+        workers (int): Number of worker processes.
+        model_name (str, optional): rembg model of the workers; the model of the
+            process-wide session pool if omitted.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, model_name=None):
+        self.workers = max(1, workers)
+        self.model_name = model_name or get_session_pool().model_name
+        # Share the cores between workers so their ONNX Runtime thread pools do not oversubscribe the CPU
+        self.intra_op_threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self._context = multiprocessing.get_context('forkserver')
+        # Workers fork from a server that has already imported the pipeline and its dependencies
+        self._context.set_forkserver_preload(['pipeline'])
+        # Puts on a SimpleQueue are synchronous, so a shard's reports are queued before its result returns
+        self._progress_queue = self._context.SimpleQueue()
+        self._progress = {}
+        self._run_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._start()
+        threading.Thread(target=self._collect_progress, name='shard-progress', daemon=True).start()
+
+    def _start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context,
+                                             initializer=_init_worker,
+                                             initargs=(self.model_name, self.intra_op_threads, self._progress_queue))
+        # Workers are launched on demand while none is idle; one task per worker, submitted while the
+        # first sessions are still loading, launches them all now rather than on the first run
+        for future in [self._executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def _collect_progress(self):
+        while True:
+            run_id, frames = self._progress_queue.get()
+            with self._lock:
+                progress = self._progress.get(run_id)
+            if progress is None:
+                continue
+            # None marks the end of a run, queued after every report of its shards
+            if frames is None:
+                progress['drained'].set()
+            else:
+                progress['frames'] += frames
+
+    def render(self, shards, frame_count, progress_callback, frames_done=0, on_shard_done=None):
+        """
+        Renders frame-range shards on the pool.
+
+        Args:
+            shards (list): Arguments of _render_shard, one tuple per shard.
+            frame_count (int): Frame count of the whole video, for progress reporting.
+            progress_callback (callable): Called as progress_callback(frames_done, total_frames), or None.
+            frames_done (int): Frames finished before this call, counted in the reported progress.
+            on_shard_done (callable, optional): Called as on_shard_done(position, stats) as soon as
+                the shard at `position` in `shards` is finished.
+
+        Returns:
+            list: Stats of every shard, in shard order.
+        """
+        run_id = next(self._run_ids)
+        progress = {'frames': frames_done, 'drained': threading.Event()}
+        with self._lock:
+            self._progress[run_id] = progress
+            executor = self._executor
+        try:
+            futures = [executor.submit(_render_shard, run_id, shard) for shard in shards]
+            positions = {future: position for position, future in enumerate(futures)}
+
+            # Poll the frame counter of this run until every shard is done
+            pending = futures
+            while pending:
+                done, pending = wait(pending, timeout=1)
+                if on_shard_done:
+                    for future in sorted(done, key=positions.get):
+                        on_shard_done(positions[future], future.result())
+                if progress_callback:
+                    progress_callback(progress['frames'], max(frame_count, progress['frames']))
+            results = [future.result() for future in futures]
+
+            # Report the final count once the last reports of the shards are collected
+            if progress_callback:
+                self._progress_queue.put((run_id, None))
+                progress['drained'].wait()
+                progress_callback(progress['frames'], progress['frames'])
+            return results
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool for the next runs
+            with self._lock:
+                if self._executor is executor:
+                    self._start()
+            raise
+        finally:
+            with self._lock:
+                del self._progress[run_id]
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """
+    Returns the process-wide shard worker pool, starting it on first use.
+    """
+    global _worker_pool
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = ShardWorkerPool()
+    return _worker_pool
+
+
+def set_worker_pool(worker_pool):
+    """
+    Replaces the process-wide shard worker pool, e.g. with one of another size.
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        _worker_pool = worker_pool
+
+
+def max_shard_workers():
+    """
+    Returns the number of worker processes a sharded run can use: the size of the
+    process-wide shard worker pool, which the server sets (BACKGROUND_WORKERS), not the request.
+    """
+    worker_pool = _worker_pool
+    return worker_pool.workers if worker_pool is not None else DEFAULT_WORKERS
+
+
+def start_worker_pool():
+    """
+    Starts the process-wide shard worker pool when sharding is enabled by default, so the
+    first request does not pay the worker and model start-up. Call at process start.
+    """
+    if DEFAULT_WORKERS > 1:
+        get_worker_pool()
+
+
+def _render_shards(shards, frame_count, progress_callback, frames_done=0, on_shard_done=None):
+    return get_worker_pool().render(shards, frame_count, progress_callback, frames_done=frames_done,
+                                    on_shard_done=on_shard_done)
+
+
+def _replace_background_sharded(input_video_path, background_image_path, output_video_path, frame_count, fps,
+                                frame_size, workers, debug_frames_dir, options, progress_callback, cached_masks_dir,
+                                record_masks_dir):
+    # Split the video into one contiguous frame range per worker; the last range reads to the end
+    shard_length = math.ceil(frame_count / workers)
+    segments_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(os.path.abspath(output_video_path)))
+    shards = []
+    for index in range(workers):
+        start_frame = index * shard_length
+        end_frame = None if index == workers - 1 else start_frame + shard_length
+        segment_path = os.path.join(segments_dir, f'segment_{index:04d}.mp4')
+        shards.append((input_video_path, background_image_path, segment_path, start_frame, end_frame,
+                       debug_frames_dir, options, cached_masks_dir, record_masks_dir))
+
+    try:
+        stats_per_shard = _render_shards(shards, frame_count, progress_callback)
+
+        # Merge the segments back in frame order
+        segment_paths = [shard[2] for shard, stats in zip(shards, stats_per_shard) if stats['frames_written'] > 0]
+        # The segments carry no audio; the source audio is muxed in while joining them
+        audio_source = input_video_path if options.encoder == 'ffmpeg' else None
+        concat_segments(segment_paths, output_video_path, fps, frame_size, audio_source=audio_source)
+    finally:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+
+    return _merge_stats(stats_per_shard)
+
+
+def _replace_background_checkpointed(input_video_path, background_image_path, output_video_path, checkpoint_dir,
+                                     frame_count, fps, frame_size, workers, debug_frames_dir, options,
+                                     progress_callback, cached_masks_dir, record_masks_dir):
+    # Pin the encoder thread count so a segment encodes to the same bytes in whichever process renders it
+    if not options.encoder_threads:
+        options = ProcessingOptions(**{**options.to_dict(), 'encoder_threads': CHECKPOINT_ENCODER_THREADS})
+
+    # Segments have a fixed length, independent of the worker count, so a resumed run
+    # cuts the video exactly like the interrupted one
+    fingerprint = {
+        'video': file_digest(input_video_path),
+        'background': file_digest(background_image_path),
+        'segment_frames': CHECKPOINT_SEGMENT_FRAMES,
+        'options': {name: value for name, value in options.to_dict().items() if name != 'workers'},
+    }
+    manifest = CheckpointManifest(checkpoint_dir, fingerprint)
+    segment_count = max(1, math.ceil(frame_count / CHECKPOINT_SEGMENT_FRAMES))
+    shards = []
+    for index in range(segment_count):
+        start_frame = index * CHECKPOINT_SEGMENT_FRAMES
+        end_frame = None if index == segment_count - 1 else start_frame + CHECKPOINT_SEGMENT_FRAMES
+        shards.append((input_video_path, background_image_path, manifest.segment_path(index), start_frame,
+                       end_frame, debug_frames_dir, options, cached_masks_dir, record_masks_dir))
+
+    # Masks recorded by an earlier process are gone, so resumed segments never complete the mask cache
+    stats_per_segment = {index: {**entry['stats'], 'masks_recorded': False}
+                         for index, entry in manifest.segments.items()}
+    resumed_frames = sum(stats['frames_written'] for stats in stats_per_segment.values())
+    if stats_per_segment:
+        print(f"Resuming from checkpoint: {len(stats_per_segment)} of {segment_count} segments done, "
+              f"last finished frame {manifest.last_finished_frame}.")
+    pending = [index for index in range(segment_count) if index not in stats_per_segment]
+
+    def segment_done(index, stats):
+        manifest.mark_done(index, shards[index][3], stats)
+        stats_per_segment[index] = stats
+
+    if workers == 1:
+        frames_done = resumed_frames
+        for index in pending:
+            _, _, segment_path, start_frame, end_frame, *_ = shards[index]
+
+            def report_progress(done, total, base=frames_done):
+                progress_callback(base + done, max(frame_count, base + done))
+
+            stats = render_frame_range(input_video_path, background_image_path, segment_path,
+                                       start_frame=start_frame, end_frame=end_frame,
+                                       debug_frames_dir=debug_frames_dir, options=options,
+                                       progress_callback=report_progress if progress_callback else None,
+                                       cached_masks_dir=cached_masks_dir, record_masks_dir=record_masks_dir)
+            segment_done(index, stats)
+            frames_done += stats['frames_written']
+    elif pending:
+        _render_shards([shards[index] for index in pending], frame_count, progress_callback,
+                       frames_done=resumed_frames,
+                       on_shard_done=lambda position, stats: segment_done(pending[position], stats))
+
+    # Join the segments in frame order; the source audio is muxed in while joining them
+    segment_paths = [manifest.segment_path(index) for index in range(segment_count)
+                     if stats_per_segment[index]['frames_written'] > 0]
+    audio_source = input_video_path if options.encoder == 'ffmpeg' else None
+    concat_segments(segment_paths, output_video_path, fps, frame_size, audio_source=audio_source)
+    manifest.remove()
+
+    stats = _merge_stats([stats_per_segment[index] for index in range(segment_count)])
+    stats['resumed_frames'] = resumed_frames
+    return stats
+
+
+def replace_background(input_video_path, background_image_path, output_video_path, debug_frames_dir=None,
+                       options=None, progress_callback=None, mask_cache=None, checkpoint_dir=None):
+    """
+    Replaces the background of every frame of a video and streams the composited
+    frames straight into the video encoder, without writing intermediate files.
+
+    Args:
+        input_video_path (str): Path to the input video.
+        background_image_path (str): Path to the new background, a still image or a video.
+            A video background is played in lockstep with the input video, looped when
+            shorter and cut when longer.
+        output_video_path (str): Path where the output video is written.
+        debug_frames_dir (str, optional): If given, every composited frame is also
+            dumped there as a PNG for debugging.
+        options (ProcessingOptions, optional): Processing parameters; defaults are used if omitted.
+            With more than one worker, the video is split by frame range, each range is
+            processed in its own process and the resulting segments are joined back in
+            frame order. The worker count is capped by the size of the shard worker pool,
+            see max_shard_workers(). The ffmpeg encoder keeps the audio track of the input video.
+        progress_callback (callable, optional): Called as progress_callback(frames_done, total_frames)
+            while the video is processed.
+        mask_cache (MaskCache, optional): Cache of per-frame alpha masks. When it holds the
+            masks of this video and matting parameters, matting is skipped entirely;
+            otherwise the predicted masks are added to it.
+        checkpoint_dir (str, optional): If given and the video has at least CHECKPOINT_MIN_FRAMES
+            frames, the video is rendered as fixed-size segments checkpointed in this directory,
+            and a run interrupted by a crash or restart resumes from the finished segments when
+            called again with the same arguments. The output is byte-identical to an
+            uninterrupted checkpointed run. The directory is removed on success. Shorter videos
+            take the regular path and are rendered again from the start after a restart.
+
+    Returns:
+        dict: Number of frames written, matting inferences run, inferences skipped, the
+            utilization of every pipeline stage and whether the masks came from the cache.
+
+    Raises:
+        ValueError: If the video or the background cannot be opened.
+    """
+    options = options or ProcessingOptions()
+    fps, frame_count, frame_width, frame_height = probe_video(input_video_path)
+    # Fail early on an unreadable background
+    if not is_video_background(background_image_path):
+        load_background(background_image_path)
+
+    # Reuse the masks of an earlier run on this video, or record them for the next background
+    mask_key, cached_masks_dir, record_masks_dir = None, None, None
+    if mask_cache is not None:
+        mask_key = mask_cache.key(input_video_path, options)
+        cached_masks_dir = mask_cache.lookup(mask_key)
+        if cached_masks_dir is None:
+            record_masks_dir = mask_cache.begin()
+
+    # More shards than pooled processes would only run one after another and add concat overhead
+    workers = max(1, min(options.workers, max_shard_workers(), frame_count or 1))
+    try:
+        if checkpoint_dir and frame_count >= CHECKPOINT_MIN_FRAMES:
+            os.makedirs(os.path.dirname(os.path.abspath(output_video_path)), exist_ok=True)
+            stats = _replace_background_checkpointed(input_video_path, background_image_path, output_video_path,
+                                                     checkpoint_dir, frame_count, fps, (frame_width, frame_height),
+                                                     workers, debug_frames_dir, options, progress_callback,
+                                                     cached_masks_dir, record_masks_dir)
+        elif workers == 1:
+            stats = render_frame_range(input_video_path, background_image_path, output_video_path,
+                                       debug_frames_dir=debug_frames_dir, options=options,
+                                       progress_callback=progress_callback, audio_source=input_video_path,
+                                       cached_masks_dir=cached_masks_dir, record_masks_dir=record_masks_dir)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(output_video_path)), exist_ok=True)
+            stats = _replace_background_sharded(input_video_path, background_image_path, output_video_path,
+                                                frame_count, fps, (frame_width, frame_height), workers,
+                                                debug_frames_dir, options, progress_callback, cached_masks_dir,
+                                                record_masks_dir)
+    except Exception:
+        if record_masks_dir:
+            mask_cache.discard(record_masks_dir)
+        raise
+    finally:
+        if cached_masks_dir:
+            mask_cache.release(cached_masks_dir)
+
+    # Only a complete set of masks is published to the cache
+    if record_masks_dir:
+        if stats['masks_recorded']:
+            mask_cache.commit(mask_key, record_masks_dir, stats['frames_written'])
+        else:
+            mask_cache.discard(record_masks_dir)
+    del stats['masks_recorded']
+    stats['mask_cache_hit'] = cached_masks_dir is not None
+    return stats
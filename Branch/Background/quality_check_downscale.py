@@ -0,0 +1,60 @@
+import argparse
+import sys
+import cv2
+from downscale import DownscaledMattingEngine, mask_iou
+from matting import BatchedMattingEngine, get_session_pool
+
+
+"""
+
+Quality check of downscaled-inference matting: mean mask IoU against full-resolution
+inference on the frames of a video. Exits with status 1 when the IoU is below the
+required minimum.
+
+    python quality_check_downscale.py --video /srv/videos/example_video.mp4 --inference-size 512 --min-iou 0.95
+
+"""
+
+def read_frames(video_path, frame_count, stride):
+    frames = []
+    cap = cv2.VideoCapture(video_path)
+    index = 0
+    while len(frames) < frame_count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if index % stride == 0:
+            frames.append(frame)
+        index += 1
+    cap.release()
+    return frames
+
+
+def check(frames, inference_size, refine_edges):
+    full_engine = BatchedMattingEngine(get_session_pool())
+    downscaled_engine = DownscaledMattingEngine(BatchedMattingEngine(get_session_pool()), inference_size,
+                                                refine_edges=refine_edges)
+
+    full_alphas = full_engine.predict_alphas(frames)
+    downscaled_alphas = downscaled_engine.predict_alphas(frames)
+    scores = [mask_iou(full, downscaled) for full, downscaled in zip(full_alphas, downscaled_alphas)]
+    return sum(scores) / len(scores), min(scores)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare downscaled and full-resolution matting masks.")
+    parser.add_argument('--video', required=True)
+    parser.add_argument('--inference-size', type=int, default=512)
+    parser.add_argument('--refine-edges', action='store_true')
+    parser.add_argument('--frames', type=int, default=32)
+    parser.add_argument('--stride', type=int, default=10, help="Check every n-th frame.")
+    parser.add_argument('--min-iou', type=float, default=0.95)
+    args = parser.parse_args()
+
+    frames = read_frames(args.video, args.frames, args.stride)
+    if not frames:
+        sys.exit(f"Could not read frames from {args.video}")
+
+    mean_iou, worst_iou = check(frames, args.inference_size, args.refine_edges)
+    print(f"{len(frames)} frames, inference size {args.inference_size}: mean IoU {mean_iou:.4f}, worst {worst_iou:.4f}")
+    sys.exit(0 if mean_iou >= args.min_iou else 1)
@@ -0,0 +1,139 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from matting import MATTING_MODEL
+
+# Upper bound of the disk space used by cached output videos
+RESULT_CACHE_MAX_BYTES = int(os.getenv('BACKGROUND_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+
+# Processing options left out of cache keys. batch_size stays in: batched ONNX Runtime runs are
+# not bit-identical to runs of one frame. The shard boundaries and encoder threads only change
+# how the video is encoded, and the small per-pixel differences they cause are accepted.
+_PERFORMANCE_OPTIONS = ('workers', 'encoder_threads')
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Disk-backed cache of rendered output videos, keyed by the content hashes of the
+    input video and background image and by the processing parameters.
+
+    Entries are evicted least-recently-used first once the cache grows past
+    `max_bytes`; the modification time of an entry records its last use.
+
+    Args:
+        cache_dir (str): Directory holding the cached videos.
+        max_bytes (int): Maximum total size of the cached videos.
+    """
+
+    def __init__(self, cache_dir, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_video_path, background_image_path, options):
+        """
+        Builds the cache key of a render.
+
+        Args:
+            input_video_path (str): Path to the input video.
+            background_image_path (str): Path to the background image.
+            options (ProcessingOptions): Processing parameters of the render.
+
+        Returns:
+            str: Hex digest identifying the render.
+        """
+        params = {name: value for name, value in options.to_dict().items() if name not in _PERFORMANCE_OPTIONS}
+        params['model'] = MATTING_MODEL
+        digest = hashlib.sha256()
+        digest.update(file_digest(input_video_path).encode())
+        digest.update(file_digest(background_image_path).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.mp4')
+
+    def fetch(self, key, output_video_path):
+        """
+        Places the cached video of `key` at `output_video_path`, if there is one.
+
+        Returns:
+            bool: True on a cache hit.
+        """
+        entry_path = self._entry_path(key)
+        with self._lock:
+            if not os.path.exists(entry_path):
+                self.misses += 1
+                return False
+            self.hits += 1
+            os.utime(entry_path)
+
+            # Hard-link when possible so a hit costs no copy; the output survives eviction either way
+            os.makedirs(os.path.dirname(os.path.abspath(output_video_path)), exist_ok=True)
+            if os.path.exists(output_video_path):
+                os.remove(output_video_path)
+            try:
+                os.link(entry_path, output_video_path)
+            except OSError:
+                shutil.copyfile(entry_path, output_video_path)
+        return True
+
+    def store(self, key, output_video_path):
+        """
+        Adds a rendered video to the cache, then evicts the least recently used
+        entries until the cache fits in `max_bytes`.
+        """
+        # Copy to a temporary file first so a concurrent fetch never sees a partial entry
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(file_descriptor)
+        shutil.copyfile(output_video_path, temp_path)
+        with self._lock:
+            os.replace(temp_path, self._entry_path(key))
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.mp4'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total_bytes -= size
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            sizes = [os.path.getsize(os.path.join(self.cache_dir, name))
+                     for name in os.listdir(self.cache_dir) if name.endswith('.mp4')]
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'entries': len(sizes),
+                'size_bytes': sum(sizes),
+                'max_bytes': self.max_bytes,
+            }
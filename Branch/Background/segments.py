@@ -0,0 +1,59 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import cv2
+
+
+def concat_segments(segment_paths, output_video_path, fps, frame_size, audio_source=None):
+    """
+    Joins video segments, in the given order, into a single output video.
+
+    Uses ffmpeg's concat demuxer to copy the streams without re-encoding, and
+    falls back to decoding and re-encoding the segments with OpenCV when ffmpeg
+    is not available.
+
+    Args:
+        segment_paths (list): Paths of the segment videos, in playback order.
+        output_video_path (str): Path of the joined video.
+        fps (float): Frame rate of the segments.
+        frame_size (tuple): (width, height) of the segments.
+        audio_source (str, optional): Video whose audio track is muxed into the joined
+            video (ffmpeg only).
+
+    Returns:
+        str: The output video path.
+    """
+    if shutil.which('ffmpeg'):
+        # The concat demuxer reads the segment list from a text file
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as list_file:
+            for segment_path in segment_paths:
+                list_file.write(f"file '{os.path.abspath(segment_path)}'\n")
+        try:
+            command = [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "concat", "-safe", "0", "-i", list_file.name,
+            ]
+            if audio_source:
+                command += ["-i", audio_source, "-map", "0:v:0", "-map", "1:a:0?", "-c:a", "aac"]
+            command += ["-c:v", "copy", "-fflags", "+bitexact", "-flags:a", "+bitexact", "-map_metadata", "-1",
+                        output_video_path]
+            subprocess.run(command, check=True)
+        finally:
+            os.remove(list_file.name)
+        return output_video_path
+
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, frame_size)
+    try:
+        for segment_path in segment_paths:
+            cap = cv2.VideoCapture(segment_path)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                video_writer.write(frame)
+            cap.release()
+    finally:
+        video_writer.release()
+    return output_video_path
@@ -0,0 +1,72 @@
+import cv2
+
+# Size of the grayscale thumbnails used to measure how much a frame changed
+PROBE_SIZE = (64, 36)
+
+
+class TemporalMattingEngine:
+    """
+    Wraps a matting engine so that only keyframes are matted; the frames in between
+    reuse the alpha mask of the last keyframe.
+
+    A frame becomes a keyframe when `keyframe_interval` frames have passed since the
+    last one, or when the mean absolute difference between its grayscale thumbnail
+    and the last keyframe's exceeds `diff_threshold`. Comparing against the keyframe
+    rather than the previous frame keeps slow drift from accumulating.
+
+    Args:
+        engine (BatchedMattingEngine): Engine used to matte the keyframes.
+        keyframe_interval (int): Maximum number of frames between two keyframes.
+        diff_threshold (float): Mean absolute difference (0-255) that forces a keyframe.
+    """
+
+    def __init__(self, engine, keyframe_interval, diff_threshold):
+        self.engine = engine
+        self.batch_size = engine.batch_size
+        self.keyframe_interval = keyframe_interval
+        self.diff_threshold = diff_threshold
+        self.inferences = 0
+        self.skipped_inferences = 0
+        self._reference_probe = None
+        self._frames_since_keyframe = 0
+        self._last_alpha = None
+
+    def _is_keyframe(self, frame):
+        probe = cv2.cvtColor(cv2.resize(frame, PROBE_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        keyframe = (self._reference_probe is None
+                    or self._frames_since_keyframe >= self.keyframe_interval
+                    or cv2.absdiff(probe, self._reference_probe).mean() > self.diff_threshold)
+        if keyframe:
+            self._reference_probe = probe
+            self._frames_since_keyframe = 0
+        self._frames_since_keyframe += 1
+        return keyframe
+
+    def predict_alphas(self, frames):
+        """
+        Predicts the alpha mask of every frame, running inference on keyframes only.
+
+        Args:
+            frames (list): Consecutive BGR frames (numpy.ndarray).
+
+        Returns:
+            list: One uint8 alpha mask per frame; non-keyframes share their keyframe's mask.
+        """
+        keyframe_flags = [self._is_keyframe(frame) for frame in frames]
+        try:
+            keyframe_alphas = iter(self.engine.predict_alphas([f for f, key in zip(frames, keyframe_flags) if key]))
+        except Exception:
+            # Start over from a fresh keyframe after a failed inference
+            self._reference_probe = None
+            self._last_alpha = None
+            raise
+
+        alphas = []
+        for key in keyframe_flags:
+            if key:
+                self._last_alpha = next(keyframe_alphas)
+                self.inferences += 1
+            else:
+                self.skipped_inferences += 1
+            alphas.append(self._last_alpha)
+        return alphas
@@ -0,0 +1,50 @@
+import os
+import shutil
+
+
+class JobWorkspace:
+    """
+    A job-scoped working directory holding the job's inputs, debug frames and output,
+    so concurrent jobs never touch each other's files.
+
+    Layout:
+        <root>/<job_id>/input_video.mp4
+        <root>/<job_id>/new_background      (still image or video)
+        <root>/<job_id>/output_frames/      (debug mode only)
+        <root>/<job_id>/checkpoint/         (segments and manifest of an unfinished render)
+        <root>/<job_id>/output_video.mp4
+        <root>/<job_id>/job.json            (persisted job state)
+
+    Args:
+        root (str): Directory holding the workspaces of all jobs.
+        job_id (str): Id of the job owning the workspace.
+    """
+
+    def __init__(self, root, job_id):
+        self.path = os.path.join(root, job_id)
+        self.input_video_path = os.path.join(self.path, 'input_video.mp4')
+        self.background_path = os.path.join(self.path, 'new_background')
+        self.frames_dir = os.path.join(self.path, 'output_frames')
+        self.checkpoint_dir = os.path.join(self.path, 'checkpoint')
+        self.output_video_path = os.path.join(self.path, 'output_video.mp4')
+        self.job_file = os.path.join(self.path, 'job.json')
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def cleanup_inputs(self):
+        """
+        Deletes the downloaded inputs of a finished job; the output and any debug frames are kept.
+        """
+        for path in (self.input_video_path, self.background_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove(self):
+        """
+        Deletes the whole workspace, output included.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
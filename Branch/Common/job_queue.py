@@ -0,0 +1,232 @@
+import os
+import json
+import queue
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How long a finished job's workspace (and output) is kept before it is deleted, by default
+JOB_RETENTION_SECONDS = 24 * 3600
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+class Job:
+    """
+    A queued request and its progress.
+
+    The job state is persisted in its workspace, so jobs survive a restart of the process.
+
+    Args:
+        params (dict): JSON-serializable request parameters passed on to the job handler.
+        workspace_root (str): Directory under which the job gets its own workspace.
+        workspace_class (type): Workspace of the app, called as workspace_class(root, job_id);
+            it provides create(), cleanup_inputs(), remove(), output_video_path and job_file.
+        job_id (str, optional): Id of the job; a new one is generated if omitted.
+    """
+
+    def __init__(self, params, workspace_root, workspace_class, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.params = params
+        self.workspace = workspace_class(workspace_root, self.id).create()
+        self.output_path = self.workspace.output_video_path
+        self.status = QUEUED
+        self.error = None
+        self.stats = None
+        self.frames_done = 0
+        self.total_frames = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def update_progress(self, frames_done, total_frames):
+        """
+        Records how many frames have been processed; safe to call from any thread.
+        """
+        with self._lock:
+            self.frames_done = frames_done
+            self.total_frames = total_frames
+
+    @classmethod
+    def load(cls, workspace_root, workspace_class, job_id):
+        """
+        Restores a job persisted by save().
+        """
+        job = cls({}, workspace_root, workspace_class, job_id=job_id)
+        with open(job.workspace.job_file) as job_file:
+            state = json.load(job_file)
+        job.params = state['params']
+        for name in ('status', 'error', 'stats', 'frames_done', 'total_frames', 'created_at', 'started_at',
+                     'finished_at'):
+            setattr(job, name, state[name])
+        return job
+
+    def save(self):
+        """
+        Persists the job state atomically in the job's workspace.
+        """
+        with self._lock:
+            state = {
+                'job_id': self.id,
+                'params': self.params,
+                'status': self.status,
+                'error': self.error,
+                'stats': self.stats,
+                'frames_done': self.frames_done,
+                'total_frames': self.total_frames,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+        temp_path = self.workspace.job_file + '.tmp'
+        with open(temp_path, 'w') as job_file:
+            json.dump(state, job_file)
+        os.replace(temp_path, self.workspace.job_file)
+
+    def to_dict(self):
+        """
+        Returns the job state, including throughput and estimated time remaining.
+        """
+        with self._lock:
+            fps, eta = None, None
+            if self.started_at and self.frames_done:
+                elapsed = (self.finished_at or time.time()) - self.started_at
+                fps = self.frames_done / elapsed if elapsed > 0 else None
+                if fps and self.status == RUNNING:
+                    eta = max(0, self.total_frames - self.frames_done) / fps
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'frames_done': self.frames_done,
+                'total_frames': self.total_frames,
+                'fps': round(fps, 2) if fps else None,
+                'eta_seconds': round(eta, 1) if eta is not None else None,
+                'output_path': self.output_path if self.status == COMPLETED else None,
+                'error': self.error,
+                'stats': self.stats,
+            }
+
+
+class JobManager:
+    """
+    Queues jobs and processes them on a pool of worker threads, so HTTP requests return
+    as soon as the job is enqueued. The workers share the models the handler uses.
+
+    Every job works in its own workspace; once it finishes only its own inputs are
+    deleted, and the whole workspace is deleted after `retention_seconds`. Jobs are
+    served from memory, so status requests must reach the process that accepted the job
+    (e.g. a single gunicorn worker with several threads).
+
+    Job states are also persisted in their workspaces: on startup, jobs that were queued
+    or running when the previous process stopped are queued again, so a handler that
+    checkpoints its work can resume them, and finished jobs stay available.
+
+    Args:
+        handler (callable): Called as handler(job) on a worker thread; it processes the job
+            inside job.workspace, writes job.output_path, reports progress through
+            job.update_progress and returns the job stats.
+        workspace_root (str): Directory holding the job workspaces.
+        workspace_class (type): Workspace of the app's jobs, see Job.
+        workers (int): Number of worker threads.
+        retention_seconds (int): How long finished jobs and their files are kept.
+        name (str): Kind of job, naming the worker threads ('<name>-job-worker-<n>') and
+            the log messages.
+    """
+
+    def __init__(self, handler, workspace_root, workspace_class, workers=1, retention_seconds=JOB_RETENTION_SECONDS,
+                 name='job'):
+        self.handler = handler
+        self.workspace_root = workspace_root
+        self.workspace_class = workspace_class
+        self.retention_seconds = retention_seconds
+        self.name = name
+        self._jobs = {}
+        self._latest_job_id = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._recover_jobs()
+        for index in range(max(1, workers)):
+            threading.Thread(target=self._work, name=f'{name}-job-worker-{index}', daemon=True).start()
+
+    def submit(self, params):
+        """
+        Enqueues a job and returns it immediately.
+        """
+        self._remove_expired_jobs()
+        job = Job(params, self.workspace_root, self.workspace_class)
+        job.save()
+        with self._lock:
+            self._jobs[job.id] = job
+            self._latest_job_id = job.id
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id=None):
+        """
+        Returns the job with the given id, or the most recently submitted job when no id
+        is given. Returns None if there is no such job.
+        """
+        with self._lock:
+            return self._jobs.get(job_id or self._latest_job_id)
+
+    def _recover_jobs(self):
+        # Reload the jobs persisted by a previous process, oldest first, and requeue the unfinished ones
+        if not os.path.isdir(self.workspace_root):
+            return
+        jobs = []
+        for job_id in os.listdir(self.workspace_root):
+            if os.path.exists(os.path.join(self.workspace_root, job_id, 'job.json')):
+                try:
+                    jobs.append(Job.load(self.workspace_root, self.workspace_class, job_id))
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Could not restore job {job_id}: {e}")
+
+        requeued = 0
+        for job in sorted(jobs, key=lambda job: job.created_at):
+            self._jobs[job.id] = job
+            self._latest_job_id = job.id
+            if job.status in (QUEUED, RUNNING):
+                job.status = QUEUED
+                job.started_at = None
+                job.save()
+                self._queue.put(job)
+                requeued += 1
+        if requeued:
+            logger.info(f"Requeued {requeued} unfinished {self.name} job(s).")
+
+    def _remove_expired_jobs(self):
+        # Only finished jobs are removed, and each one only deletes its own workspace
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_at and now - job.finished_at > self.retention_seconds]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            job.workspace.remove()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = RUNNING
+            job.started_at = time.time()
+            job.save()
+            try:
+                job.stats = self.handler(job)
+                job.status = COMPLETED
+            except Exception as e:
+                logger.exception(f"{self.name} job {job.id} failed")
+                job.error = str(e)
+                job.status = FAILED
+            finally:
+                job.workspace.cleanup_inputs()
+                job.finished_at = time.time()
+                job.save()
+                self._queue.task_done()
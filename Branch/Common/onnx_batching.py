@@ -0,0 +1,33 @@
+import numpy as np
+
+
+def make_batch_dynamic(model):
+    """
+    Replaces the fixed batch dimension of the model inputs and outputs with a symbolic
+    one, so a single session run can take several samples.
+    """
+    for value in list(model.graph.input) + list(model.graph.output):
+        value.type.tensor_type.shape.dim[0].dim_param = 'batch'
+    # Inferred intermediate shapes still carry the fixed batch size
+    del model.graph.value_info[:]
+    return model
+
+
+def accepts_batches(session, input_shapes, output_name=None):
+    """
+    Probes whether a session runs a batch of two, e.g. after make_batch_dynamic() on a
+    graph whose nodes may still hard-code a batch of one.
+
+    Args:
+        session (onnxruntime.InferenceSession): Session to probe.
+        input_shapes (dict): Shape of one sample of every input, by input name.
+        output_name (str, optional): Output to check; the first output if omitted.
+
+    Returns:
+        bool: True if the session returns a batch of two.
+    """
+    feeds = {name: np.zeros((2, *shape), dtype=np.float32) for name, shape in input_shapes.items()}
+    try:
+        return session.run([output_name] if output_name else None, feeds)[0].shape[0] == 2
+    except Exception:
+        return False
@@ -1,11 +1,15 @@
 # app.py
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from face_swapper import FaceSwapper
-from config import TARGET_PATH, SOURCE_PATH, OUTPUT_PATH, MODEL_PATH
+from config import MODEL_PATH, JOBS_DIR, output_dir
+from jobs import JobManager, COMPLETED, FAILED
+from face_index import CATALOGUE_DIR
+from face_tracker import DETECT_INTERVAL
 import model_setup
 import os
 import json
+import uuid
 from werkzeug.utils import secure_filename
 import logging
 import gdown
@@ -28,7 +32,7 @@ logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s -
 # Setup environment and models
 model_setup.setup_environment()
 
-# Initialize face swapper
+# Initialize face swapper; every job worker shares its engine
 face_swapper = FaceSwapper(MODEL_PATH, roop_directory="roop")
 
 """
@@ -36,13 +40,6 @@ face_swapper = FaceSwapper(MODEL_PATH, roop_directory="roop")
 For Runing model with API
 
 """
-# For User Inputs Data 
-
-# Path to store uploaded file metadata (file paths, etc.)
-METADATA_FILE = '/srv/uploads/metadata_faceSwap.json'
-# Make sure directories exist
-os.makedirs(os.path.dirname(METADATA_FILE), exist_ok=True)
-
 # Allowed extensions for files
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'mp3', 'wav', 'mp4'}
 
@@ -50,68 +47,162 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'mp3', 'wav', 'mp4'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Helper function to store file metadata
-def save_metadata(data):
-    if not os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'w') as f:
-            json.dump([], f)  # Initialize empty list in file
-
-    with open(METADATA_FILE, 'r+') as f:
-        metadata = json.load(f)
-        metadata.append(data)
-        f.seek(0)
-        json.dump(metadata, f, indent=4)
-    logging.info(f"Metadata saved: {data}")
-
 # Helper function to download file from Google Drive
 def download_from_google_drive(url, output_path):
     file_id = url.split("/d/")[1].split("/view")[0]
     download_url = f"https://drive.google.com/uc?id={file_id}"
     gdown.download(download_url, output_path, quiet=False)
 
-# Endpoint to handle uploads and user selections
+# Helper function to resolve a target chosen from the stock videos, or None if it is outside the catalogue
+def catalogue_video_path(path):
+    catalogue_dir = os.path.realpath(CATALOGUE_DIR)
+    video_path = os.path.realpath(path)
+    if os.path.commonpath([catalogue_dir, video_path]) != catalogue_dir or not os.path.isfile(video_path):
+        return None
+    return video_path
+
+# Runs one queued job on a job worker thread: a face swap, or listing the identities of a target video
+def process_job(job):
+    params = job.params
+    workspace = job.workspace
+    if params.get('kind') == 'identities':
+        return list_identities(job)
+
+    # Download the inputs into the job's own workspace; catalogue videos are read in place,
+    # so their face-track index is used
+    face_mapping = None
+    if params.get('face_mapping'):
+        face_mapping = {}
+        for identity, image_url in params['face_mapping'].items():
+            face_mapping[int(identity)] = workspace.identity_source_image_path(identity)
+            download_from_google_drive(image_url, face_mapping[int(identity)])
+    else:
+        download_from_google_drive(params['image_url'], workspace.source_image_path)
+    target_path = get_target_path(params, workspace.target_video_path)
+
+    return face_swapper.swap_faces(target_path, workspace.source_image_path, job.output_path,
+                                   params['detect_interval'], progress_callback=job.update_progress,
+                                   face_mapping=face_mapping)
+
+# Lists the identities of the job's target video; they are returned as the job stats
+def list_identities(job):
+    target_path = get_target_path(job.params, job.workspace.target_video_path)
+    clusters = face_swapper.get_identities(target_path)
+    return {'identities': clusters.to_list()}
+
+# Helper function to get a local path of the target video, downloading it unless it is a catalogue video
+def get_target_path(params, download_path):
+    if params.get('chosen_video_path'):
+        return params['chosen_video_path']
+    download_from_google_drive(params['chosen_video_url'], download_path)
+    return download_path
+
+# Helper function to parse the optional face mapping of a request: {target identity id: source image link}
+def parse_face_mapping(value):
+    if not value:
+        return None
+    face_mapping = json.loads(value)
+    if not isinstance(face_mapping, dict) or not face_mapping:
+        raise ValueError('face_mapping must be a non-empty JSON object')
+    return {str(int(identity)): image_url for identity, image_url in face_mapping.items()}
+
+job_manager = JobManager(process_job, JOBS_DIR)
+
+# Endpoint to enqueue a face swap job
+@app.route('/swap', methods=['POST'])
 @app.route('/user_input_data_faceSwap', methods=['POST'])
-def upload():
-    # Retrieve uploaded files and user selections
+def swap_faces():
+    # Source image link, and either a Google Drive link or a catalogue path for the target video;
+    # a face mapping gives a source image link per target identity instead of a single image
     image_file = request.form.get('image_url')
     chosen_video = request.form.get('chosen_video_url')
+    chosen_video_path = request.form.get('chosen_video_path')
+    try:
+        face_mapping = parse_face_mapping(request.form.get('face_mapping'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid face_mapping: {e}'}), 400
 
     # Error handling for missing fields
-    if not image_file or not chosen_video :
+    if not (image_file or face_mapping) or not (chosen_video or chosen_video_path):
         logging.error('All inputs (image and video) are required.')
         return jsonify({'error': 'All inputs (image and video) are required.'}), 400
 
-    input_image_path = os.path.join('/srv/input_images', 'input_image.jpg')
-    input_video_path = os.path.join('/srv/input_videos', 'input_video.mp4')
-
-    # Download video and background from Google Drive
-    download_from_google_drive(image_file, input_image_path)
-    download_from_google_drive(chosen_video, input_video_path)
-
-    # Save metadata to JSON
-    data = {
-        'image_path': input_image_path,
-        'chosen_video_path': input_video_path,
-    }
-    save_metadata(data)
+    if chosen_video_path:
+        chosen_video_path = catalogue_video_path(chosen_video_path)
+        if chosen_video_path is None:
+            return jsonify({'error': f'chosen_video_path must be a video in {CATALOGUE_DIR}.'}), 400
 
-    return jsonify(data), 200
-
-
-# With API
-@app.route('/swap', methods=['POST'])
-def swap_faces():
     try:
-        # Run face swapping process
-        face_swapper.swap_faces(TARGET_PATH, SOURCE_PATH, OUTPUT_PATH)
-        return jsonify({"message": "Face swapping completed", "output_path": OUTPUT_PATH}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        detect_interval = int(request.form.get('detect_interval', DETECT_INTERVAL))
+    except ValueError:
+        return jsonify({'error': 'detect_interval must be an integer.'}), 400
+
+    job = job_manager.submit({
+        'image_url': image_file,
+        'chosen_video_url': chosen_video,
+        'chosen_video_path': chosen_video_path,
+        'detect_interval': detect_interval,
+        'face_mapping': face_mapping,
+    })
+    logging.info(f"Face swap job {job.id} queued")
+
+    return jsonify({'message': 'Face swapping started. Check the status for completion.', 'job_id': job.id}), 202
+
+# Endpoint to enqueue listing the identities of a target video, to build the face mapping of a swap;
+# the identities are returned by /result/<job_id> once the job is done
+@app.route('/identities', methods=['POST'])
+def identities():
+    chosen_video = request.form.get('chosen_video_url')
+    chosen_video_path = request.form.get('chosen_video_path')
+    if not (chosen_video or chosen_video_path):
+        return jsonify({'error': 'A target video (chosen_video_url or chosen_video_path) is required.'}), 400
+
+    if chosen_video_path:
+        chosen_video_path = catalogue_video_path(chosen_video_path)
+        if chosen_video_path is None:
+            return jsonify({'error': f'chosen_video_path must be a video in {CATALOGUE_DIR}.'}), 400
+
+    # Downloading and clustering a whole video can outlast the request, so it runs as a job
+    job = job_manager.submit({
+        'kind': 'identities',
+        'chosen_video_url': chosen_video,
+        'chosen_video_path': chosen_video_path,
+    })
+    logging.info(f"Identities job {job.id} queued")
+
+    return jsonify({'message': 'Listing identities started. Check the status for completion.', 'job_id': job.id}), 202
+
+# Endpoint to report the progress of a job
+@app.route('/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict()), 200
+
+# Endpoint to download the output video of a job
+@app.route('/result/<job_id>', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    if job.status == COMPLETED and job.params.get('kind') == 'identities':
+        return jsonify({'identities': job.stats['identities']}), 200
+    if job.status == COMPLETED:
+        return send_file(job.output_path, as_attachment=True, mimetype='video/mp4', download_name='output_video.mp4')
+    if job.status == FAILED:
+        return jsonify(job.to_dict()), 500
+    return jsonify({'message': 'Processing is still in progress. Please wait.', **job.to_dict()}), 202
 
 @app.route('/status', methods=['GET'])
 def status():
     return jsonify({"status": "Server is running"}), 200
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({**face_swapper.engine.face_cache.stats(),
+                    'clusters': face_swapper.engine.cluster_cache.stats()}), 200
+
 
 
 """
@@ -122,6 +213,7 @@ For Runing model without API
 
 # Without API
 def run_face_swap_loacl(TARGET_PATH, SOURCE_PATH):
+    OUTPUT_PATH = os.path.join(output_dir, f"output_{uuid.uuid4()}.mp4")
     try:
         face_swapper.swap_faces(TARGET_PATH, SOURCE_PATH, OUTPUT_PATH)
         print({"message": "Face swapping completed", "output_path": OUTPUT_PATH})
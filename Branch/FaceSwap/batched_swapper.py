@@ -0,0 +1,154 @@
+import os
+import sys
+import logging
+import tempfile
+import cv2
+import numpy as np
+import onnx
+from onnx import numpy_helper
+from insightface.utils import face_align
+from face_blend import FaceBlender, face_region
+from session_factory import SessionFactory
+# The ONNX batching helpers are shared with the other apps
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Common')))
+from onnx_batching import make_batch_dynamic, accepts_batches
+
+logger = logging.getLogger(__name__)
+
+# Number of face crops sent to inswapper in one session run
+SWAP_BATCH_SIZE = int(os.getenv('FACE_SWAP_BATCH_SIZE', '8'))
+
+# inswapper normalisation, as in insightface's INSwapper
+_INPUT_MEAN = 0.0
+_INPUT_STD = 255.0
+
+
+def _overlap(region, other):
+    x0, y0, x1, y1 = region
+    other_x0, other_y0, other_x1, other_y1 = other
+    return x0 < other_x1 and other_x0 < x1 and y0 < other_y1 and other_y0 < y1
+
+
+class BatchedSwapper:
+    """
+    inswapper_128 run on batches of aligned face crops: the crops of many frames and
+    faces go through one ONNX Runtime call per `batch_size` crops, and each result is
+    pasted back into its frame by a FaceBlender.
+
+    The batch dimension of the model is made dynamic when the session is created. If
+    the graph does not accept a batch larger than one, crops are run one at a time.
+
+    A face whose region overlaps that of an earlier face of the same frame is cropped
+    in a later round, once the earlier face is pasted, so its paste does not bring back
+    the unswapped pixels of the overlap.
+
+    The session comes from a SessionFactory, which caches the optimized graph; the emap
+    matrix, which the optimized graph drops, is cached next to it.
+
+    Args:
+        model_path (str): Path to inswapper_128.onnx.
+        providers (list): ONNX Runtime execution providers.
+        batch_size (int): Number of crops per session run.
+        blender (FaceBlender, optional): Paste-back step; insightface's blending if omitted.
+        session_factory (SessionFactory, optional): Session options; a default factory
+            is created if omitted.
+    """
+
+    def __init__(self, model_path, providers, batch_size=SWAP_BATCH_SIZE, blender=None, session_factory=None):
+        self.blender = blender or FaceBlender()
+        self.session_factory = session_factory or SessionFactory()
+        self.emap = None
+        self._emap_path = self.session_factory.cache_path(model_path, providers, '.emap.npy')
+        self.session = self.session_factory.create(model_path, providers, prepare=self._prepare_model)
+        if self.emap is None:
+            # The optimized graph came from the cache
+            self.emap = np.load(self._emap_path) if os.path.exists(self._emap_path) \
+                else self._load_emap(onnx.load(model_path))
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.output_name = self.session.get_outputs()[0].name
+        input_size = self.session.get_inputs()[0].shape[3]
+        self.input_size = input_size if isinstance(input_size, int) else 128
+        self.batch_size = max(1, batch_size)
+        self.session_runs = 0
+        input_shapes = {self.input_names[0]: (3, self.input_size, self.input_size),
+                        self.input_names[1]: (self.emap.shape[0],)}
+        if self.batch_size > 1 and not accepts_batches(self.session, input_shapes, self.output_name):
+            logger.warning(f"{model_path} does not accept batched inputs, running face crops one at a time")
+            self.batch_size = 1
+
+    def _prepare_model(self, model):
+        self._load_emap(model)
+        return make_batch_dynamic(model)
+
+    def _load_emap(self, model):
+        # The emap is the last initializer of inswapper
+        self.emap = numpy_helper.to_array(model.graph.initializer[-1])
+        if self._emap_path:
+            file_descriptor, temp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(self._emap_path))
+            with os.fdopen(file_descriptor, 'wb') as emap_file:
+                np.save(emap_file, self.emap)
+            os.replace(temp_path, self._emap_path)
+        return self.emap
+
+    def _run(self, blob, latent):
+        return self.session.run([self.output_name], {self.input_names[0]: blob, self.input_names[1]: latent})[0]
+
+    def source_latent(self, source_face):
+        """
+        Projects the source embedding into the swapper's latent space.
+        """
+        latent = source_face.normed_embedding.reshape((1, -1))
+        latent = np.dot(latent, self.emap)
+        latent /= np.linalg.norm(latent)
+        return latent.astype(np.float32)
+
+    def swap(self, frames, swaps):
+        """
+        Swaps faces into frames.
+
+        Args:
+            frames (list): BGR frames; the face regions are written in place.
+            swaps (list): (frame index, target face, source latent) tuples; overlapping
+                faces of one frame are pasted in list order.
+
+        Returns:
+            list: The frames with the swapped faces.
+        """
+        # Round of every face: one past the latest round of the earlier overlapping faces of its frame
+        rounds, pasted_regions = [], {}
+        for frame_index, target_face, latent in swaps:
+            # Faces from a face-track index carry their alignment matrix
+            M = target_face.matrix
+            if M is None:
+                M = face_align.estimate_norm(target_face.kps, self.input_size)
+            region = face_region(M, self.input_size, frames[frame_index].shape)
+            earlier = pasted_regions.setdefault(frame_index, [])
+            round_index = max((other_round + 1 for other_round, other in earlier if _overlap(region, other)),
+                              default=0)
+            earlier.append((round_index, region))
+            while len(rounds) <= round_index:
+                rounds.append([])
+            rounds[round_index].append((frame_index, M, latent))
+
+        for round_swaps in rounds:
+            self._swap_round(frames, round_swaps)
+        return frames
+
+    def _swap_round(self, frames, swaps):
+        # Crops are taken from the frames as pasted by the previous rounds
+        crops = [(frame_index, cv2.warpAffine(frames[frame_index], M, (self.input_size, self.input_size),
+                                              borderValue=0.0), M, latent)
+                 for frame_index, M, latent in swaps]
+
+        for start in range(0, len(crops), self.batch_size):
+            chunk = crops[start:start + self.batch_size]
+            blob = cv2.dnn.blobFromImages([aimg for _, aimg, _, _ in chunk], 1.0 / _INPUT_STD,
+                                          (self.input_size, self.input_size),
+                                          (_INPUT_MEAN, _INPUT_MEAN, _INPUT_MEAN), swapRB=True)
+            latent = np.concatenate([latent for _, _, _, latent in chunk])
+            pred = self._run(blob, latent)
+            self.session_runs += 1
+
+            for (frame_index, aimg, M, _), img_fake in zip(chunk, pred.transpose((0, 2, 3, 1))):
+                bgr_fake = np.clip(255 * img_fake, 0, 255).astype(np.uint8)[:, :, ::-1]
+                self.blender.paste(frames[frame_index], bgr_fake, aimg, M)
@@ -0,0 +1,54 @@
+import argparse
+import os
+import tempfile
+import time
+import cv2
+from swap_engine import FaceSwapEngine
+
+
+"""
+
+Benchmark of batched inswapper inference: frames/s of a video swap for several batch
+sizes on the same engine, against batch size 1 (one session run per face crop, as in
+roop).
+
+    python benchmark_batching.py --video /srv/videos/example_video.mp4 --source /srv/uploads/example_image.png --model models/inswapper_128.onnx
+
+"""
+
+def benchmark(video_path, source_path, model_path, execution_provider, batch_sizes):
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    output_dir = tempfile.mkdtemp(prefix='benchmark_batching_')
+
+    engine = FaceSwapEngine(model_path, execution_provider, batch_size=max(batch_sizes))
+    accepts_batches = engine.swapper.batch_size > 1
+    if not accepts_batches:
+        print("The model does not accept batched inputs; every batch size runs one crop per session run.")
+    engine.get_source_face(source_path)
+
+    baseline = None
+    for batch_size in batch_sizes:
+        engine.swapper.batch_size = batch_size if accepts_batches else 1
+        session_runs = engine.swapper.session_runs
+        start = time.perf_counter()
+        engine.swap_video(video_path, source_path, os.path.join(output_dir, f'output_{batch_size}.mp4'))
+        elapsed = time.perf_counter() - start
+        session_runs = engine.swapper.session_runs - session_runs
+
+        baseline = baseline or elapsed
+        print(f"batch_size={batch_size:<3d} {elapsed:8.2f} s  {frame_count / elapsed:7.2f} frames/s  "
+              f"{session_runs:6d} session runs  speedup {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched inswapper inference.")
+    parser.add_argument('--video', required=True)
+    parser.add_argument('--source', required=True)
+    parser.add_argument('--model', default=os.path.join('models', 'inswapper_128.onnx'))
+    parser.add_argument('--execution-provider', default='cpu')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    benchmark(args.video, args.source, args.model, args.execution_provider, sorted(set(args.batch_sizes)))
@@ -0,0 +1,77 @@
+import argparse
+import time
+import cv2
+import numpy as np
+from insightface.utils import face_align
+from face_blend import FaceBlender
+
+
+"""
+
+Benchmark of the paste-back step: time per face of insightface's full-frame
+paste-back against the face-region paste-back of FaceBlender, at several frame
+resolutions with the same face size.
+
+    python benchmark_paste_back.py --face-size 200
+
+"""
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4K': (3840, 2160)}
+
+
+def full_frame_paste_back(frame, bgr_fake, aimg, M):
+    # Paste-back of insightface's INSwapper.get(paste_back=True), warping into the whole frame
+    IM = cv2.invertAffineTransform(M)
+    img_white = np.full((aimg.shape[0], aimg.shape[1]), 255, dtype=np.float32)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, (frame.shape[1], frame.shape[0]), borderValue=0.0)
+    img_white = cv2.warpAffine(img_white, IM, (frame.shape[1], frame.shape[0]), borderValue=0.0)
+    img_white[img_white > 20] = 255
+    img_mask = img_white
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    mask_size = int(np.sqrt((np.max(mask_h_inds) - np.min(mask_h_inds)) * (np.max(mask_w_inds) - np.min(mask_w_inds))))
+    k = max(mask_size // 10, 10)
+    img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+    k = max(mask_size // 20, 5)
+    img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+    img_mask = (img_mask / 255)[:, :, None]
+    return (img_mask * bgr_fake + (1 - img_mask) * frame.astype(np.float32)).astype(np.uint8)
+
+
+def time_per_call(paste, frame, repeats):
+    paste(frame)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        paste(frame)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def benchmark(face_size, repeats):
+    rng = np.random.default_rng(0)
+    blenders = {
+        'region feather': FaceBlender(),
+        'region color+feather': FaceBlender(color_correction=True),
+        'region seamless': FaceBlender(blend_mode='seamless'),
+    }
+
+    print(f"{'':8s} {'full-frame feather':>20s}" + ''.join(f" {name:>22s}" for name in blenders))
+    for name, (width, height) in RESOLUTIONS.items():
+        frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        # Five landmarks of a face of `face_size` pixels in the middle of the frame
+        kps = face_align.arcface_dst / 112 * face_size + (width / 2 - face_size / 2, height / 2 - face_size / 2)
+        M = face_align.estimate_norm(kps.astype(np.float32), 128)
+        aimg = cv2.warpAffine(frame, M, (128, 128), borderValue=0.0)
+        bgr_fake = rng.integers(0, 256, (128, 128, 3), dtype=np.uint8)
+
+        row = f"{name:8s} {time_per_call(lambda f: full_frame_paste_back(f, bgr_fake, aimg, M), frame, repeats):17.2f} ms"
+        for blender in blenders.values():
+            row += f" {time_per_call(lambda f: blender.paste(f, bgr_fake, aimg, M), frame, repeats):19.2f} ms"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark full-frame and face-region paste-back.")
+    parser.add_argument('--face-size', type=int, default=200, help="Face size in pixels")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    benchmark(args.face_size, args.repeats)
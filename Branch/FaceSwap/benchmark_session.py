@@ -0,0 +1,84 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from batched_swapper import BatchedSwapper
+from session_factory import SessionFactory, GRAPH_OPTIMIZATION_LEVELS
+from swap_engine import get_execution_providers
+
+
+"""
+
+Benchmark of the inswapper session configurations: startup time (session creation,
+cold and from the optimized graph cache) and latency per face crop, run one crop at a
+time and in batches, for the fp32, fp16 and int8 variants. The output of every variant
+is compared with the untuned fp32 session.
+
+    python benchmark_session.py --model models/inswapper_128.onnx --execution-provider cuda --intra-op-threads 4
+
+"""
+
+
+def crop_latency(swapper, batch, latent, repeats):
+    swapper._run(batch, latent)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        swapper._run(batch, latent)
+    return (time.perf_counter() - start) / repeats / len(batch) * 1000
+
+
+def benchmark(model_path, execution_provider, graph_optimization, intra_op_threads, inter_op_threads,
+              precisions, batch_size, repeats):
+    providers = get_execution_providers(execution_provider)
+    cache_dir = tempfile.mkdtemp(prefix='benchmark_session_')
+    rng = np.random.default_rng(0)
+
+    configurations = [('ort defaults', SessionFactory('all', 0, 0, True, True, precision='fp32', cache_dir=''))]
+    for precision in precisions:
+        factory = SessionFactory(graph_optimization, intra_op_threads, inter_op_threads, precision=precision,
+                                 cache_dir=cache_dir)
+        # The first start fills the optimized graph cache, the second loads from it
+        configurations += [(f'{precision} cold', factory), (f'{precision} cached', factory)]
+
+    reference = None
+    print(f"{'':14s} {'startup':>10s} {'1 crop':>12s} {f'batch of {batch_size}':>14s} {'max diff':>9s}")
+    try:
+        for name, factory in configurations:
+            start = time.perf_counter()
+            swapper = BatchedSwapper(model_path, providers, batch_size, session_factory=factory)
+            startup = time.perf_counter() - start
+
+            # The same crops and latents for every configuration
+            if reference is None:
+                size = swapper.input_size
+                crops = rng.random((batch_size, 3, size, size), dtype=np.float32)
+                latents = rng.normal(size=(batch_size, swapper.emap.shape[0])).astype(np.float32)
+                latents /= np.linalg.norm(latents, axis=1, keepdims=True)
+            batch, latent = crops[:swapper.batch_size], latents[:swapper.batch_size]
+            single = crop_latency(swapper, batch[:1], latent[:1], repeats)
+            batched = crop_latency(swapper, batch, latent, max(1, repeats // swapper.batch_size))
+
+            output = swapper._run(batch[:1], latent[:1])
+            reference = output if reference is None else reference
+            print(f"{name:14s} {startup * 1000:7.0f} ms {single:9.2f} ms {batched:11.2f} ms "
+                  f"{np.abs(output - reference).max():9.4f}")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark inswapper session options and model variants.")
+    parser.add_argument('--model', default=os.path.join('models', 'inswapper_128.onnx'))
+    parser.add_argument('--execution-provider', default='cpu')
+    parser.add_argument('--graph-optimization', default='all', choices=list(GRAPH_OPTIMIZATION_LEVELS))
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'fp16', 'int8'])
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    benchmark(args.model, args.execution_provider, args.graph_optimization, args.intra_op_threads,
+              args.inter_op_threads, args.precisions, args.batch_size, args.repeats)
@@ -2,39 +2,21 @@
 
 import logging
 import os
-import uuid
-import tempfile
-from UserInputs.get_user_inputs_data import get_face_swap_data
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Ensure output directory exists
+# Output directory of local runs; API jobs write their output into their own workspace
 output_dir = os.getenv('OUTPUT_DIR', "/srv/faceSwapOutputsVideos/")
 os.makedirs(output_dir, exist_ok=True)
 logger.info(f"Output directory set to: {output_dir}")
 
-# Generate unique output file
-unique_id = str(uuid.uuid4())
-output_path = os.path.join(output_dir, f"output_{unique_id}.mp4")
-logger.info(f"Output file path: {output_path}")
+# Every face swap job gets its own workspace (inputs, output, job state) under this directory
+JOBS_DIR = os.getenv('FACE_SWAP_JOBS_DIR', "/srv/faceSwapJobs/")
 
-# Uncomment the following block for temporary files (auto-cleanup)
-"""
-with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4", dir=output_dir) as temp_file:
-    output_path = temp_file.name
-    logger.info(f"Temporary file created: {output_path}")
-"""
-
-# Define paths
-SOURCE_PATH, TARGET_PATH = get_face_swap_data()
-
-OUTPUT_PATH = output_path
 MODEL_PATH = "./models/inswapper_128.onnx"
 
-logger.info(f"Target video path: {TARGET_PATH}")
-logger.info(f"Source image path: {SOURCE_PATH}")
 logger.info(f"Model path: {MODEL_PATH}")
 
 
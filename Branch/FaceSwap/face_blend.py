@@ -0,0 +1,156 @@
+import os
+import cv2
+import numpy as np
+
+# Padding around the pasted face, as a fraction of the face size in the frame
+FACE_ROI_PADDING = float(os.getenv('FACE_SWAP_ROI_PADDING', '0.25'))
+
+# Match the colour statistics of the swapped face to the target face
+COLOR_CORRECTION = os.getenv('FACE_SWAP_COLOR_CORRECTION', '0') == '1'
+
+# 'feather' blends with the mask of insightface's INSwapper; 'seamless' runs Poisson
+# blending (cv2.seamlessClone) before feathering
+BLEND_MODES = ('feather', 'seamless')
+BLEND_MODE = os.getenv('FACE_SWAP_BLEND_MODE', 'feather')
+
+# Face enhancer run on the pasted face ('' for none), as roop's face_enhancer does with GFPGAN
+FACE_ENHANCER = os.getenv('FACE_SWAP_ENHANCER', '')
+FACE_ENHANCER_MODEL = os.getenv('FACE_SWAP_ENHANCER_MODEL', os.path.join('models', 'GFPGANv1.4.pth'))
+
+
+def face_region(M, crop_size, frame_shape, padding=FACE_ROI_PADDING):
+    """
+    Returns the padded frame region (x0, y0, x1, y1) covered by an aligned face crop.
+
+    Args:
+        M (numpy.ndarray): Affine matrix mapping the frame to the crop.
+        crop_size (int): Size of the square crop.
+        frame_shape (tuple): Shape of the frame.
+        padding (float): Padding on every side, as a fraction of the face size.
+    """
+    IM = cv2.invertAffineTransform(M)
+    corners = cv2.transform(np.array([[[0, 0], [crop_size, 0], [0, crop_size], [crop_size, crop_size]]],
+                                     dtype=np.float32), IM)[0]
+    (x0, y0), (x1, y1) = corners.min(axis=0), corners.max(axis=0)
+    # The feathering blur needs a few pixels of margin even without padding
+    pad = int(np.sqrt((x1 - x0) * (y1 - y0)) * padding) + 8
+    height, width = frame_shape[:2]
+    return (max(int(x0) - pad, 0), max(int(y0) - pad, 0),
+            min(int(np.ceil(x1)) + pad, width), min(int(np.ceil(y1)) + pad, height))
+
+
+def color_transfer(bgr_fake, aimg):
+    """
+    Shifts the mean and spread of every Lab channel of the swapped crop to those of
+    the target crop, measured on the centre of the crops.
+    """
+    size = aimg.shape[0]
+    centre = slice(size // 4, size - size // 4)
+    fake_lab = cv2.cvtColor(bgr_fake, cv2.COLOR_BGR2LAB).astype(np.float32)
+    target_lab = cv2.cvtColor(aimg, cv2.COLOR_BGR2LAB).astype(np.float32)
+    fake_mean, fake_std = cv2.meanStdDev(fake_lab[centre, centre])
+    target_mean, target_std = cv2.meanStdDev(target_lab[centre, centre])
+    scale = (target_std / np.maximum(fake_std, 1e-3)).ravel()
+    fake_lab = (fake_lab - fake_mean.ravel()) * scale + target_mean.ravel()
+    return cv2.cvtColor(np.clip(fake_lab, 0, 255).astype(np.uint8), cv2.COLOR_LAB2BGR)
+
+
+class FaceEnhancer:
+    """
+    GFPGAN face restoration, run on the padded face region instead of the whole frame.
+
+    Args:
+        model_path (str): Path to the GFPGAN weights.
+    """
+
+    def __init__(self, model_path=FACE_ENHANCER_MODEL):
+        # Optional dependency, only needed when enhancement is enabled
+        import gfpgan
+        self.restorer = gfpgan.GFPGANer(model_path=model_path, upscale=1)
+
+    def enhance(self, region):
+        _, _, restored = self.restorer.enhance(region, has_aligned=False, only_center_face=True, paste_back=True)
+        return region if restored is None else restored
+
+
+class FaceBlender:
+    """
+    Pastes swapped face crops back into their frames. All the work (colour correction,
+    blending, enhancement) is done on the padded face region, which is written back
+    into the frame buffer in place, so its cost depends on the face size only and not
+    on the frame resolution.
+
+    With the defaults the result is the same as insightface's
+    INSwapper.get(paste_back=True).
+
+    Args:
+        color_correction (bool): Match the colours of the swapped face to the target.
+        blend_mode (str): One of BLEND_MODES.
+        enhancer (str): '' for no enhancement, or 'gfpgan'.
+
+    Raises:
+        ValueError: If the blend mode or the enhancer is not supported.
+    """
+
+    def __init__(self, color_correction=COLOR_CORRECTION, blend_mode=BLEND_MODE, enhancer=FACE_ENHANCER):
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(f"Unsupported blend mode '{blend_mode}', expected one of {BLEND_MODES}")
+        if enhancer not in ('', 'gfpgan'):
+            raise ValueError(f"Unsupported face enhancer '{enhancer}'")
+        self.color_correction = color_correction
+        self.blend_mode = blend_mode
+        self.enhancer = FaceEnhancer() if enhancer else None
+
+    def paste(self, frame, bgr_fake, aimg, M):
+        """
+        Blends a swapped crop into the frame, in place.
+
+        Args:
+            frame (numpy.ndarray): BGR frame the crop was taken from.
+            bgr_fake (numpy.ndarray): Swapped face crop.
+            aimg (numpy.ndarray): Aligned crop fed to the swapper.
+            M (numpy.ndarray): Affine matrix mapping the frame to the crop.
+
+        Returns:
+            numpy.ndarray: The frame.
+        """
+        x0, y0, x1, y1 = face_region(M, aimg.shape[0], frame.shape)
+        if x1 <= x0 or y1 <= y0:
+            return frame
+        if self.color_correction:
+            bgr_fake = color_transfer(bgr_fake, aimg)
+
+        # Inverse warp straight into the region rather than into a full-size frame
+        IM = cv2.invertAffineTransform(M)
+        IM[:, 2] -= (x0, y0)
+        region_size = (x1 - x0, y1 - y0)
+        region = frame[y0:y1, x0:x1]
+        img_white = np.full((aimg.shape[0], aimg.shape[1]), 255, dtype=np.float32)
+        bgr_fake = cv2.warpAffine(bgr_fake, IM, region_size, borderValue=0.0)
+        img_white = cv2.warpAffine(img_white, IM, region_size, borderValue=0.0)
+        img_white[img_white > 20] = 255
+        img_mask = img_white
+        mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+        if len(mask_h_inds) == 0:
+            return frame
+        mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+        mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+        mask_size = int(np.sqrt(mask_h * mask_w))
+        k = max(mask_size // 10, 10)
+        img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+
+        if self.blend_mode == 'seamless' and img_mask.any():
+            clone_mask = (img_mask > 0).astype(np.uint8) * 255
+            x, y, w, h = cv2.boundingRect(clone_mask)
+            bgr_fake = cv2.seamlessClone(bgr_fake, region, clone_mask, (x + w // 2, y + h // 2), cv2.NORMAL_CLONE)
+
+        k = max(mask_size // 20, 5)
+        img_mask = cv2.GaussianBlur(img_mask, (2 * k + 1, 2 * k + 1), 0)
+        img_mask /= 255
+        img_mask = np.reshape(img_mask, [img_mask.shape[0], img_mask.shape[1], 1])
+        fake_merged = img_mask * bgr_fake + (1 - img_mask) * region.astype(np.float32)
+        region[:] = fake_merged.astype(np.uint8)
+
+        if self.enhancer is not None:
+            region[:] = self.enhancer.enhance(region)
+        return frame
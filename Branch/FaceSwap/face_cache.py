@@ -0,0 +1,152 @@
+import os
+import glob
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from insightface.app.common import Face
+
+logger = logging.getLogger(__name__)
+
+# Number of analysed source faces kept in memory
+FACE_CACHE_MAX_ENTRIES = int(os.getenv('FACE_CACHE_MAX_ENTRIES', '128'))
+
+# Faces evicted from memory are spilled here, up to FACE_CACHE_MAX_DISK_ENTRIES files
+FACE_CACHE_DIR = os.getenv('FACE_CACHE_DIR', '/srv/cache/source_faces')
+FACE_CACHE_MAX_DISK_ENTRIES = int(os.getenv('FACE_CACHE_MAX_DISK_ENTRIES', '4096'))
+
+
+def image_digest(image_bytes):
+    """
+    Returns the SHA-256 hex digest of encoded image bytes.
+    """
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class SourceFaceCache:
+    """
+    Cache of source-face analysis results (bounding box, landmarks, embedding),
+    keyed by the hash of the source image bytes.
+
+    Faces live in an in-memory LRU; the least recently used face is spilled to
+    `spill_dir` when memory is full, and the spill directory itself is trimmed
+    least-recently-used first. A face found on disk is promoted back to memory.
+
+    Args:
+        max_entries (int): Number of faces kept in memory.
+        spill_dir (str): Directory faces evicted from memory are written to, or None to
+            drop them.
+        max_disk_entries (int): Number of faces kept in `spill_dir`.
+    """
+
+    def __init__(self, max_entries=FACE_CACHE_MAX_ENTRIES, spill_dir=FACE_CACHE_DIR,
+                 max_disk_entries=FACE_CACHE_MAX_DISK_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self.spill_dir = spill_dir
+        self.max_disk_entries = max_disk_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spills = 0
+        self._faces = OrderedDict()
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f'{key}.npz')
+
+    def get(self, key):
+        """
+        Returns the cached face of `key`, or None on a miss.
+        """
+        with self._lock:
+            face = self._faces.get(key)
+            if face is not None:
+                self._faces.move_to_end(key)
+                self.memory_hits += 1
+                return face
+
+            face = self._load(key)
+            if face is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, face)
+            return face
+
+    def put(self, key, face):
+        """
+        Caches the analysed face of the image with hash `key`.
+        """
+        with self._lock:
+            self._insert(key, face)
+
+    def _insert(self, key, face):
+        self._faces[key] = face
+        self._faces.move_to_end(key)
+        while len(self._faces) > self.max_entries:
+            evicted_key, evicted_face = self._faces.popitem(last=False)
+            self._spill(evicted_key, evicted_face)
+
+    def _spill(self, key, face):
+        if not self.spill_dir or os.path.exists(self._spill_path(key)):
+            return
+
+        # Keep the numeric fields only; derived properties such as normed_embedding are recomputed on load
+        fields = {name: np.asarray(value) for name, value in face.items()
+                  if isinstance(value, (np.ndarray, np.number, int, float))}
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.npz', dir=self.spill_dir)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as spill_file:
+                np.savez(spill_file, **fields)
+            os.replace(temp_path, self._spill_path(key))
+            self.spills += 1
+        except OSError as e:
+            logger.warning(f"Could not spill source face {key}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self._trim_disk()
+
+    def _load(self, key):
+        if not self.spill_dir:
+            return None
+        spill_path = self._spill_path(key)
+        try:
+            with np.load(spill_path) as fields:
+                face = Face({name: fields[name][()] if fields[name].ndim == 0 else fields[name] for name in fields.files})
+            os.utime(spill_path)
+            return face
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable spilled face {spill_path}: {e}")
+            os.remove(spill_path)
+            return None
+
+    def _trim_disk(self):
+        paths = glob.glob(os.path.join(self.spill_dir, '*.npz'))
+        if len(paths) <= self.max_disk_entries:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_disk_entries]:
+            os.remove(path)
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the number of cached faces.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else None,
+                'memory_entries': len(self._faces),
+                'disk_entries': len(glob.glob(os.path.join(self.spill_dir, '*.npz'))) if self.spill_dir else 0,
+                'spills': self.spills,
+            }
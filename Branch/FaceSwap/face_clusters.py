@@ -0,0 +1,217 @@
+import os
+import glob
+import hashlib
+import logging
+import tempfile
+import threading
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Largest squared distance between normed embeddings of the same identity, as roop's
+# --similar-face-distance
+FACE_CLUSTER_DISTANCE = float(os.getenv('FACE_CLUSTER_DISTANCE', '0.85'))
+
+# Faces are collected from every Nth frame of the target to cluster identities
+FACE_CLUSTER_SAMPLE_INTERVAL = int(os.getenv('FACE_CLUSTER_SAMPLE_INTERVAL', '5'))
+
+# Clustered identities of target videos, keyed by video content
+FACE_CLUSTER_CACHE_DIR = os.getenv('FACE_CLUSTER_CACHE_DIR', '/srv/cache/face_clusters')
+FACE_CLUSTER_CACHE_MAX_ENTRIES = int(os.getenv('FACE_CLUSTER_CACHE_MAX_ENTRIES', '1024'))
+
+
+class IdentityClusters:
+    """
+    Identities found in a target video: one normed centroid embedding per identity,
+    with the number of sampled faces and where the identity is first seen.
+
+    Identity ids are the cluster indexes, ordered from the most to the least frequent.
+
+    Args:
+        centroids (numpy.ndarray): Normed centroid embeddings, shape (identities, 512).
+        counts (numpy.ndarray): Number of sampled faces of every identity.
+        first_frames (numpy.ndarray): Frame where every identity is first seen.
+        bboxes (numpy.ndarray): Bounding box of every identity in its first frame.
+        distance (float): Largest squared embedding distance of a face to its identity.
+    """
+
+    def __init__(self, centroids, counts, first_frames, bboxes, distance=FACE_CLUSTER_DISTANCE):
+        self.centroids = centroids
+        self.counts = counts
+        self.first_frames = first_frames
+        self.bboxes = bboxes
+        self.distance = distance
+
+    def __len__(self):
+        return len(self.counts)
+
+    def match(self, embedding):
+        """
+        Returns the id of the identity of a normed embedding, or None if it matches no identity.
+        """
+        if not len(self):
+            return None
+        distances = np.sum((self.centroids - embedding) ** 2, axis=1)
+        identity = int(np.argmin(distances))
+        return identity if distances[identity] < self.distance else None
+
+    def to_list(self):
+        """
+        Returns the identities as JSON-serializable dicts.
+        """
+        return [{'identity': identity, 'faces': int(count), 'first_frame': int(first_frame),
+                 'bbox': [round(float(value), 1) for value in bbox]}
+                for identity, (count, first_frame, bbox) in enumerate(zip(self.counts, self.first_frames, self.bboxes))]
+
+
+def cluster_faces(samples, distance=FACE_CLUSTER_DISTANCE):
+    """
+    Groups sampled faces by identity: each face joins the closest identity within
+    `distance` of its embedding, or starts a new one.
+
+    Args:
+        samples (list): (frame index, bbox, normed embedding) of every sampled face, in frame order.
+        distance (float): Largest squared embedding distance within an identity.
+
+    Returns:
+        IdentityClusters: The identities, most frequent first.
+    """
+    sums, counts, first_frames, bboxes = [], [], [], []
+    for frame_index, bbox, embedding in samples:
+        if sums:
+            centroids = np.array(sums) / np.linalg.norm(sums, axis=1, keepdims=True)
+            distances = np.sum((centroids - embedding) ** 2, axis=1)
+            identity = int(np.argmin(distances))
+            if distances[identity] < distance:
+                sums[identity] = sums[identity] + embedding
+                counts[identity] += 1
+                continue
+        sums.append(np.array(embedding, dtype=np.float32))
+        counts.append(1)
+        first_frames.append(frame_index)
+        bboxes.append(bbox)
+
+    order = np.argsort(-np.array(counts, dtype=np.int64), kind='stable')
+    sums = np.array(sums, dtype=np.float32).reshape(-1, 512)[order]
+    centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-6)
+    return IdentityClusters(centroids, np.array(counts, dtype=np.int64)[order],
+                            np.array(first_frames, dtype=np.int64)[order],
+                            np.array(bboxes, dtype=np.float32).reshape(-1, 4)[order], distance)
+
+
+def sample_faces(target_path, face_analyser, sample_interval=FACE_CLUSTER_SAMPLE_INTERVAL):
+    """
+    Detects the faces of every `sample_interval`th frame of a video, or of an image.
+
+    Returns:
+        list: (frame index, bbox, normed embedding) of every detected face.
+    """
+    cap = cv2.VideoCapture(target_path)
+    samples = []
+    frame_index = 0
+    try:
+        while True:
+            ret = cap.grab()
+            if not ret:
+                break
+            if frame_index % sample_interval == 0:
+                _, frame = cap.retrieve()
+                for face in face_analyser.get(frame):
+                    samples.append((frame_index, face.bbox, face.normed_embedding))
+            frame_index += 1
+    finally:
+        cap.release()
+
+    # Still images are not always readable as a one-frame video
+    if frame_index == 0:
+        frame = cv2.imread(target_path)
+        if frame is None:
+            raise ValueError(f'Could not read target {target_path}')
+        samples = [(0, face.bbox, face.normed_embedding) for face in face_analyser.get(frame)]
+    return samples
+
+
+class ClusterCache:
+    """
+    Disk-backed cache of the identities of target videos, keyed by the content hash of
+    the video and the clustering parameters, so each video is clustered once.
+
+    Entries are evicted least-recently-used first past `max_entries`.
+
+    Args:
+        cache_dir (str): Directory holding the cached clusters.
+        max_entries (int): Number of videos kept.
+        sample_interval (int): Faces are sampled from every Nth frame.
+        distance (float): Largest squared embedding distance within an identity.
+    """
+
+    def __init__(self, cache_dir=FACE_CLUSTER_CACHE_DIR, max_entries=FACE_CLUSTER_CACHE_MAX_ENTRIES,
+                 sample_interval=FACE_CLUSTER_SAMPLE_INTERVAL, distance=FACE_CLUSTER_DISTANCE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.sample_interval = max(1, sample_interval)
+        self.distance = distance
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, target_path, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        with open(target_path, 'rb') as target_file:
+            for chunk in iter(lambda: target_file.read(chunk_size), b''):
+                digest.update(chunk)
+        digest.update(f'{self.sample_interval}:{self.distance}'.encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, target_path, face_analyser):
+        """
+        Returns the identities of a target, clustering its faces on a cache miss.
+        """
+        key = self.key(target_path)
+        entry_path = self._entry_path(key)
+        with self._lock:
+            if os.path.exists(entry_path):
+                self.hits += 1
+                os.utime(entry_path)
+                with np.load(entry_path) as entry:
+                    return IdentityClusters(entry['centroids'], entry['counts'], entry['first_frames'],
+                                            entry['bboxes'], self.distance)
+            self.misses += 1
+
+        clusters = cluster_faces(sample_faces(target_path, face_analyser, self.sample_interval), self.distance)
+        logger.info(f"Found {len(clusters)} identities in {target_path}")
+
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.npz', dir=self.cache_dir)
+        with os.fdopen(file_descriptor, 'wb') as entry_file:
+            np.savez(entry_file, centroids=clusters.centroids, counts=clusters.counts,
+                     first_frames=clusters.first_frames, bboxes=clusters.bboxes)
+        with self._lock:
+            os.replace(temp_path, entry_path)
+            self._evict()
+        return clusters
+
+    def _evict(self):
+        paths = glob.glob(os.path.join(self.cache_dir, '*.npz'))
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_entries]:
+            os.remove(path)
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the number of cached videos.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'entries': len(glob.glob(os.path.join(self.cache_dir, '*.npz'))),
+            }
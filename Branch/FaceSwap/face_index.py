@@ -0,0 +1,176 @@
+import os
+import struct
+import hashlib
+import logging
+import tempfile
+import cv2
+import numpy as np
+from insightface.app.common import Face
+from insightface.utils import face_align
+
+logger = logging.getLogger(__name__)
+
+# Directory of the stock target videos indexed ahead of time
+CATALOGUE_DIR = os.getenv('FACE_SWAP_CATALOGUE_DIR', '/srv/videos')
+
+INDEX_SUFFIX = '.faceidx'
+
+# Input size of inswapper_128, the alignment the stored affine matrices map faces to
+SWAPPER_INPUT_SIZE = 128
+
+_MAGIC = b'VLFACE02'
+
+# Indexes written before the header carried a content hash of the video
+_OLD_MAGICS = (b'VLFACE01',)
+
+# Bytes at the start of the video covered by the content hash of the header; they hold the
+# container header and the first frames, so a re-encoded or replaced video hashes differently
+_FINGERPRINT_BYTES = 1024 * 1024
+
+# magic, video size in bytes, SHA-256 of its first _FINGERPRINT_BYTES, frame count, width,
+# height, total number of faces
+_HEADER = struct.Struct('<8sQ32sIIII')
+
+# Per face: bbox (4), det_score (1), kps (5 x 2), affine matrix (2 x 3), as float32
+_RECORD_FLOATS = 4 + 1 + 10 + 6
+
+
+def index_path(video_path):
+    """
+    Returns the path of the face-track index stored next to a video.
+    """
+    return video_path + INDEX_SUFFIX
+
+
+class FaceTrackIndex:
+    """
+    Per-frame faces of a video, as detected once by the offline indexer.
+
+    The index file starts with a fixed header, which identifies the video by its size, a
+    SHA-256 of its first megabyte and its frame size, followed by the number of faces of every
+    frame (uint16) and one float32 record per face holding its bounding box, detection
+    score, five landmarks and the affine matrix aligning it to the inswapper input.
+
+    Args:
+        face_counts (numpy.ndarray): Number of faces of every frame.
+        records (numpy.ndarray): Face records, frame by frame, shape (faces, 21).
+    """
+
+    def __init__(self, face_counts, records):
+        self.face_counts = face_counts
+        self.records = records
+        self.offsets = np.concatenate(([0], np.cumsum(face_counts, dtype=np.int64)))
+
+    @property
+    def frame_count(self):
+        return len(self.face_counts)
+
+    def faces(self, frame_index):
+        """
+        Returns the faces of a frame as insightface Face objects; the affine matrix is
+        available as `face.matrix`.
+        """
+        faces = []
+        for record in self.records[self.offsets[frame_index]:self.offsets[frame_index + 1]]:
+            faces.append(Face(bbox=record[0:4], det_score=record[4], kps=record[5:15].reshape(5, 2),
+                              matrix=record[15:21].reshape(2, 3)))
+        return faces
+
+    @classmethod
+    def load(cls, video_path):
+        """
+        Loads the index of a video.
+
+        Returns:
+            FaceTrackIndex: The index, or None if the video has no index or the index was
+            built from a different file.
+        """
+        path = index_path(video_path)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as index_file:
+            data = index_file.read()
+
+        if data[:len(_MAGIC)] in _OLD_MAGICS:
+            logger.warning(f"Ignoring face-track index {path}: written by an older indexer, index the video again")
+            return None
+        try:
+            magic, video_size, fingerprint, frame_count, width, height, face_total = _HEADER.unpack_from(data)
+        except struct.error:
+            magic = None
+        if magic != _MAGIC:
+            logger.warning(f"Ignoring face-track index {path}: not a face-track index")
+            return None
+        if video_size != os.path.getsize(video_path) or fingerprint != _video_fingerprint(video_path) \
+                or (width, height) != _frame_size(video_path):
+            logger.warning(f"Ignoring stale face-track index {path}: the video changed since it was indexed")
+            return None
+
+        counts_offset = _HEADER.size
+        records_offset = counts_offset + frame_count * 2
+        face_counts = np.frombuffer(data, dtype='<u2', count=frame_count, offset=counts_offset)
+        records = np.frombuffer(data, dtype='<f4', count=face_total * _RECORD_FLOATS, offset=records_offset)
+        return cls(face_counts, records.reshape(face_total, _RECORD_FLOATS))
+
+
+def _video_fingerprint(video_path):
+    with open(video_path, 'rb') as video_file:
+        return hashlib.sha256(video_file.read(_FINGERPRINT_BYTES)).digest()
+
+
+def _frame_size(video_path):
+    cap = cv2.VideoCapture(video_path)
+    frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+    return frame_size
+
+
+def build_index(video_path, face_analyser):
+    """
+    Detects the faces of every frame of a video and writes its face-track index.
+
+    Args:
+        video_path (str): Path to the video.
+        face_analyser (insightface.app.FaceAnalysis): Prepared face analyser.
+
+    Returns:
+        str: Path to the written index.
+
+    Raises:
+        ValueError: If the video cannot be opened.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f'Could not open video {video_path}')
+    frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    face_counts, records = [], []
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            faces = face_analyser.get(frame)
+            face_counts.append(len(faces))
+            for face in faces:
+                matrix = face_align.estimate_norm(face.kps, SWAPPER_INPUT_SIZE)
+                records.append(np.concatenate((face.bbox, [face.det_score], face.kps.ravel(), matrix.ravel())))
+    finally:
+        cap.release()
+
+    header = _HEADER.pack(_MAGIC, os.path.getsize(video_path), _video_fingerprint(video_path), len(face_counts),
+                          frame_size[0], frame_size[1], len(records))
+    face_counts = np.asarray(face_counts, dtype='<u2')
+    records = np.asarray(records, dtype='<f4').reshape(-1, _RECORD_FLOATS)
+
+    # Write next to the video and rename, so the engine never loads a partial index
+    path = index_path(video_path)
+    file_descriptor, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(file_descriptor, 'wb') as index_file:
+        index_file.write(header)
+        index_file.write(face_counts.tobytes())
+        index_file.write(records.tobytes())
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+    logger.info(f"Indexed {len(face_counts)} frames, {len(records)} faces of {video_path}")
+    return path
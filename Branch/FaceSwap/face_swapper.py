@@ -1,46 +1,34 @@
-import onnxruntime as ort
-import cv2
-import subprocess
-import os
 import logging
+from swap_engine import DETECT_INTERVAL, get_engine
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class FaceSwapper:
+    """
+    Swaps the face of a source image into a target video or image.
+
+    Runs in-process on the shared FaceSwapEngine, which keeps the face analyser and
+    the inswapper session loaded across calls, instead of spawning roop's run.py
+    (and reloading every model) for each request.
+
+    Args:
+        model_path (str): Path to inswapper_128.onnx.
+        roop_directory (str): Location of the roop checkout; kept for compatibility,
+            roop is no longer invoked as a subprocess.
+    """
+
     def __init__(self, model_path, roop_directory='roop'):
-        # Initialize ONNX model session
-        self.session = ort.InferenceSession(model_path)
+        # Load the detector, embedder and inswapper session once
+        self.engine = get_engine(model_path)
+        self.engine.warm_up()
         self.roop_directory = roop_directory
 
-    def run_external_command(self, target_path, source_path, output_path):
-        # Change to the Roop directory
-        original_directory = os.getcwd()
-        os.chdir(self.roop_directory)
-        
-        # Define the command to run
-        command = [
-            "python", "run.py",
-            "--target", target_path,
-            "--source", source_path,
-            "-o", output_path,
-            "--execution-provider", "cuda",
-            "--frame-processor", "face_swapper"
-        ]
-        
-        try:
-            # Run the command
-            logger.info(f"Running command: {' '.join(command)}")
-            subprocess.run(command, check=True)
-            logger.info("Face swapping completed successfully.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Command failed with error: {e}")
-            raise
-        finally:
-            # Return to the original directory
-            os.chdir(original_directory)
+    def swap_faces(self, target_path, source_path, output_path, detect_interval=DETECT_INTERVAL,
+                   progress_callback=None, face_mapping=None):
+        return self.engine.swap_faces(target_path, source_path, output_path, detect_interval, progress_callback,
+                                      face_mapping)
 
-    def swap_faces(self, target_path, source_path, output_path):
-        # Example: Using the external command (Roop face swapper)
-        self.run_external_command(target_path, source_path, output_path)
+    def get_identities(self, target_path):
+        return self.engine.get_identities(target_path)
@@ -0,0 +1,120 @@
+import os
+import cv2
+import numpy as np
+from insightface.app.common import Face
+
+# Run the face detector on every Nth frame and track the landmarks in between;
+# 1 detects on every frame
+DETECT_INTERVAL = int(os.getenv('FACE_SWAP_DETECT_INTERVAL', '1'))
+
+# Largest forward-backward optical flow error, in pixels, of a tracked landmark before
+# the tracker falls back to the detector
+TRACK_MAX_ERROR = float(os.getenv('FACE_SWAP_TRACK_MAX_ERROR', '2.0'))
+
+# Mean absolute difference (0-255) between consecutive grayscale frames above which the
+# frame is treated as a cut and detected again
+TRACK_MAX_FRAME_DIFF = float(os.getenv('FACE_SWAP_TRACK_MAX_FRAME_DIFF', '30'))
+
+_FLOW_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+
+class FaceTracker:
+    """
+    Faces of consecutive video frames, detected every `detect_interval` frames and
+    propagated in between by tracking the five landmarks with pyramidal Lucas-Kanade
+    optical flow; the bounding box follows the similarity transform of the landmarks.
+
+    Tracking is checked by running the flow backwards: when a landmark is lost or does
+    not return within `max_error` pixels of where it started, the frame is detected
+    again. Frames following a faceless frame, and frames that differ sharply from the
+    previous one (cuts), are always detected, so a face coming back after a cutaway is
+    swapped from its first frame.
+
+    Args:
+        face_analyser (insightface.app.FaceAnalysis): Prepared face analyser.
+        detect_interval (int): Number of frames between two detector runs.
+        max_error (float): Largest forward-backward error of a tracked landmark.
+        max_frame_diff (float): Largest mean absolute difference between consecutive
+            frames that are tracked rather than detected.
+    """
+
+    def __init__(self, face_analyser, detect_interval=DETECT_INTERVAL, max_error=TRACK_MAX_ERROR,
+                 max_frame_diff=TRACK_MAX_FRAME_DIFF):
+        self.face_analyser = face_analyser
+        self.detect_interval = max(1, detect_interval)
+        self.max_error = max_error
+        self.max_frame_diff = max_frame_diff
+        self.detector_runs = 0
+        self.tracked_frames = 0
+        self._previous_gray = None
+        self._faces = None
+        self._frames_since_detection = 0
+
+    def get(self, frame):
+        """
+        Returns the faces of the next frame of the video.
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if self.detect_interval > 1 else None
+        faces = None
+        if self._faces is not None and self._frames_since_detection < self.detect_interval:
+            faces = self._track(gray)
+
+        if faces is None:
+            faces = self.face_analyser.get(frame)
+            self.detector_runs += 1
+            self._frames_since_detection = 0
+        else:
+            self.tracked_frames += 1
+        self._frames_since_detection += 1
+        self._previous_gray = gray
+        self._faces = faces
+        return faces
+
+    def _track(self, gray):
+        """
+        Moves the faces of the previous frame to `gray`, or returns None when the
+        landmarks cannot be tracked reliably.
+        """
+        # Nothing to track after a faceless frame: a face may appear on any frame
+        if not self._faces:
+            return None
+
+        # A cut moves the whole frame; optical flow would latch onto the new content
+        if cv2.norm(gray, self._previous_gray, cv2.NORM_L1) / gray.size > self.max_frame_diff:
+            return None
+
+        points = np.concatenate([face.kps for face in self._faces]).astype(np.float32).reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self._previous_gray, gray, points, None, **_FLOW_PARAMS)
+        if next_points is None or not status.all():
+            return None
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self._previous_gray, next_points, None, **_FLOW_PARAMS)
+        if back_points is None or not back_status.all():
+            return None
+        if np.linalg.norm(points - back_points, axis=2).max() > self.max_error:
+            return None
+
+        faces = []
+        for face, kps in zip(self._faces, next_points.reshape(len(self._faces), 5, 2)):
+            M, _ = cv2.estimateAffinePartial2D(face.kps.astype(np.float32), kps, method=cv2.LMEDS)
+            if M is None:
+                return None
+            x1, y1, x2, y2 = face.bbox
+            corners = cv2.transform(np.array([[[x1, y1], [x2, y1], [x1, y2], [x2, y2]]], dtype=np.float32), M)[0]
+            tracked_face = Face(face)
+            tracked_face.bbox = np.concatenate((corners.min(axis=0), corners.max(axis=0))).astype(np.float32)
+            tracked_face.kps = kps
+            faces.append(tracked_face)
+        return faces
+
+    def stats(self):
+        """
+        Returns how many frames were detected and tracked.
+        """
+        frames = self.detector_runs + self.tracked_frames
+        return {
+            'detect_interval': self.detect_interval,
+            'detector_runs': self.detector_runs,
+            'tracked_frames': self.tracked_frames,
+            'detector_run_rate': round(self.detector_runs / frames, 3) if frames else None,
+        }
@@ -0,0 +1,43 @@
+import argparse
+import os
+from insightface.app import FaceAnalysis
+from face_index import CATALOGUE_DIR, FaceTrackIndex, build_index
+from swap_engine import DETECTION_SIZE, EXECUTION_PROVIDER, FACE_ANALYSER_MODEL, get_execution_providers
+
+
+"""
+
+Offline indexer of the stock target videos: detects the faces of every frame once and
+stores them in a face-track index next to each video, so swaps on catalogue videos
+skip face detection. Videos with an up-to-date index are skipped.
+
+    python index_videos.py --catalogue /srv/videos
+
+"""
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+
+
+def index_catalogue(catalogue_dir, execution_provider, force=False):
+    face_analyser = FaceAnalysis(name=FACE_ANALYSER_MODEL, providers=get_execution_providers(execution_provider))
+    face_analyser.prepare(ctx_id=0, det_size=DETECTION_SIZE)
+
+    for name in sorted(os.listdir(catalogue_dir)):
+        video_path = os.path.join(catalogue_dir, name)
+        if not name.lower().endswith(VIDEO_EXTENSIONS):
+            continue
+        if not force and FaceTrackIndex.load(video_path) is not None:
+            print(f"Up to date: {video_path}")
+            continue
+        print(f"Indexing {video_path}")
+        build_index(video_path, face_analyser)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build face-track indexes of the stock target videos.")
+    parser.add_argument('--catalogue', default=CATALOGUE_DIR)
+    parser.add_argument('--execution-provider', default=EXECUTION_PROVIDER)
+    parser.add_argument('--force', action='store_true', help="Rebuild indexes that are up to date")
+    args = parser.parse_args()
+
+    index_catalogue(args.catalogue, args.execution_provider, args.force)
@@ -0,0 +1,182 @@
+import os
+import hashlib
+import logging
+import tempfile
+import onnx
+import onnxruntime as ort
+
+logger = logging.getLogger(__name__)
+
+# Graph optimizations applied when the session is created
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disabled': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+ORT_GRAPH_OPTIMIZATION = os.getenv('FACE_SWAP_ORT_GRAPH_OPTIMIZATION', 'all')
+
+# ONNX Runtime thread counts, 0 lets ONNX Runtime decide; inter-op threads only run
+# independent nodes in parallel when there is more than one
+ORT_INTRA_OP_THREADS = int(os.getenv('FACE_SWAP_ORT_INTRA_OP_THREADS', '0'))
+ORT_INTER_OP_THREADS = int(os.getenv('FACE_SWAP_ORT_INTER_OP_THREADS', '0'))
+
+# Memory arena of the CPU provider, buffer reuse across runs of the same shapes, and how
+# the CUDA arena grows ('kNextPowerOfTwo' or 'kSameAsRequested', which wastes less memory)
+ORT_ENABLE_CPU_MEM_ARENA = os.getenv('FACE_SWAP_ORT_CPU_MEM_ARENA', '1') == '1'
+ORT_ENABLE_MEM_PATTERN = os.getenv('FACE_SWAP_ORT_MEM_PATTERN', '1') == '1'
+ORT_ARENA_EXTEND_STRATEGY = os.getenv('FACE_SWAP_ORT_ARENA_EXTEND_STRATEGY', 'kNextPowerOfTwo')
+
+# Weights of the loaded model variant: 'fp16' halves them (mostly worth it on GPUs),
+# 'int8' quantizes them dynamically (CPU)
+MODEL_PRECISIONS = ('fp32', 'fp16', 'int8')
+MODEL_PRECISION = os.getenv('FACE_SWAP_MODEL_PRECISION', 'fp32')
+
+# Optimized graphs saved by ONNX Runtime, loaded as-is by later starts ('' disables the cache)
+OPTIMIZED_MODEL_DIR = os.getenv('FACE_SWAP_OPTIMIZED_MODEL_DIR', '/srv/cache/optimized_models')
+
+
+def convert_precision(model, precision):
+    """
+    Returns the model with its weights converted to `precision`; inputs and outputs stay
+    float32 so callers feed the same tensors to every variant.
+    """
+    if precision == 'fp32':
+        return model
+    if precision == 'fp16':
+        from onnxruntime.transformers.float16 import convert_float_to_float16
+        return convert_float_to_float16(model, keep_io_types=True)
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    with tempfile.TemporaryDirectory() as temp_dir:
+        quantized_path = os.path.join(temp_dir, 'model_int8.onnx')
+        quantize_dynamic(model, quantized_path, weight_type=QuantType.QInt8)
+        return onnx.load(quantized_path)
+
+
+class SessionFactory:
+    """
+    Creates tuned ONNX Runtime sessions: graph optimization level, thread counts, memory
+    arena options and the precision of the model weights.
+
+    The first session of a model/configuration saves its optimized graph (after any
+    preparation and precision conversion) through `optimized_model_filepath`; later
+    sessions load that graph with graph optimizations disabled, skipping both the
+    conversion and the optimization passes at startup.
+
+    Args:
+        graph_optimization (str): One of GRAPH_OPTIMIZATION_LEVELS.
+        intra_op_threads (int): Intra-op thread count, 0 for the default.
+        inter_op_threads (int): Inter-op thread count, 0 for the default.
+        enable_cpu_mem_arena (bool): Use the memory arena of the CPU provider.
+        enable_mem_pattern (bool): Pre-plan buffers from the shapes of previous runs.
+        arena_extend_strategy (str): How the CUDA memory arena grows.
+        precision (str): One of MODEL_PRECISIONS.
+        cache_dir (str): Directory of the optimized graphs, '' to disable the cache.
+
+    Raises:
+        ValueError: If the optimization level or the precision is not supported.
+    """
+
+    def __init__(self, graph_optimization=ORT_GRAPH_OPTIMIZATION, intra_op_threads=ORT_INTRA_OP_THREADS,
+                 inter_op_threads=ORT_INTER_OP_THREADS, enable_cpu_mem_arena=ORT_ENABLE_CPU_MEM_ARENA,
+                 enable_mem_pattern=ORT_ENABLE_MEM_PATTERN, arena_extend_strategy=ORT_ARENA_EXTEND_STRATEGY,
+                 precision=MODEL_PRECISION, cache_dir=OPTIMIZED_MODEL_DIR):
+        if graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"Unsupported graph optimization '{graph_optimization}', "
+                             f"expected one of {tuple(GRAPH_OPTIMIZATION_LEVELS)}")
+        if precision not in MODEL_PRECISIONS:
+            raise ValueError(f"Unsupported model precision '{precision}', expected one of {MODEL_PRECISIONS}")
+        self.graph_optimization = graph_optimization
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.enable_cpu_mem_arena = enable_cpu_mem_arena
+        self.enable_mem_pattern = enable_mem_pattern
+        self.arena_extend_strategy = arena_extend_strategy
+        self.precision = precision
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def session_options(self, graph_optimization=None):
+        sess_opts = ort.SessionOptions()
+        sess_opts.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization or self.graph_optimization]
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = self.inter_op_threads
+        if self.inter_op_threads > 1:
+            sess_opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        sess_opts.enable_cpu_mem_arena = self.enable_cpu_mem_arena
+        sess_opts.enable_mem_pattern = self.enable_mem_pattern
+        return sess_opts
+
+    def provider_options(self, providers):
+        """
+        Returns the providers with their arena options, as accepted by InferenceSession.
+        """
+        return [(provider, {'arena_extend_strategy': self.arena_extend_strategy})
+                if provider == 'CUDAExecutionProvider' else provider for provider in providers]
+
+    def cache_path(self, model_path, providers, suffix='.onnx'):
+        """
+        Returns the cache file of a model under this configuration, or None without a cache.
+
+        The key covers the model file (path, size, modification time), the precision, the
+        optimization level, the providers and the ONNX Runtime version, since saved graphs
+        may hold provider- and version-specific nodes.
+        """
+        if not self.cache_dir:
+            return None
+        model_stat = os.stat(model_path)
+        key = '|'.join([os.path.abspath(model_path), str(model_stat.st_size), str(model_stat.st_mtime_ns),
+                        self.precision, self.graph_optimization, ','.join(providers), ort.__version__])
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        return os.path.join(self.cache_dir, f'{name}-{self.precision}-{hashlib.sha256(key.encode()).hexdigest()[:16]}{suffix}')
+
+    def create(self, model_path, providers, prepare=None):
+        """
+        Creates a session of a model, from its cached optimized graph when there is one.
+
+        Args:
+            model_path (str): Path to the ONNX model.
+            providers (list): ONNX Runtime execution providers.
+            prepare (callable, optional): Called with the loaded onnx.ModelProto before the
+                precision conversion, returning the model to run; skipped on a cache hit.
+
+        Returns:
+            onnxruntime.InferenceSession: The session.
+        """
+        provider_options = self.provider_options(providers)
+        optimized_path = self.cache_path(model_path, providers)
+        if optimized_path and os.path.exists(optimized_path):
+            logger.info(f"Loading the optimized graph of {model_path} from {optimized_path}")
+            return ort.InferenceSession(optimized_path, sess_options=self.session_options('disabled'),
+                                        providers=provider_options)
+
+        model = onnx.load(model_path)
+        if prepare is not None:
+            model = prepare(model)
+        model = convert_precision(model, self.precision)
+        serialized_model = model.SerializeToString()
+        if not optimized_path:
+            return ort.InferenceSession(serialized_model, sess_options=self.session_options(),
+                                        providers=provider_options)
+
+        # ONNX Runtime writes the optimized graph while creating the session; it is moved into
+        # place afterwards so concurrent starts never load a partial file
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.onnx', dir=self.cache_dir)
+        os.close(file_descriptor)
+        sess_opts = self.session_options()
+        sess_opts.optimized_model_filepath = temp_path
+        try:
+            session = ort.InferenceSession(serialized_model, sess_options=sess_opts, providers=provider_options)
+            os.replace(temp_path, optimized_path)
+            logger.info(f"Saved the optimized graph of {model_path} to {optimized_path}")
+        except Exception as e:
+            # Some providers (e.g. TensorRT) compile nodes that cannot be saved
+            logger.warning(f"Could not save the optimized graph of {model_path}: {e}")
+            session = ort.InferenceSession(serialized_model, sess_options=self.session_options(),
+                                           providers=provider_options)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return session
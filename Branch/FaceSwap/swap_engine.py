@@ -0,0 +1,371 @@
+import os
+import shutil
+import logging
+import threading
+import subprocess
+import tempfile
+import cv2
+import numpy as np
+import onnxruntime as ort
+from insightface.app import FaceAnalysis
+from tqdm import tqdm
+from face_cache import SourceFaceCache, image_digest
+from face_index import FaceTrackIndex
+from batched_swapper import SWAP_BATCH_SIZE, BatchedSwapper
+from face_tracker import DETECT_INTERVAL, FaceTracker
+from face_clusters import ClusterCache
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Execution provider, as in roop's --execution-provider (cuda, cpu, ...)
+EXECUTION_PROVIDER = os.getenv('FACE_SWAP_EXECUTION_PROVIDER', 'cuda')
+
+# Face analyser model pack and detector input size used by roop
+FACE_ANALYSER_MODEL = 'buffalo_l'
+DETECTION_SIZE = (640, 640)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+
+def get_execution_providers(execution_provider=EXECUTION_PROVIDER):
+    """
+    Maps a short provider name such as 'cuda' to the available ONNX Runtime providers,
+    always keeping the CPU provider as a fallback.
+    """
+    available = ort.get_available_providers()
+    providers = [provider for provider in available
+                 if provider.lower().replace('executionprovider', '') == execution_provider.lower()]
+    if 'CPUExecutionProvider' not in providers:
+        providers.append('CPUExecutionProvider')
+    return providers
+
+
+class FaceSwapEngine:
+    """
+    In-process face swapper that keeps the face detector, the embedder and the
+    inswapper session loaded across requests, so a swap does not pay any model
+    loading cost.
+
+    Matches the behaviour of roop's face_swapper frame processor: the left-most face
+    of the source image replaces the left-most face of every target frame.
+
+    Args:
+        model_path (str): Path to inswapper_128.onnx.
+        execution_provider (str): Short name of the ONNX Runtime provider, e.g. 'cuda' or 'cpu'.
+        face_cache (SourceFaceCache, optional): Cache of analysed source faces; a default
+            cache is created if omitted.
+        batch_size (int): Number of frames whose face crops go through inswapper in one
+            session run.
+        cluster_cache (ClusterCache, optional): Cache of the identities of target videos;
+            a default cache is created if omitted.
+        session_factory (SessionFactory, optional): ONNX Runtime options of the inswapper
+            session; configured from the environment if omitted.
+    """
+
+    def __init__(self, model_path, execution_provider=EXECUTION_PROVIDER, face_cache=None,
+                 batch_size=SWAP_BATCH_SIZE, cluster_cache=None, session_factory=None):
+        self.model_path = model_path
+        self.providers = get_execution_providers(execution_provider)
+        self.face_cache = face_cache or SourceFaceCache()
+        self.cluster_cache = cluster_cache or ClusterCache()
+
+        # Detector and embedder (ArcFace) of the buffalo_l pack
+        self.face_analyser = FaceAnalysis(name=FACE_ANALYSER_MODEL, providers=self.providers)
+        self.face_analyser.prepare(ctx_id=0, det_size=DETECTION_SIZE)
+
+        # inswapper session, loaded once and run on batches of face crops
+        self.swapper = BatchedSwapper(model_path, self.providers, batch_size, session_factory=session_factory)
+        logger.info(f"Face swap engine loaded {model_path} with providers {self.providers}")
+
+    def warm_up(self):
+        """
+        Runs the detector once so the first request does not pay session initialisation.
+        """
+        self.face_analyser.get(np.zeros((DETECTION_SIZE[1], DETECTION_SIZE[0], 3), dtype=np.uint8))
+
+    def get_one_face(self, frame):
+        """
+        Returns the left-most face of a frame, or None if there is no face.
+        """
+        faces = self.face_analyser.get(frame)
+        if not faces:
+            return None
+        return min(faces, key=lambda face: face.bbox[0])
+
+    def get_source_face(self, source_path):
+        """
+        Detects the face to paste from the source image. Results are cached by the hash
+        of the image bytes, so a portrait used again skips detection and embedding.
+
+        Raises:
+            ValueError: If the image cannot be read or contains no face.
+        """
+        with open(source_path, 'rb') as source_file:
+            image_bytes = source_file.read()
+        key = image_digest(image_bytes)
+        source_face = self.face_cache.get(key)
+        if source_face is not None:
+            return source_face
+
+        source_image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if source_image is None:
+            raise ValueError(f'Could not read source image {source_path}')
+        source_face = self.get_one_face(source_image)
+        if source_face is None:
+            raise ValueError(f'No face found in source image {source_path}')
+        self.face_cache.put(key, source_face)
+        return source_face
+
+    def swap_frame(self, frame, source_face, target_faces=None):
+        """
+        Swaps the left-most face of a frame with the source face; frames without a face
+        are returned unchanged.
+
+        Args:
+            frame (numpy.ndarray): BGR frame.
+            source_face (Face): Face to paste.
+            target_faces (list, optional): Faces of the frame from a face-track index;
+                detected when omitted.
+        """
+        return self.swap_frames([frame], self.swapper.source_latent(source_face), [target_faces])[0]
+
+    def swap_frames(self, frames, source_latent, target_faces=None, face_mapping=None):
+        """
+        Swaps the left-most face of every frame, running inswapper on the crops of all
+        frames in batches. The face regions are written into the frames in place.
+
+        Args:
+            frames (list): BGR frames.
+            source_latent (numpy.ndarray): Source embedding in the swapper's latent space.
+            target_faces (list, optional): Faces of each frame from a face-track index, or
+                None for frames whose faces must be detected.
+            face_mapping (tuple, optional): (IdentityClusters, {identity: source latent}); when
+                given, every face of a mapped identity is swapped with its own source instead.
+        """
+        return self.swapper.swap(list(frames), self._plan_swaps(frames, source_latent, target_faces, face_mapping))
+
+    def _plan_swaps(self, frames, source_latent, target_faces, face_mapping):
+        # (frame index, target face, source latent) of every face to swap, see swap_frames()
+        target_faces = target_faces or [None] * len(frames)
+        swaps = []
+        for frame_index, (frame, faces) in enumerate(zip(frames, target_faces)):
+            if faces is None:
+                faces = self.face_analyser.get(frame)
+            if not faces:
+                continue
+            if face_mapping is None:
+                swaps.append((frame_index, min(faces, key=lambda face: face.bbox[0]), source_latent))
+                continue
+            clusters, latents = face_mapping
+            for face in faces:
+                identity = clusters.match(self.get_embedding(frame, face))
+                if identity in latents:
+                    swaps.append((frame_index, face, latents[identity]))
+        return swaps
+
+    def get_embedding(self, frame, face):
+        """
+        Returns the normed embedding of a face, computing it with the recognition model
+        for faces that only carry landmarks (e.g. from a face-track index).
+        """
+        if face.embedding is None:
+            self.face_analyser.models['recognition'].get(frame, face)
+        return face.normed_embedding
+
+    def get_identities(self, target_path):
+        """
+        Returns the identities of a target, clustered by face embedding once per video.
+        """
+        return self.cluster_cache.get(target_path, self.face_analyser)
+
+    def _source_latents(self, target_path, source_path, face_mapping):
+        # Either one source for the left-most face, or a source per identity of the target
+        if not face_mapping:
+            return self.swapper.source_latent(self.get_source_face(source_path)), None
+        clusters = self.get_identities(target_path)
+        latents = {}
+        for identity, mapped_source_path in face_mapping.items():
+            if not 0 <= int(identity) < len(clusters):
+                raise ValueError(f'Unknown identity {identity}; the target has {len(clusters)} identities')
+            latents[int(identity)] = self.swapper.source_latent(self.get_source_face(mapped_source_path))
+        return None, (clusters, latents)
+
+    def swap_image(self, target_path, source_path, output_path, face_mapping=None):
+        source_latent, face_mapping = self._source_latents(target_path, source_path, face_mapping)
+        frame = cv2.imread(target_path)
+        if frame is None:
+            raise ValueError(f'Could not read target image {target_path}')
+        target_faces = self.face_analyser.get(frame)
+        swaps = self._plan_swaps([frame], source_latent, [target_faces], face_mapping)
+        cv2.imwrite(output_path, self.swapper.swap([frame], swaps)[0])
+        return {'frames': 1, 'indexed_frames': 0, 'detector_runs': 1, 'tracked_frames': 0, 'detector_run_rate': 1.0,
+                'swapped_frames': int(bool(swaps)), 'faceless_frames': int(not target_faces), 'duplicate_frames': 0}
+
+    def swap_video(self, target_path, source_path, output_path, detect_interval=DETECT_INTERVAL,
+                   progress_callback=None, face_mapping=None):
+        """
+        Swaps faces frame by frame, streaming the frames from the target video to the
+        output without extracting them to disk, then restores the target's audio.
+
+        Face detection is skipped when the target has a face-track index (see
+        index_videos.py). Otherwise faces are detected every `detect_interval` frames
+        and tracked in between.
+
+        Frames without a face go straight to the writer, and a frame identical to the
+        previous one reuses its output; neither runs inswapper.
+
+        `progress_callback(frames_done, total_frames)` is called after every batch. With a
+        `face_mapping`, every mapped identity is swapped with its own source in the same pass.
+
+        Returns:
+            dict: Number of frames, of frames read from the index, of detector runs, of
+            tracked frames, of frames where at least one face was swapped, and of faceless
+            and duplicate frames that were skipped.
+        """
+        tracker = FaceTracker(self.face_analyser, detect_interval)
+        source_latent, face_mapping = self._source_latents(target_path, source_path, face_mapping)
+        face_index = FaceTrackIndex.load(target_path)
+        if face_index is not None:
+            logger.info(f"Using the face-track index of {target_path}")
+        cap = cv2.VideoCapture(target_path)
+        if not cap.isOpened():
+            raise ValueError(f'Could not open target video {target_path}')
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+        # Write the video stream next to the output, then mux the original audio into the output
+        file_descriptor, temp_video_path = tempfile.mkstemp(suffix='.mp4', dir=os.path.dirname(output_path))
+        os.close(file_descriptor)
+        video_writer = cv2.VideoWriter(temp_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, frame_size)
+        frame_index = indexed_frames = faceless_frames = duplicate_frames = swapped_frames = 0
+        previous_frame = previous_output = None
+        try:
+            with tqdm(total=frame_count, desc="Swapping faces") as progress:
+                while True:
+                    # Read a batch of frames, so their face crops share session runs; every
+                    # frame read is written as the output of the distinct frame in `outputs`,
+                    # or of the previous batch's last frame (-1)
+                    frames, target_faces, outputs = [], [], []
+                    while len(outputs) < self.swapper.batch_size:
+                        ret, frame = cap.read()
+                        if not ret:
+                            break
+                        frame_index += 1
+                        if previous_frame is not None and cv2.norm(frame, previous_frame, cv2.NORM_INF) == 0:
+                            duplicate_frames += 1
+                            outputs.append(outputs[-1] if outputs else -1)
+                            continue
+                        previous_frame = frame
+
+                        if face_index is not None and frame_index <= face_index.frame_count:
+                            faces = face_index.faces(frame_index - 1)
+                            indexed_frames += 1
+                        else:
+                            faces = tracker.get(frame)
+                        if not faces:
+                            faceless_frames += 1
+                        frames.append(frame)
+                        target_faces.append(faces)
+                        outputs.append(len(frames) - 1)
+                    if not outputs:
+                        break
+
+                    # Faces are pasted into the decoded frames in place; keep the last one intact
+                    # for the duplicate check of the next batch
+                    if frames:
+                        previous_frame = frames[-1].copy()
+                    # With a face mapping, a frame may only hold faces of unmapped identities
+                    swaps = self._plan_swaps(frames, source_latent, target_faces, face_mapping)
+                    swapped_frames += len({swap[0] for swap in swaps})
+                    frames = self.swapper.swap(frames, swaps)
+                    for output in outputs:
+                        if output >= 0:
+                            previous_output = frames[output]
+                        video_writer.write(previous_output)
+                    progress.update(len(outputs))
+                    if progress_callback:
+                        progress_callback(frame_index, frame_count)
+        finally:
+            cap.release()
+            video_writer.release()
+        restore_audio(target_path, temp_video_path, output_path)
+
+        stats = tracker.stats()
+        stats.update(frames=frame_index, indexed_frames=indexed_frames,
+                     detector_run_rate=round(stats['detector_runs'] / frame_index, 3) if frame_index else None,
+                     swapped_frames=swapped_frames,
+                     faceless_frames=faceless_frames, duplicate_frames=duplicate_frames)
+        return stats
+
+    def swap_faces(self, target_path, source_path, output_path, detect_interval=DETECT_INTERVAL,
+                   progress_callback=None, face_mapping=None):
+        """
+        Swaps the face of the source image into the target video or image, or, with a face
+        mapping, the face of every mapped target identity with its own source image.
+
+        Args:
+            target_path (str): Path to the target video or image.
+            source_path (str): Path to the source face image; unused with a face mapping.
+            output_path (str): Path where the result is written.
+            detect_interval (int): Number of video frames between two face detector runs;
+                faces are tracked in between.
+            progress_callback (callable, optional): Called as progress_callback(frames_done,
+                total_frames) while a video is swapped.
+            face_mapping (dict, optional): Source image path of each target identity id, as
+                listed by get_identities().
+
+        Returns:
+            dict: Frame statistics, including how often the face detector ran.
+
+        Raises:
+            ValueError: If an input cannot be read, a source image has no face or a mapped
+                identity does not exist.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        logger.info(f"Swapping face of {face_mapping or source_path} into {target_path}")
+        if target_path.lower().endswith(IMAGE_EXTENSIONS):
+            stats = self.swap_image(target_path, source_path, output_path, face_mapping)
+        else:
+            stats = self.swap_video(target_path, source_path, output_path, detect_interval, progress_callback,
+                                    face_mapping)
+        logger.info(f"Face swapping completed: {output_path} ({stats['detector_runs']} detector runs "
+                    f"for {stats['frames']} frames)")
+        return stats
+
+
+def restore_audio(target_path, video_path, output_path):
+    """
+    Muxes the audio of the target into the swapped video, re-encoding the video to
+    H.264; the video is used as is when ffmpeg is missing or fails.
+    """
+    if shutil.which('ffmpeg'):
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error", "-i", video_path, "-i", target_path,
+            "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "libx264", "-crf", "18", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", output_path
+        ]
+        result = subprocess.run(command, stderr=subprocess.PIPE)
+        if result.returncode == 0:
+            os.remove(video_path)
+            return
+        logger.warning(f"Restoring audio failed, keeping the video without audio: {result.stderr.decode(errors='replace')}")
+    shutil.move(video_path, output_path)
+
+
+# Engine shared by every request of the process, created on first use
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(model_path):
+    """
+    Returns the process-wide face swap engine, loading it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = FaceSwapEngine(model_path)
+        return _engine
@@ -0,0 +1,51 @@
+import os
+import glob
+import shutil
+
+
+class JobWorkspace:
+    """
+    A job-scoped working directory holding the job's inputs and output, so concurrent
+    face swap jobs never touch each other's files.
+
+    Layout:
+        <root>/<job_id>/source_image
+        <root>/<job_id>/source_image_<identity>   (one per mapped target identity)
+        <root>/<job_id>/target_video.mp4    (downloaded targets only; catalogue videos are read in place)
+        <root>/<job_id>/output_video.mp4
+        <root>/<job_id>/job.json            (persisted job state)
+
+    Args:
+        root (str): Directory holding the workspaces of all jobs.
+        job_id (str): Id of the job owning the workspace.
+    """
+
+    def __init__(self, root, job_id):
+        self.path = os.path.join(root, job_id)
+        self.source_image_path = os.path.join(self.path, 'source_image')
+        self.target_video_path = os.path.join(self.path, 'target_video.mp4')
+        self.output_video_path = os.path.join(self.path, 'output_video.mp4')
+        self.job_file = os.path.join(self.path, 'job.json')
+
+    def identity_source_image_path(self, identity):
+        return f'{self.source_image_path}_{identity}'
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def cleanup_inputs(self):
+        """
+        Deletes the downloaded inputs of a finished job; the output is kept.
+        """
+        for path in glob.glob(f'{self.source_image_path}*') + [self.target_video_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove(self):
+        """
+        Deletes the whole workspace, output included.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)